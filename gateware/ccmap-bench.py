@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+from midicontroller import MIDIController, curve_table, CURVE_ATTENUATION
+from amaranth.sim import Simulator, Tick, Settle, Passive
+
+if __name__ == "__main__":
+    dut = MIDIController()
+    payload = dut.midi_stream.payload
+    valid   = dut.midi_stream.valid
+    ready   = dut.midi_stream.ready
+    curve   = curve_table()
+
+    # register writes which arrive at the JT51 side of the output FIFO
+    writes = []
+
+    def send_packet(*packet, wait=32):
+        """ sends one 4 byte USB MIDI event packet, honouring ready """
+        yield valid.eq(1)
+        for byte in packet:
+            yield payload.eq(byte)
+            yield Settle()
+            while not (yield ready):
+                yield Tick("usb")
+                yield Settle()
+            yield Tick("usb")
+        yield valid.eq(0)
+        yield payload.eq(0)
+        for _ in range(wait):
+            yield Tick("usb")
+
+    def usb_midi_sysex(message):
+        # split a sysex message into 4 byte USB MIDI event packets
+        packets = []
+        for i in range(0, len(message), 3):
+            chunk = message[i:i + 3]
+            cin = 0x4 + len(chunk) if chunk[-1] == 0xf7 else 0x4
+            packets += [cin] + chunk + [0] * (3 - len(chunk))
+        return packets
+
+    def control_change(channel, cc, value):
+        yield from send_packet(0x0b, 0xb0 | channel, cc, value)
+
+    def take_writes():
+        result = list(writes)
+        writes.clear()
+        return result
+
+    def usb_process():
+        for _ in range(2**10 + 300):
+            yield Tick("usb")
+        writes.clear()
+
+        # default map: the mod wheel sets PMD
+        yield from control_change(0, 1, 64)
+        assert take_writes() == [(0x19, 0x80 | 64)]
+
+        # default map: expression sets TL of the C2 operators of the voices playing the channel
+        yield from send_packet(0x09, 0x90, 69, 100)
+        yield from send_packet(0x09, 0x91, 69, 100)
+        yield from send_packet(0x09, 0x90, 72, 100)
+        writes.clear()
+        yield from control_change(0, 11, 64)
+        tl = curve[CURVE_ATTENUATION * 128 + 64]
+        assert take_writes() == [(0x78, tl), (0x7a, tl)]
+
+        # unmapped CCs are dropped
+        yield from control_change(0, 7, 64)
+        assert take_writes() == []
+
+        # map CC 74 of channel 2 to the feedback bits 3 to 5 of 0x20, keeping RL and CON 4
+        yield from send_packet(*usb_midi_sysex([0xf0, MIDIController.SYSEX_CC_MAP, 2, 74,
+                                                0x2, 0x0, 0xc, 0x4, 3, 3, 0, 0, 0xf7]))
+        yield from control_change(2, 74, 127)
+        assert take_writes() == [(0x20, 0xc4 | 7 << 3)]
+        yield from control_change(2, 74, 32)
+        assert take_writes() == [(0x20, 0xc4 | 2 << 3)]
+        print("CC map: all checks passed")
+
+    def jt51_process():
+        yield Passive()
+        yield dut.jt51_stream.ready.eq(1)
+        while True:
+            yield Tick("jt51")
+            if (yield dut.jt51_stream.valid):
+                entry = yield dut.jt51_stream.payload
+                writes.append(((entry >> 8) & 0xff, entry & 0xff))
+
+    sim = Simulator(dut)
+    sim.add_clock(1.0/60e6, domain="usb")
+    sim.add_clock(1.0/30e6, domain="jt51")
+    sim.add_sync_process(usb_process, domain="usb")
+    sim.add_sync_process(jt51_process, domain="jt51")
+
+    with sim.write_vcd(f'ccmap.vcd'):
+        sim.run()
@@ -1,62 +1,149 @@
-from amaranth         import Elaboratable, Module, Signal, Instance, ClockDomain
+from amaranth         import Elaboratable, Module, Signal, Instance, ClockDomain, Cat, Const, Mux, Memory
 from amaranth.hdl.ast import ResetSignal
 from amlib.stream import StreamInterface
 
 class Jt51Streamer(Elaboratable):
+    """ Writes the address/data pairs of input_stream into the JT51.
+
+        The next FIFO entry is read while the chip is busy with the previous write,
+        so a write starts as soon as busy drops. A shadow of the register file in
+        block RAM drops writes which would not change a register, except for those
+        in UNSHADOWED. Registers start out as unknown, so the first write to each
+        of them always goes through.
+
+        The shadow doubles as a mirror of the chip state, which a readback
+        entry in input_stream sends to mirror, after all writes before it.
+    """
+    # writes to these always have to reach the chip
+    UNSHADOWED = [
+        0x01, # test register, bit 1 resets the LFO
+        0x08, # key on/off
+        0x14, # timer load, IRQ enable and flag reset
+    ]
+
+    # shadow slots beyond the 256 registers, like in YM2151Shadow:
+    # 0x19 holds the AM depth when bit 7 is 0 and the PM depth when bit 7 is 1,
+    # and the key on writes to 0x08 go to one slot per channel
+    PMD_SLOT     = 0x100
+    KEY_ON_SLOT  = 0x108
+    MIRROR_SLOTS = 0x110
+
     def __init__(self, jt51) -> None:
-        self.input_stream = StreamInterface(payload_width=16)
+        # address and data, or a latency ping tag, see MIDIController.PING_FLAG
+        self.input_stream = StreamInterface(payload_width=17)
         self.jt51 = jt51
+        # strobes when a ping has been read, after all writes before it have completed
+        self.ping_done     = Signal()
+        self.ping_done_tag = Signal(14)
+        # the MIRROR_SLOTS shadow slots, with bit 8 set for the registers which have been
+        # written, as the reply of a readback, see MIDIController.READBACK_FLAG
+        self.mirror = StreamInterface(payload_width=9)
+
+        # statistics, in the jt51 domain
+        self.writes_issued     = Signal(32)
+        self.writes_suppressed = Signal(32)
+        # cycles in which a write was ready but the chip was busy
+        self.busy_cycles       = Signal(32)
+
+    def slot(self, address, data):
+        """ the shadow slot of a register write """
+        return Mux((address == 0x19) & data[7], self.PMD_SLOT,
+                   Mux(address == 0x08, self.KEY_ON_SLOT | data[0:3], address))
 
     def elaborate(self, platform):
         m = Module()
         jt51 = self.jt51
 
-        ready   = Signal()
-        valid   = Signal()
-        address = Signal(8)
-        data    = Signal(8)
-        busy    = Signal()
+        # the prefetched FIFO entry
+        pending  = Signal()
+        address  = Signal(8)
+        data     = Signal(8)
+        ping     = Signal()
+        readback = Signal()
+        busy     = Signal()
+        # data of the write in progress, the next entry is prefetched meanwhile
+        written = Signal(8)
 
+        # register values, with bit 8 set once the register has been written
+        shadow = Memory(width=9, depth=512)
+        m.submodules.shadow_read  = shadow_read  = shadow.read_port(domain="jt51", transparent=False)
+        m.submodules.shadow_write = shadow_write = shadow.write_port(domain="jt51")
+        clearing    = Signal(reset=1)
+        clear_index = Signal(range(self.MIRROR_SLOTS))
+        mirror_index = Signal(range(self.MIRROR_SLOTS))
+
+        payload    = self.input_stream.payload
+        unshadowed = Signal()
+        unchanged  = Signal()
         m.d.comb += [
-            self.input_stream.ready.eq(ready),
-            valid.eq(self.input_stream.valid),
             busy.eq(jt51.dout[7]),
+            # the shadow entry of an entry is read in the cycle it is taken from the FIFO
+            self.input_stream.ready.eq(~pending & ~clearing),
+            shadow_read.addr.eq(Mux(pending, self.slot(address, data), self.slot(payload[8:16], payload[:8]))),
+            unshadowed.eq(Cat(address == register for register in self.UNSHADOWED).any()),
+            unchanged.eq(shadow_read.data[8] & (shadow_read.data[0:8] == data) & ~unshadowed),
         ]
 
-        with m.If(valid & ready):
+        with m.If(self.input_stream.valid & self.input_stream.ready):
             m.d.jt51 += [
-                address.eq(self.input_stream.payload[8:]),
-                data.eq(self.input_stream.payload[:8]),
-                ready.eq(0), # only read one FIFO entry
+                address.eq(payload[8:16]),
+                data.eq(payload[:8]),
+                ping.eq(payload[16]),
+                readback.eq(payload[14]),
+                pending.eq(1),
             ]
 
+        # after a reset of the jt51 domain all registers are unknown again
+        with m.If(clearing):
+            m.d.comb += [
+                shadow_write.addr.eq(clear_index),
+                shadow_write.data.eq(0),
+                shadow_write.en.eq(1),
+            ]
+            m.d.jt51 += clear_index.eq(clear_index + 1)
+            with m.If(clear_index == self.MIRROR_SLOTS - 1):
+                m.d.jt51 += clearing.eq(0)
+
         with m.FSM(domain="jt51"):
             with m.State("IDLE"):
-                # address comes always first
                 m.d.jt51 += [
                     jt51.wr_n.eq(1),
                     # address comes always first
                     jt51.a0.eq(0),
                 ]
 
-                with m.If(valid & ~busy):
-                    # read a FIFO entry
-                    m.d.jt51 += ready.eq(1)
-                    m.next = "FIFO_READ"
+                with m.If(pending & busy):
+                    m.d.jt51 += self.busy_cycles.eq(self.busy_cycles + 1)
 
-            with m.State("FIFO_READ"):
-                # in this cycle, ready is 1
-                # and the read values appear
-                # in the next cycle
-                m.d.jt51 += ready.eq(0)
-                m.next = "WRITE_ADDRESS"
+                with m.Elif(pending & ping & readback):
+                    # the entry stays pending during the readback,
+                    # so no other entry is read meanwhile
+                    m.d.jt51 += mirror_index.eq(0)
+                    m.next = "MIRROR_READ"
 
-            with m.State("WRITE_ADDRESS"):
-                m.d.jt51 += [
-                    jt51.din.eq(address),
-                    jt51.wr_n.eq(0),
-                ]
-                m.next = "ADDRESS_DONE"
+                with m.Elif(pending):
+                    m.d.jt51 += pending.eq(0)
+                    with m.If(ping):
+                        # the chip is not busy anymore, so all writes before the ping are done
+                        m.d.comb += [
+                            self.ping_done.eq(1),
+                            self.ping_done_tag.eq(Cat(data, address)[:14]),
+                        ]
+                    with m.Elif(unchanged):
+                        m.d.jt51 += self.writes_suppressed.eq(self.writes_suppressed + 1)
+                    with m.Else():
+                        m.d.comb += [
+                            shadow_write.addr.eq(self.slot(address, data)),
+                            shadow_write.data.eq(Cat(data, Const(1, 1))),
+                            shadow_write.en.eq(1),
+                        ]
+                        m.d.jt51 += [
+                            jt51.din.eq(address),
+                            jt51.wr_n.eq(0),
+                            written.eq(data),
+                            self.writes_issued.eq(self.writes_issued + 1),
+                        ]
+                        m.next = "ADDRESS_DONE"
 
             with m.State("ADDRESS_DONE"):
                 m.d.jt51 += jt51.wr_n.eq(1)
@@ -65,7 +152,7 @@ class Jt51Streamer(Elaboratable):
             with m.State("WRITE_DATA"):
                 m.d.jt51 += [
                     jt51.a0.eq(1),
-                    jt51.din.eq(data),
+                    jt51.din.eq(written),
                     jt51.wr_n.eq(0),
                 ]
                 m.next = "WAIT_ONE"
@@ -76,6 +163,27 @@ class Jt51Streamer(Elaboratable):
                 m.d.jt51 += jt51.wr_n.eq(1)
                 m.next = "IDLE"
 
+            # the shadow reads the slot in this cycle
+            with m.State("MIRROR_READ"):
+                m.d.comb += shadow_read.addr.eq(mirror_index)
+                m.next = "MIRROR_SEND"
+
+            with m.State("MIRROR_SEND"):
+                m.d.comb += [
+                    shadow_read.addr.eq(mirror_index),
+                    self.mirror.valid.eq(1),
+                    self.mirror.payload.eq(shadow_read.data),
+                    self.mirror.first.eq(mirror_index == 0),
+                    self.mirror.last.eq(mirror_index == self.MIRROR_SLOTS - 1),
+                ]
+                with m.If(self.mirror.ready):
+                    m.d.jt51 += mirror_index.eq(mirror_index + 1)
+                    with m.If(mirror_index == self.MIRROR_SLOTS - 1):
+                        m.d.jt51 += pending.eq(0)
+                        m.next = "IDLE"
+                    with m.Else():
+                        m.next = "MIRROR_READ"
+
         return m
 
 class Jt51(Elaboratable):
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+from amaranth import Elaboratable, Module, Signal
+from amaranth.sim import Simulator, Tick, Settle, Passive
+from jt51 import Jt51Streamer
+
+# the jt51 clock of the synth
+JT51_CLOCK = 3.584e6
+# jt51 clock cycles of busy after a data write. Assumed to be 32 cycles
+# of cen_p1, which SynthModule runs at half the jt51 clock
+BUSY_CYCLES = 64
+PING_FLAG     = 1 << 16
+READBACK_FLAG = 1 << 14
+
+class BusyModel(Elaboratable):
+    """ the bus interface of the JT51, busy for BUSY_CYCLES after a data write """
+    def __init__(self):
+        self.wr_n = Signal(reset=1)
+        self.a0   = Signal()
+        self.din  = Signal(8)
+        self.dout = Signal(8)
+
+    def elaborate(self, platform):
+        m = Module()
+        counter = Signal(range(BUSY_CYCLES + 1))
+        with m.If(~self.wr_n & self.a0):
+            m.d.jt51 += counter.eq(BUSY_CYCLES)
+        with m.Elif(counter != 0):
+            m.d.jt51 += counter.eq(counter - 1)
+        m.d.comb += self.dout[7].eq(counter != 0)
+        return m
+
+def slot(address, data):
+    if address == 0x19 and data & 0x80:
+        return Jt51Streamer.PMD_SLOT
+    if address == 0x08:
+        return Jt51Streamer.KEY_ON_SLOT | data & 0x7
+    return address
+
+def expected_writes(entries, shadow=None):
+    """ reference model of the register shadow """
+    shadow = {} if shadow is None else shadow
+    result = []
+    for entry in entries:
+        if entry & PING_FLAG:
+            continue
+        address, data = entry >> 8, entry & 0xff
+        if address in Jt51Streamer.UNSHADOWED or shadow.get(slot(address, data)) != data:
+            shadow[slot(address, data)] = data
+            result.append((address, data))
+    return result
+
+if __name__ == "__main__":
+    chip = BusyModel()
+    dut  = Jt51Streamer(chip)
+    m = Module()
+    m.submodules.chip = chip
+    m.submodules.dut  = dut
+    stream = dut.input_stream
+
+    # register writes as seen by the chip
+    writes = []
+    pings  = []
+    mirror = []
+
+    def feed(entries):
+        """ offers the entries like a FIFO which is never empty, returns the cycles taken """
+        cycles = 0
+        yield stream.valid.eq(1)
+        for entry in entries:
+            yield stream.payload.eq(entry)
+            yield Settle()
+            while not (yield stream.ready):
+                yield Tick("jt51")
+                yield Settle()
+                cycles += 1
+            yield Tick("jt51")
+            cycles += 1
+        yield stream.valid.eq(0)
+        # until the last write has completed
+        yield Settle()
+        while (yield chip.dout[7]) or (yield dut.input_stream.ready) == 0:
+            yield Tick("jt51")
+            yield Settle()
+            cycles += 1
+        for _ in range(8):
+            yield Tick("jt51")
+        return cycles
+
+    def counters():
+        return ((yield dut.writes_issued), (yield dut.writes_suppressed), (yield dut.busy_cycles))
+
+    def stream_process():
+        # the shadow is cleared after reset
+        for _ in range(300):
+            yield Tick("jt51")
+
+        # repeated values are dropped, except for the unshadowed registers,
+        # 0x19 holds two values, and a ping is reported after the writes before it
+        entries = [0x2000 | 0xc7, 0x2000 | 0xc7, 0x0800 | 0x78, 0x0800 | 0x78, 0x1900 | 0x7f, 0x1900 | 0xff,
+                   0x1900 | 0x7f, 0x2000 | 0xc0, PING_FLAG | 0x1234, 0x0100 | 0x02, 0x0100 | 0x02, 0x2000 | 0xc0]
+        yield from feed(entries)
+        assert writes == expected_writes(entries), writes
+        assert pings == [(0x1234, len(expected_writes(entries[:8])))], pings
+        issued, suppressed, _ = yield from counters()
+        assert (issued, suppressed) == (len(writes), len(entries) - len(writes) - 1)
+        writes.clear()
+
+        # sustained rate of writes which all change a register
+        count = 1000
+        changing = [(0x60 + i % 32) << 8 | (i // 32) % 0x80 for i in range(count)]
+        before = yield from counters()
+        cycles = yield from feed(changing)
+        after  = yield from counters()
+        assert writes == expected_writes(changing)
+        stalls = after[2] - before[2]
+        print(f"changing writes: {cycles / count:.1f} cycles per write, "
+              f"{count * JT51_CLOCK / cycles:.0f} writes/s, {stalls / count:.1f} busy stall cycles per write")
+        assert cycles / count <= BUSY_CYCLES + 5
+        writes.clear()
+
+        # a stream in which every other write repeats the register value
+        repeating = [entry for entry in changing for _ in range(2)]
+        before = yield from counters()
+        cycles = yield from feed(repeating)
+        after  = yield from counters()
+        assert writes == expected_writes(repeating)
+        suppressed = after[1] - before[1]
+        print(f"half redundant writes: {len(repeating) * JT51_CLOCK / cycles:.0f} writes/s sustained, "
+              f"{suppressed} of {len(repeating)} suppressed")
+
+        # a readback sends all shadow slots, with bit 8 set for the written ones
+        shadow = {}
+        expected_writes(entries + changing, shadow)
+        yield from feed([PING_FLAG | READBACK_FLAG | 0x0042])
+        assert len(mirror) == Jt51Streamer.MIRROR_SLOTS
+        assert mirror == [0x100 | shadow[i] if i in shadow else 0 for i in range(Jt51Streamer.MIRROR_SLOTS)]
+        assert pings == [(0x1234, len(expected_writes(entries[:8])))], pings
+        print("jt51 streamer: all checks passed")
+
+    def chip_process():
+        yield Passive()
+        yield dut.mirror.ready.eq(1)
+        address = None
+        while True:
+            yield Tick("jt51")
+            if (yield dut.mirror.valid) and (yield dut.mirror.ready):
+                mirror.append((yield dut.mirror.payload))
+            if (yield dut.ping_done):
+                pings.append(((yield dut.ping_done_tag), len(writes)))
+            if not (yield chip.wr_n):
+                if (yield chip.a0):
+                    writes.append((address, (yield chip.din)))
+                else:
+                    address = yield chip.din
+
+    sim = Simulator(m)
+    sim.add_clock(1.0/JT51_CLOCK, domain="jt51")
+    sim.add_sync_process(stream_process, domain="jt51")
+    sim.add_sync_process(chip_process, domain="jt51")
+
+    with sim.write_vcd(f'jt51streamer.vcd'):
+        sim.run()
@@ -17,16 +17,20 @@ class JT51Synth(Elaboratable):
     """ JT51 based FPGA synthesizer with USB MIDI, TopLevel Module """
 
     USE_ILA = False
+    # enable the EP1 IN endpoint, which echoes latency pings to the host
+    USE_MIDI_IN = False
 
     def elaborate(self, platform):
         m = Module()
 
         # Generate our domain clocks/resets.
         m.submodules.car         = platform.clock_domain_generator()
-        m.submodules.usbmidi     = usbmidi = USBMIDI(use_ila=self.USE_ILA)
-        m.submodules.synthmodule = synthmodule = SynthModule()
+        m.submodules.usbmidi     = usbmidi = USBMIDI(use_ila=self.USE_ILA, with_midi_in=self.USE_MIDI_IN)
+        m.submodules.synthmodule = synthmodule = SynthModule(with_midi_in=self.USE_MIDI_IN)
 
         m.d.comb += synthmodule.midi_stream.stream_eq(usbmidi.stream_out),
+        if self.USE_MIDI_IN:
+            m.d.comb += usbmidi.stream_in.stream_eq(synthmodule.midi_out)
 
         adat = platform.request("adat")
         m.d.comb += adat.tx.eq(synthmodule.adat_out)
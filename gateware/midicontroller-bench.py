@@ -1,9 +1,9 @@
 #!/usr/bin/env python3
 from midicontroller import MIDIController
-from amaranth.sim import Simulator, Tick
+from amaranth.sim import Simulator, Tick, Settle
 
 if __name__ == "__main__":
-    dut = MIDIController()
+    dut = MIDIController(with_midi_in=True)
     payload = dut.midi_stream.payload
     valid = dut.midi_stream.valid
 
@@ -11,10 +11,32 @@ if __name__ == "__main__":
         yield valid.eq(1)
         for byte in args:
             yield payload.eq(byte)
+            yield Settle()
+            while not (yield dut.midi_stream.ready):
+                yield Tick("usb")
+                yield Settle()
             yield Tick("usb")
         yield payload.eq(0)
         yield valid.eq(0)
 
+    def pack_7bit(data):
+        # groups of 7 bytes, preceded by a byte holding their MSBs
+        result = []
+        for i in range(0, len(data), 7):
+            group = data[i:i + 7]
+            result.append(sum(((byte >> 7) & 1) << n for n, byte in enumerate(group)))
+            result += [byte & 0x7f for byte in group]
+        return result
+
+    def usb_midi_sysex(message):
+        # split a sysex message into 4 byte USB MIDI event packets
+        packets = []
+        for i in range(0, len(message), 3):
+            chunk = message[i:i + 3]
+            cin = 0x4 + len(chunk) if chunk[-1] == 0xf7 else 0x4
+            packets += [cin] + chunk + [0] * (3 - len(chunk))
+        return packets
+
     def midi_message(*args, set_valid=True):
         if set_valid:
             yield valid.eq(1)
@@ -72,6 +94,21 @@ if __name__ == "__main__":
             yield Tick("usb")
         # send USB MIDI sysex
         yield from sysex(0x04, 0xf0, 0x0a, 0x0b, 0x07, 0x0c, 0x0d, 0xf7)
+        for _ in range(40):
+            yield Tick("usb")
+        # send bulk sysex with three address/data pairs
+        pairs = [0x20, 0xfa, 0x60, 0x1f, 0x08, 0x78]
+        yield from sysex(*usb_midi_sysex([0xf0, MIDIController.SYSEX_BULK] + pack_7bit(pairs) + [0xf7]))
+        for _ in range(40):
+            yield Tick("usb")
+        # send an address run message, with three channel registers and two operator registers
+        runs = [0x28, 3, 0x4a, 0x4b, 0x4c, 0x60, 0x80 | 2, 0x10, 0x20]
+        yield from sysex(*usb_midi_sysex([0xf0, MIDIController.SYSEX_RUNS] + pack_7bit(runs) + [0xf7]))
+        for _ in range(40):
+            yield Tick("usb")
+        # send a latency ping with tag 0x1234, which is echoed on midi_out
+        yield dut.midi_out.ready.eq(1)
+        yield from sysex(*usb_midi_sysex([0xf0, MIDIController.SYSEX_PING, 0x1234 >> 7, 0x1234 & 0x7f, 0xf7]))
         for _ in range(40):
             yield Tick("usb")
         yield dut.midi_stream.valid.eq(1)
@@ -1,9 +1,12 @@
 #!/usr/bin/env python3
+import math
 from amaranth import *
 from amaranth.lib.fifo import AsyncFIFO
 from amaranth.cli import main
 from amlib.stream import StreamInterface
 from mido.messages.specs import SPEC_LOOKUP
+from voiceallocator import VoiceAllocator
+from jt51 import Jt51Streamer
 
 midi_to_keycode = {
     1:   0,  # C#
@@ -20,16 +23,132 @@ midi_to_keycode = {
     0:  14   # C
 }
 
+# the YM2151 plays 8 octaves from C#0 to C8, MIDI notes 13 to 108
+LOWEST_NOTE = 13
+SEMITONES   = 96
+# key fraction steps per semitone
+KF_STEPS    = 64
+
+def keycode_table():
+    """ YM2151 key code (octave, note) for each MIDI note number, 0 outside the YM2151 range """
+    return [((((note - 1) // 12) - 1) << 4) | midi_to_keycode[note % 12]
+            if LOWEST_NOTE <= note < LOWEST_NOTE + SEMITONES else 0
+            for note in range(128)]
+
+def bend_table(bend_range, width):
+    """ pitch offset in key fraction steps for the upper 8 bits of the 14 bit
+        pitch bend value, as width bit two's complement """
+    return [round((i - 128) * bend_range * KF_STEPS / 128) & ((1 << width) - 1) for i in range(256)]
+
+# scaling curves of the CC map, from the 7 bit CC value to a 7 bit field value
+CURVE_LINEAR      = 0
+CURVE_INVERTED    = 1
+# YM2151 attenuation (TL, 0.75dB per step) for the CC value as amplitude
+CURVE_ATTENUATION = 2
+CURVE_SQUARED     = 3
+
+def curve_table():
+    attenuation = lambda value: 127 if value == 0 else min(127, round(-20 * math.log10(value / 127) / 0.75))
+    curves = [
+        lambda value: value,
+        lambda value: 127 - value,
+        attenuation,
+        lambda value: round(value * value / 127),
+    ]
+    return [curve(value) for curve in curves for value in range(128)]
+
+def cc_map_entry(address, *, base=0, shift=0, width=7, curve=CURVE_LINEAR, per_voice=False):
+    """ a CC map table entry: the CC value, scaled by curve to width bits,
+        is written to bits shift and up of register address, the other bits are base.
+        With per_voice, the address is that of channel 0 and the value is written
+        to all voices which play notes of the MIDI channel. Width 0 means unmapped """
+    return address | base << 8 | shift << 16 | width << 19 | curve << 22 | int(per_voice) << 24
+
+def default_cc_map():
+    """ for all MIDI channels: the mod wheel sets the PMD and expression the TL of the C2 operators """
+    table = [0] * (16 * 128)
+    for channel in range(16):
+        table[channel << 7 | 1]  = cc_map_entry(0x19, base=0x80)
+        table[channel << 7 | 11] = cc_map_entry(0x78, curve=CURVE_ATTENUATION, per_voice=True)
+    return table
+
+# the registers of a voice patch, as addresses of YM2151 channel 0 in the order of
+# the patch store: RL/FB/CON, PMS/AMS, then DT1/MUL, TL, KS/AR, AMS-EN/D1R, DT2/D2R
+# and D1L/RR of the operators M1, M2, C1, C2
+PATCH_REGISTERS = [0x20, 0x38] + [base + operator * 8
+                                  for base in range(0x40, 0x100, 0x20) for operator in range(4)]
+
+def default_patch():
+    """ the voice set up by the initialization of MIDIController """
+    init = {0x20: 0xfa}
+    init.update((address, 0x1f) for address in range(0x60, 0xa0))
+    return [init.get(address, 0) for address in PATCH_REGISTERS]
+
 class MIDIController(Elaboratable):
-    def __init__(self):
-        self.midi_stream = StreamInterface(payload_width=8)
-        self.jt51_stream = StreamInterface(payload_width=16)
+    # first sysex byte of a bulk register write message.
+    # This is the non-commercial manufacturer ID, which can never be
+    # mistaken for the address high nibble of a single pair message
+    SYSEX_BULK = 0x7d
+    # first sysex byte of a latency ping: F0 7C <tag high 7 bits> <tag low 7 bits> F7.
+    # With MIDI IN, the ping is echoed as F0 7C <stage> <tag high> <tag low> F7,
+    # once with stage PING_QUEUED when it has been written into the output FIFO,
+    # behind all register writes sent before it, and once with stage PING_DONE
+    # when the Jt51Streamer has completed all those writes
+    SYSEX_PING  = 0x7c
+    # first sysex byte of a CC map entry:
+    # F0 7B <MIDI channel> <CC> <address high nibble> <address low nibble>
+    #       <base high nibble> <base low nibble> <shift> <width> <curve> <per voice> F7
+    # see cc_map_entry()
+    SYSEX_CC_MAP = 0x7b
+    # first sysex byte of a patch upload: F0 7A <program> <packed patch> F7,
+    # the patch registers in the order of PATCH_REGISTERS, packed like a bulk message
+    SYSEX_PATCH  = 0x7a
+    PATCHES      = 128
+    # first sysex byte of a register readback request, with MIDI IN only:
+    # F0 79 <tag high 7 bits> <tag low 7 bits> F7. After all register writes sent
+    # before it, the Jt51Streamer mirror of the chip state is sent to the host as
+    # F0 79 <tag high> <tag low> <slot 0> ... <slot 0x10f> F7, each slot as
+    # <known << 4 | value high nibble> <value low nibble>, see Jt51Streamer.MIRROR_SLOTS.
+    # A request while the reply to the previous one is pending is dropped
+    SYSEX_READBACK = 0x79
+    # first sysex byte of an address run register write: F0 78 <packed runs> F7.
+    # The runs are packed like a bulk message, each is <start address> <step 8 << 7 | count>
+    # followed by count data bytes, which go to the registers start, start + step ...
+    # with a step of 1, or 8 if bit 7 of the count byte is set
+    SYSEX_RUNS = 0x78
+    PING_QUEUED = 0
+    PING_DONE   = 1
+    # output FIFO entries are address and data, or a ping tag with this bit set
+    PING_FLAG   = 16
+    # a ping entry with this bit set too is a readback request
+    READBACK_FLAG = 14
+
+    # width of a pitch bend offset in key fraction steps
+    BEND_WIDTH = 12
+
+    def __init__(self, with_midi_in=False, *, bend_range=2, bend_interval=60_000):
+        """ bend_range is the pitch bend range in semitones. Pitch bends are applied
+            to the sounding voices at most once per bend_interval USB clock cycles,
+            the default is 1ms at 60MHz """
+        self.with_midi_in  = with_midi_in
+        self.bend_range    = bend_range
+        self.bend_interval = bend_interval
+        self.midi_stream  = StreamInterface(payload_width=8)
+        self.jt51_stream  = StreamInterface(payload_width=17)
+        # USB MIDI event packets to the host, with_midi_in only
+        self.midi_out     = StreamInterface(payload_width=8)
+        # jt51 domain: the Jt51Streamer has reached the ping with the tag ping_done_tag
+        self.ping_done     = Signal()
+        self.ping_done_tag = Signal(14)
+        # jt51 domain: the mirror slots of a readback, with_midi_in only
+        self.mirror        = StreamInterface(payload_width=9)
 
     @staticmethod
     def fifo_write(m, fifo, address, data, *, next_state):
         with m.If(fifo.w_rdy):
             m.d.usb += [
-                fifo.w_data.eq(Cat(data, address)),
+                # shifted rather than concatenated, so data may be narrower than 8 bits
+                fifo.w_data.eq((Value.cast(address) << 8) | data),
                 fifo.w_en.eq(1),
             ]
             m.next = next_state
@@ -40,7 +159,7 @@ class MIDIController(Elaboratable):
     def elaborate(self, platform):
         m = Module()
         midi_stream = self.midi_stream
-        output_fifo = AsyncFIFO(width=16, depth=1024, w_domain="usb", r_domain="jt51")
+        output_fifo = AsyncFIFO(width=17, depth=1024, w_domain="usb", r_domain="jt51")
         m.submodules.output_fifo = output_fifo
 
         m.d.comb += [
@@ -61,6 +180,131 @@ class MIDIController(Elaboratable):
         address = Signal(8)
         data    = Signal(8)
 
+        ping_tag = Signal(14)
+        readback = Signal()
+
+        m.submodules.voices = voices = DomainRenamer("usb")(VoiceAllocator())
+        # the YM2151 channel of the current note
+        voice = Signal(3)
+
+        # pitch of voices.note on voices.channel in key fraction steps above C#0,
+        # including the pitch bend of the channel
+        bend  = Array(Signal(signed(self.BEND_WIDTH), name=f"bend_{i}") for i in range(16))
+        pitch = Signal(signed(16))
+        clamped_pitch = Signal(range(SEMITONES * KF_STEPS))
+        m.d.comb += pitch.eq((Cat(voices.note, Const(0, 1)).as_signed() - LOWEST_NOTE) * KF_STEPS
+                             + bend[voices.channel])
+        with m.If(pitch < 0):
+            m.d.comb += clamped_pitch.eq(0)
+        with m.Elif(pitch >= SEMITONES * KF_STEPS):
+            m.d.comb += clamped_pitch.eq(SEMITONES * KF_STEPS - 1)
+        with m.Else():
+            m.d.comb += clamped_pitch.eq(pitch)
+
+        # key code of the pitch, one cycle after voices.note and voices.channel
+        keycode_rom = Memory(width=8, depth=128, init=keycode_table())
+        m.submodules.keycode_rom = keycode_read = keycode_rom.read_port(domain="usb", transparent=False)
+        key_fraction = Signal(8)
+        m.d.comb += [
+            keycode_read.addr.eq(LOWEST_NOTE + (clamped_pitch >> 6)),
+            # KF is in the upper 6 bits of the register
+            key_fraction.eq(clamped_pitch[0:6] << 2),
+        ]
+
+        bend_rom = Memory(width=self.BEND_WIDTH, depth=256, init=bend_table(self.bend_range, self.BEND_WIDTH))
+        m.submodules.bend_rom = bend_read = bend_rom.read_port(domain="usb", transparent=False)
+        bend_channel = Signal(4)
+        bend_lsb     = Signal()
+        # channels whose bend changed since the last update, and those of the current update
+        bend_dirty   = Signal(16)
+        bend_pass    = Signal(16)
+        bend_voice   = Signal(3)
+        # rate limit of the updates
+        bend_timer   = Signal(range(self.bend_interval + 1))
+        with m.If(bend_timer != 0):
+            m.d.usb += bend_timer.eq(bend_timer - 1)
+
+        # CC map, indexed by MIDI channel and CC number
+        cc_map = Memory(width=25, depth=16 * 128, init=default_cc_map())
+        m.submodules.cc_map_read  = cc_map_read  = cc_map.read_port(domain="usb", transparent=False)
+        m.submodules.cc_map_write = cc_map_write = cc_map.write_port(domain="usb")
+        curve_rom = Memory(width=7, depth=4 * 128, init=curve_table())
+        m.submodules.curve_rom = curve_read = curve_rom.read_port(domain="usb", transparent=False)
+
+        cc_channel = Signal(4)
+        cc_value   = Signal(7)
+        cc_voice   = Signal(3)
+        cc_address = Signal(8)
+        cc_data    = Signal(8)
+
+        entry_address   = cc_map_read.data[0:8]
+        entry_base      = cc_map_read.data[8:16]
+        entry_shift     = cc_map_read.data[16:19]
+        entry_width     = cc_map_read.data[19:22]
+        entry_curve     = cc_map_read.data[22:24]
+        entry_per_voice = cc_map_read.data[24]
+        # the curve is read in the cycle the entry arrives, its value comes one cycle later
+        m.d.comb += curve_read.addr.eq(Cat(cc_value, entry_curve))
+        scaled = (curve_read.data >> (7 - entry_width)) << entry_shift
+
+        # sysex decoding of a CC map entry: the data bytes in the order of the message
+        cc_map_index = Signal(4)
+        cc_map_bytes = Array(Signal(7, name=f"cc_map_byte_{i}") for i in range(10))
+        channel_byte, cc_byte, address_high, address_low, base_high, base_low, \
+            shift_byte, width_byte, curve_byte, per_voice_byte = cc_map_bytes
+        m.d.comb += [
+            cc_map_write.addr.eq(Cat(cc_byte, channel_byte[0:4])),
+            cc_map_write.data.eq(Cat(address_low[0:4], address_high[0:4], base_low[0:4], base_high[0:4],
+                                     shift_byte[0:3], width_byte[0:3], curve_byte[0:2], per_voice_byte[0])),
+        ]
+        if self.with_midi_in:
+            self.elaborate_ping_echo(m)
+
+        # patch store, indexed by program and register. Two registers per 16 bit word
+        # keep the depth at that of the CC map, pysim compiles a read of a deeper
+        # memory into more nested branches than Python can handle
+        patch_size  = len(PATCH_REGISTERS)
+        patch_bytes = default_patch() + [0] * (32 - patch_size)
+        patch_words = [low | high << 8 for low, high in zip(patch_bytes[0::2], patch_bytes[1::2])]
+        patches = Memory(width=16, depth=self.PATCHES * 16, init=patch_words * self.PATCHES)
+        m.submodules.patch_read  = patch_read  = patches.read_port(domain="usb", transparent=False)
+        m.submodules.patch_write = patch_write = patches.write_port(domain="usb", granularity=8)
+        patch_register = Array(Const(address, 8) for address in PATCH_REGISTERS)
+
+        # program selected by program change, per MIDI channel
+        channel_program = Array(Signal(7, name=f"channel_program_{i}") for i in range(16))
+        # patch loaded into each voice, valid until that program is uploaded again
+        voice_program   = Array(Signal(7, name=f"voice_program_{i}") for i in range(VoiceAllocator.VOICES))
+        voice_patched   = Signal(VoiceAllocator.VOICES, reset=(1 << VoiceAllocator.VOICES) - 1)
+
+        # patch burst into patch_voice, which is also the voice loop of a program change
+        patch_voice     = Signal(3)
+        patch_program   = Signal(7)
+        patch_slot      = Signal(range(patch_size))
+        patch_for_note  = Signal()
+        program_channel = Signal(4)
+        patch_data      = Signal(8)
+        m.d.comb += [
+            patch_read.addr.eq(Cat(patch_slot[1:], patch_program)),
+            patch_data.eq(patch_read.data.word_select(patch_slot[0], 8)),
+        ]
+
+        # bulk sysex decoding state
+        packet_pos  = Signal(2)
+        group_index = Signal(3)
+        msbs        = Signal(7)
+        data_phase  = Signal()
+        # the decoded bytes of a bulk message go into the patch store instead of the FIFO
+        patch_upload   = Signal()
+        # the decoded bytes are address runs, see SYSEX_RUNS. run_phase is 0 for
+        # the start address, 1 for the count byte and 2 for the data bytes
+        run_mode       = Signal()
+        run_phase      = Signal(2)
+        run_count      = Signal(7)
+        run_step8      = Signal()
+        upload_slot    = Signal(range(patch_size + 1))
+        upload_program = Signal(7)
+
         # USB channel messages come in groups of four bytes:
         # 0S SC DD DD, where S = Status, C = Channel, D = Data
         with m.FSM(domain="usb") as fsm:
@@ -70,17 +314,22 @@ class MIDIController(Elaboratable):
                 with m.If(init_counter[9]):
                     m.next = "INIT_CHANNELS"
 
+            # all eight channels play notes, see VoiceAllocator
             with m.State("INIT_CHANNELS"):
-                self.fifo_write(m, output_fifo, 0x20, 0xfa, next_state="INIT_ENVELOPES")
+                channel_addr = Signal(8, reset=0x20)
+                with m.If(output_fifo.w_rdy):
+                    m.d.usb += channel_addr.eq(channel_addr + 1)
+                with m.If(channel_addr == 0x27):
+                    self.fifo_write(m, output_fifo, channel_addr, Const(0xfa, 8), next_state="INIT_ENVELOPES")
+                with m.Else():
+                    self.fifo_write(m, output_fifo, channel_addr, Const(0xfa, 8), next_state="INIT_CHANNELS")
 
+            # total level and attack rate of all 32 operators
             with m.State("INIT_ENVELOPES"):
                 envelope_addr = Signal(8, reset=0x60)
-                m.d.usb += envelope_addr.eq(envelope_addr + 8)
-                with m.If(envelope_addr <= 0x78):
-                    self.fifo_write(m, output_fifo, envelope_addr, Const(0x1f, shape=8), next_state="INIT_ENVELOPES")
-                    with m.If(envelope_addr == 0x78):
-                        m.d.usb += envelope_addr.eq(0x80)
-                with m.Elif(envelope_addr <= 0x98):
+                with m.If(envelope_addr <= 0x9f):
+                    with m.If(output_fifo.w_rdy):
+                        m.d.usb += envelope_addr.eq(envelope_addr + 1)
                     self.fifo_write(m, output_fifo, envelope_addr, Const(0x1f, shape=8), next_state="INIT_ENVELOPES")
                 with m.Else():
                     m.d.usb += output_fifo.w_en.eq(0)
@@ -91,8 +340,18 @@ class MIDIController(Elaboratable):
                 m.d.usb += output_fifo.w_en.eq(0)
                 m.d.usb += message_index.eq(0)
 
+                with m.If(bend_dirty.any() & (bend_timer == 0)):
+                    m.d.comb += midi_stream.ready.eq(0)
+                    m.d.usb += [
+                        bend_pass.eq(bend_dirty),
+                        bend_dirty.eq(0),
+                        bend_voice.eq(0),
+                        bend_timer.eq(self.bend_interval),
+                    ]
+                    m.next = "BEND_VOICE"
+
                 # All beginning bytes of MIDI messages have their MSB set
-                with m.If(midi_stream.valid):
+                with m.Elif(midi_stream.valid):
                     m.d.comb += status.eq(midi_stream.payload)
 
                     with m.Switch(status):
@@ -108,6 +367,10 @@ class MIDIController(Elaboratable):
                             m.d.usb += length.eq(numbytes('control_change'))
                             m.next = "CONTROL_CHANGE"
 
+                        with m.Case(is_status('program_change')):
+                            m.d.usb += length.eq(numbytes('program_change'))
+                            m.next = "PROGRAM_CHANGE"
+
                         with m.Case(is_status('pitchwheel')):
                             m.d.usb += length.eq(numbytes('pitchwheel'))
                             m.next = "PITCH_WHEEL"
@@ -127,37 +390,69 @@ class MIDIController(Elaboratable):
 
                     with m.Switch(message_index):
                         with m.Case(0):
-                            # limit MIDI channels to 0-7
-                            channel_no = (midi_stream.payload & 0b111)
-                            # 0x28 = KEY CODE base address
-                            m.d.usb += address.eq(0x28 + channel_no)
+                            m.d.usb += voices.channel.eq(midi_stream.payload[0:4])
 
                         with m.Case(1):
-                            with m.Switch(midi_stream.payload):
-                                for note in range(13, 109):
-                                    with m.Case(note):
-                                        keycode = Const(midi_to_keycode[note % 12], 4)
-                                        msb = Const((((note - 1) // 12) - 1), 4)
-                                        m.d.usb += data.eq(Cat(keycode, msb))
-                                with m.Default():
-                                    m.d.usb += data.eq(0)
+                            m.d.usb += voices.note.eq(midi_stream.payload[0:7])
 
                         with m.Case(2):
-                            self.fifo_write(m, output_fifo, address, data, next_state="NOTE_ON_II")
+                            # note on with velocity 0 is a note off
+                            with m.If(midi_stream.payload == 0):
+                                m.next = "NOTE_RELEASE"
+                            with m.Else():
+                                m.next = "NOTE_ALLOCATE"
 
                         with m.Default():
                             m.next = "WAIT_END"
                 with m.Else():
                     m.next = "WAIT_END"
 
-            with m.State("NOTE_ON_II"):
-                # do not start reading next MIDI event while we are sending this one
+            # do not start reading the next MIDI event while we are sending this one
+            with m.State("NOTE_ALLOCATE"):
+                m.d.comb += [
+                    midi_stream.ready.eq(0),
+                    voices.allocate.eq(1),
+                ]
+                m.d.usb += voice.eq(voices.voice)
+                m.next = "NOTE_ON_KEY_OFF"
+
+            # key off first, so the envelope restarts when the voice was playing
+            with m.State("NOTE_ON_KEY_OFF"):
+                m.d.comb += midi_stream.ready.eq(0)
+                self.fifo_write(m, output_fifo, Const(0x08, 8), voice, next_state="NOTE_ON_PATCH")
+
+            # load the program of the channel, unless the voice already has it
+            with m.State("NOTE_ON_PATCH"):
+                m.d.comb += midi_stream.ready.eq(0)
+                m.d.usb += output_fifo.w_en.eq(0)
+                program = channel_program[voices.channel]
+                with m.If(voice_patched.bit_select(voice, 1) & (voice_program[voice] == program)):
+                    m.next = "NOTE_ON_KEY_CODE"
+                with m.Else():
+                    m.d.usb += [
+                        patch_voice.eq(voice),
+                        patch_program.eq(program),
+                        patch_slot.eq(0),
+                        patch_for_note.eq(1),
+                    ]
+                    m.next = "PATCH_READ"
+
+            with m.State("NOTE_ON_KEY_CODE"):
                 m.d.comb += midi_stream.ready.eq(0)
+                # 0x28 = KEY CODE base address
+                self.fifo_write(m, output_fifo, Const(0x28, 8) + voice, keycode_read.data,
+                                next_state="NOTE_ON_KEY_FRACTION")
 
-                channel_no = (midi_stream.payload & 0b111)
+            with m.State("NOTE_ON_KEY_FRACTION"):
+                m.d.comb += midi_stream.ready.eq(0)
+                # 0x30 = KEY FRACTION base address
+                self.fifo_write(m, output_fifo, Const(0x30, 8) + voice, key_fraction, next_state="NOTE_ON_KEY_ON")
+
+            with m.State("NOTE_ON_KEY_ON"):
+                m.d.comb += midi_stream.ready.eq(0)
                 # turn all oscillators on
                 c2_m2_c1_m1 = 0b1111
-                self.fifo_write(m, output_fifo, 0x08, (c2_m2_c1_m1 << 3) | channel_no, next_state="IDLE")
+                self.fifo_write(m, output_fifo, Const(0x08, 8), Const(c2_m2_c1_m1 << 3, 8) | voice, next_state="IDLE")
 
             with m.State("NOTE_OFF"):
                 with m.If(midi_stream.valid):
@@ -168,24 +463,234 @@ class MIDIController(Elaboratable):
 
                     with m.Switch(message_index):
                         with m.Case(0):
-                            # limit MIDI channels to 0-7
-                            m.d.usb += address.eq(0x08)
-                            m.d.usb += data.eq(midi_stream.payload & 0b111)
+                            m.d.usb += voices.channel.eq(midi_stream.payload[0:4])
                         with m.Case(1):
-                            pass
+                            m.d.usb += voices.note.eq(midi_stream.payload[0:7])
                         with m.Case(2):
-                            self.fifo_write(m, output_fifo, address, data, next_state="IDLE")
+                            m.next = "NOTE_RELEASE"
                         with m.Default():
                             m.next = "WAIT_END"
+                with m.Else():
+                    m.next = "WAIT_END"
+
+            # only the voice playing this note is keyed off
+            with m.State("NOTE_RELEASE"):
+                m.d.comb += midi_stream.ready.eq(0)
+                with m.If(voices.release_found):
+                    m.d.comb += voices.release.eq(1)
+                    m.d.usb += voice.eq(voices.release_voice)
+                    m.next = "NOTE_OFF_KEY_OFF"
+                with m.Else():
+                    m.next = "IDLE"
 
+            with m.State("NOTE_OFF_KEY_OFF"):
+                m.d.comb += midi_stream.ready.eq(0)
+                self.fifo_write(m, output_fifo, Const(0x08, 8), voice, next_state="IDLE")
+
+            # the CC map entry is read while the value arrives
             with m.State("CONTROL_CHANGE"):
-                m.next = "WAIT_END"
+                with m.If(midi_stream.valid):
+                    m.d.usb += message_index.eq(message_index + 1)
+                    with m.Switch(message_index):
+                        with m.Case(0):
+                            m.d.usb += cc_channel.eq(midi_stream.payload[0:4])
+                        with m.Case(1):
+                            m.d.usb += cc_map_read.addr.eq(Cat(midi_stream.payload[0:7], cc_channel))
+                        with m.Case(2):
+                            m.d.usb += cc_value.eq(midi_stream.payload[0:7])
+                            m.next = "CC_LOOKUP"
+                        with m.Default():
+                            m.next = "WAIT_END"
+                with m.Else():
+                    m.next = "WAIT_END"
+
+            with m.State("CC_LOOKUP"):
+                m.d.comb += midi_stream.ready.eq(0)
+                with m.If(entry_width == 0):
+                    # unmapped
+                    m.next = "IDLE"
+                with m.Else():
+                    m.next = "CC_SCALE"
+
+            # the curve ROM has read the value of the entry's curve
+            with m.State("CC_SCALE"):
+                m.d.comb += midi_stream.ready.eq(0)
+                m.d.usb += [
+                    cc_address.eq(entry_address),
+                    cc_data.eq(entry_base | scaled),
+                    cc_voice.eq(0),
+                ]
+                with m.If(entry_per_voice):
+                    m.next = "CC_VOICE"
+                with m.Else():
+                    m.next = "CC_WRITE"
+
+            with m.State("CC_WRITE"):
+                m.d.comb += midi_stream.ready.eq(0)
+                self.fifo_write(m, output_fifo, cc_address, cc_data, next_state="IDLE")
+
+            # write to the voices which play notes of the MIDI channel
+            with m.State("CC_VOICE"):
+                m.d.comb += midi_stream.ready.eq(0)
+                with m.If(voices.active.bit_select(cc_voice, 1) & (voices.voice_channel[cc_voice] == cc_channel)):
+                    self.fifo_write(m, output_fifo, cc_address + cc_voice, cc_data, next_state="CC_VOICE_NEXT")
+                with m.Else():
+                    m.d.usb += output_fifo.w_en.eq(0)
+                    m.next = "CC_VOICE_NEXT"
+
+            with m.State("CC_VOICE_NEXT"):
+                m.d.comb += midi_stream.ready.eq(0)
+                m.d.usb += [
+                    output_fifo.w_en.eq(0),
+                    cc_voice.eq(cc_voice + 1),
+                ]
+                with m.If(cc_voice == 7):
+                    m.next = "IDLE"
+                with m.Else():
+                    m.next = "CC_VOICE"
 
             with m.State("PROGRAM_CHANGE"):
-                m.next = "WAIT_END"
+                with m.If(midi_stream.valid):
+                    m.d.usb += message_index.eq(message_index + 1)
+                    with m.Switch(message_index):
+                        with m.Case(0):
+                            m.d.usb += program_channel.eq(midi_stream.payload[0:4])
+                        with m.Case(1):
+                            m.d.usb += [
+                                channel_program[program_channel].eq(midi_stream.payload[0:7]),
+                                patch_program.eq(midi_stream.payload[0:7]),
+                            ]
+                        with m.Case(2):
+                            # the padding byte of the USB MIDI event packet
+                            m.d.usb += patch_voice.eq(0)
+                            m.next = "PROGRAM_VOICE"
+                        with m.Default():
+                            m.next = "WAIT_END"
+                with m.Else():
+                    m.next = "WAIT_END"
+
+            # load the patch into the voices which play notes of the MIDI channel
+            with m.State("PROGRAM_VOICE"):
+                m.d.comb += midi_stream.ready.eq(0)
+                m.d.usb += output_fifo.w_en.eq(0)
+                with m.If(voices.active.bit_select(patch_voice, 1) &
+                          (voices.voice_channel[patch_voice] == program_channel)):
+                    m.d.usb += [
+                        patch_slot.eq(0),
+                        patch_for_note.eq(0),
+                    ]
+                    m.next = "PATCH_READ"
+                with m.Else():
+                    m.next = "PROGRAM_NEXT"
+
+            with m.State("PROGRAM_NEXT"):
+                m.d.comb += midi_stream.ready.eq(0)
+                m.d.usb += output_fifo.w_en.eq(0)
+                with m.If(patch_voice == 7):
+                    m.next = "IDLE"
+                with m.Else():
+                    m.d.usb += patch_voice.eq(patch_voice + 1)
+                    m.next = "PROGRAM_VOICE"
 
+            # burst the registers of patch_program into patch_voice,
+            # the patch store reads the register of patch_slot in this cycle
+            with m.State("PATCH_READ"):
+                m.d.comb += midi_stream.ready.eq(0)
+                m.d.usb += output_fifo.w_en.eq(0)
+                m.next = "PATCH_WRITE"
+
+            with m.State("PATCH_WRITE"):
+                m.d.comb += midi_stream.ready.eq(0)
+                with m.If(patch_slot == patch_size - 1):
+                    self.fifo_write(m, output_fifo, patch_register[patch_slot] + patch_voice, patch_data,
+                                    next_state="PATCH_DONE")
+                with m.Else():
+                    self.fifo_write(m, output_fifo, patch_register[patch_slot] + patch_voice, patch_data,
+                                    next_state="PATCH_READ")
+                with m.If(output_fifo.w_rdy):
+                    m.d.usb += patch_slot.eq(patch_slot + 1)
+
+            with m.State("PATCH_DONE"):
+                m.d.comb += midi_stream.ready.eq(0)
+                m.d.usb += [
+                    output_fifo.w_en.eq(0),
+                    voice_program[patch_voice].eq(patch_program),
+                    voice_patched.eq(voice_patched | (Const(1, 8) << patch_voice)),
+                ]
+                with m.If(patch_for_note):
+                    m.next = "NOTE_ON_KEY_CODE"
+                with m.Else():
+                    m.next = "PROGRAM_NEXT"
+
+            # only the bend of the channel is stored here,
+            # the voices are updated in the BEND_ states
             with m.State("PITCH_WHEEL"):
-                m.next = "WAIT_END"
+                with m.If(midi_stream.valid):
+                    m.d.usb += message_index.eq(message_index + 1)
+                    with m.Switch(message_index):
+                        with m.Case(0):
+                            m.d.usb += bend_channel.eq(midi_stream.payload[0:4])
+                        with m.Case(1):
+                            # the most significant bit of the LSB
+                            m.d.usb += bend_lsb.eq(midi_stream.payload[6])
+                        with m.Case(2):
+                            m.d.usb += bend_read.addr.eq(Cat(bend_lsb, midi_stream.payload[0:7]))
+                            m.next = "PITCH_WHEEL_READ"
+                        with m.Default():
+                            m.next = "WAIT_END"
+                with m.Else():
+                    m.next = "WAIT_END"
+
+            with m.State("PITCH_WHEEL_READ"):
+                m.d.comb += midi_stream.ready.eq(0)
+                m.next = "PITCH_WHEEL_STORE"
+
+            with m.State("PITCH_WHEEL_STORE"):
+                m.d.comb += midi_stream.ready.eq(0)
+                m.d.usb += [
+                    bend[bend_channel].eq(bend_read.data.as_signed()),
+                    bend_dirty.eq(bend_dirty | (Const(1, 16) << bend_channel)),
+                ]
+                m.next = "IDLE"
+
+            # write key code and key fraction of all voices on channels in bend_pass
+            with m.State("BEND_VOICE"):
+                m.d.comb += midi_stream.ready.eq(0)
+                m.d.usb += output_fifo.w_en.eq(0)
+                channel = voices.voice_channel[bend_voice]
+                with m.If(voices.active.bit_select(bend_voice, 1) & bend_pass.bit_select(channel, 1)):
+                    m.d.usb += [
+                        voices.note.eq(voices.voice_note[bend_voice]),
+                        voices.channel.eq(channel),
+                    ]
+                    m.next = "BEND_PITCH"
+                with m.Elif(bend_voice == 7):
+                    m.next = "IDLE"
+                with m.Else():
+                    m.d.usb += bend_voice.eq(bend_voice + 1)
+
+            # the key code ROM reads the new pitch
+            with m.State("BEND_PITCH"):
+                m.d.comb += midi_stream.ready.eq(0)
+                m.next = "BEND_KEY_CODE"
+
+            with m.State("BEND_KEY_CODE"):
+                m.d.comb += midi_stream.ready.eq(0)
+                self.fifo_write(m, output_fifo, Const(0x28, 8) + bend_voice, keycode_read.data,
+                                next_state="BEND_KEY_FRACTION")
+
+            with m.State("BEND_KEY_FRACTION"):
+                m.d.comb += midi_stream.ready.eq(0)
+                self.fifo_write(m, output_fifo, Const(0x30, 8) + bend_voice, key_fraction, next_state="BEND_NEXT")
+
+            with m.State("BEND_NEXT"):
+                m.d.comb += midi_stream.ready.eq(0)
+                m.d.usb += output_fifo.w_en.eq(0)
+                with m.If(bend_voice == 7):
+                    m.next = "IDLE"
+                with m.Else():
+                    m.d.usb += bend_voice.eq(bend_voice + 1)
+                    m.next = "BEND_VOICE"
 
             # use sysex to directly send address/data pairs to the JT51
             # first two sysex byte:    address: high nibble, low nibble
@@ -199,6 +704,37 @@ class MIDIController(Elaboratable):
                             m.next = "SYSEX"
                         with m.Case(1):
                             m.d.usb += address[4:8].eq(midi_stream.payload[0:4])
+                            if self.with_midi_in:
+                                # a readback request is a ping with another marker
+                                with m.If((midi_stream.payload == self.SYSEX_PING) |
+                                          (midi_stream.payload == self.SYSEX_READBACK)):
+                                    m.d.usb += [
+                                        packet_pos.eq(3),
+                                        readback.eq(midi_stream.payload == self.SYSEX_READBACK),
+                                    ]
+                                    m.next = "SYSEX_PING"
+                            with m.If(midi_stream.payload == self.SYSEX_CC_MAP):
+                                m.d.usb += [
+                                    packet_pos.eq(3),
+                                    cc_map_index.eq(0),
+                                ]
+                                m.next = "SYSEX_CC_MAP"
+                            with m.If(midi_stream.payload == self.SYSEX_PATCH):
+                                m.d.usb += packet_pos.eq(3)
+                                m.next = "SYSEX_PATCH"
+                            with m.If((midi_stream.payload == self.SYSEX_BULK) |
+                                      (midi_stream.payload == self.SYSEX_RUNS)):
+                                m.d.usb += [
+                                    # CIN, F0 and the bulk marker have been consumed,
+                                    # so the next byte is the last one of the first packet
+                                    packet_pos.eq(3),
+                                    group_index.eq(0),
+                                    data_phase.eq(0),
+                                    patch_upload.eq(0),
+                                    run_mode.eq(midi_stream.payload == self.SYSEX_RUNS),
+                                    run_phase.eq(0),
+                                ]
+                                m.next = "SYSEX_BULK"
                         with m.Case(2):
                             m.d.usb += address[0:4].eq(midi_stream.payload[0:4])
                         with m.Case(3):
@@ -217,12 +753,315 @@ class MIDIController(Elaboratable):
                         with m.Default():
                             m.next = "WAIT_END"
 
+            # bulk sysex: F0 7D <packed address/data pairs> F7
+            # The pairs are sent as a stream of address, data, address, data... bytes,
+            # packed into 7 bit MIDI data bytes in groups of up to 8 bytes:
+            # the first byte of a group holds the MSBs of the following 7 bytes,
+            # bit 0 for the first one. Each pair is written into the FIFO
+            # as soon as its data byte has been decoded.
+            # Address runs, see SYSEX_RUNS, are decoded here as well.
+            with m.State("SYSEX_BULK"):
+                m.d.usb += output_fifo.w_en.eq(0)
+                # the data bytes of a run can follow each other directly, so no byte
+                # is taken while a write is committed, which keeps w_rdy up to date
+                with m.If(output_fifo.w_en):
+                    m.d.comb += midi_stream.ready.eq(0)
+
+                with m.If(midi_stream.valid & midi_stream.ready):
+                    m.d.usb += packet_pos.eq(packet_pos + 1)
+
+                    # packet_pos 0 is the USB MIDI code index number, which we skip
+                    with m.If(packet_pos != 0):
+                        with m.If(midi_stream.payload[7]):
+                            # F7: end of sysex, skip the padding up to the end of the packet
+                            with m.If(packet_pos == 3):
+                                m.next = "IDLE"
+                            with m.Else():
+                                m.next = "SYSEX_BULK_END"
+
+                        with m.Elif(group_index == 0):
+                            m.d.usb += [
+                                msbs.eq(midi_stream.payload[0:7]),
+                                group_index.eq(1),
+                            ]
+
+                        with m.Else():
+                            decoded = Cat(midi_stream.payload[0:7], msbs.bit_select(group_index - 1, 1))
+                            m.d.usb += [
+                                group_index.eq(Mux(group_index == 7, 0, group_index + 1)),
+                                data_phase.eq(~data_phase),
+                            ]
+
+                            with m.If(patch_upload):
+                                # bytes beyond the end of the patch are dropped
+                                with m.If(upload_slot != patch_size):
+                                    m.d.comb += [
+                                        patch_write.addr.eq(Cat(upload_slot[1:], upload_program)),
+                                        patch_write.data.eq(Cat(decoded, decoded)),
+                                        patch_write.en.eq(Mux(upload_slot[0], 0b10, 0b01)),
+                                    ]
+                                    m.d.usb += upload_slot.eq(upload_slot + 1)
+                            with m.Elif(run_mode):
+                                with m.Switch(run_phase):
+                                    with m.Case(0):
+                                        m.d.usb += [
+                                            address.eq(decoded),
+                                            run_phase.eq(1),
+                                        ]
+                                    with m.Case(1):
+                                        m.d.usb += [
+                                            run_count.eq(decoded[0:7]),
+                                            run_step8.eq(decoded[7]),
+                                            run_phase.eq(Mux(decoded[0:7] == 0, 0, 2)),
+                                        ]
+                                    with m.Default():
+                                        m.d.usb += [
+                                            output_fifo.w_data.eq(Cat(decoded, address)),
+                                            output_fifo.w_en.eq(1),
+                                            address.eq(address + Mux(run_step8, 8, 1)),
+                                            run_count.eq(run_count - 1),
+                                        ]
+                                        with m.If(run_count == 1):
+                                            m.d.usb += run_phase.eq(0)
+                            with m.Elif(~data_phase):
+                                m.d.usb += address.eq(decoded)
+                            with m.Else():
+                                # midi_stream.ready follows output_fifo.w_rdy, so there
+                                # is always room in the FIFO for the registered write
+                                m.d.usb += [
+                                    output_fifo.w_data.eq(Cat(decoded, address)),
+                                    output_fifo.w_en.eq(1),
+                                ]
+
+            # F0 7A <program> | <packed patch> F7, see SYSEX_PATCH.
+            # The patch is decoded by SYSEX_BULK, into the patch store
+            with m.State("SYSEX_PATCH"):
+                with m.If(midi_stream.valid):
+                    m.d.usb += packet_pos.eq(packet_pos + 1)
+                    with m.If(midi_stream.payload[7]):
+                        m.next = "IDLE"
+                    with m.Else():
+                        m.d.usb += [
+                            upload_program.eq(midi_stream.payload[0:7]),
+                            upload_slot.eq(0),
+                            group_index.eq(0),
+                            patch_upload.eq(1),
+                            run_mode.eq(0),
+                            # voices playing the program load it again on their next note
+                            voice_patched.eq(voice_patched & ~Cat(voice_program[i] == midi_stream.payload[0:7]
+                                                                  for i in range(VoiceAllocator.VOICES))),
+                        ]
+                        m.next = "SYSEX_BULK"
+
+            # F0 7B <10 data bytes> F7, see SYSEX_CC_MAP
+            with m.State("SYSEX_CC_MAP"):
+                with m.If(midi_stream.valid):
+                    m.d.usb += packet_pos.eq(packet_pos + 1)
+                    # packet_pos 0 is the USB MIDI code index number, which we skip
+                    with m.If(packet_pos != 0):
+                        with m.If(midi_stream.payload[7]):
+                            # F7: store the entry if it was complete
+                            with m.If(cc_map_index == 10):
+                                m.d.comb += cc_map_write.en.eq(1)
+                            with m.If(packet_pos == 3):
+                                m.next = "IDLE"
+                            with m.Else():
+                                m.next = "SYSEX_BULK_END"
+                        with m.Elif(cc_map_index == 10):
+                            m.next = "WAIT_END"
+                        with m.Else():
+                            m.d.usb += [
+                                cc_map_bytes[cc_map_index].eq(midi_stream.payload[0:7]),
+                                cc_map_index.eq(cc_map_index + 1),
+                            ]
+
+            # skips the padding up to the end of the last sysex packet
+            with m.State("SYSEX_BULK_END"):
+                m.d.usb += output_fifo.w_en.eq(0)
+                with m.If(midi_stream.valid):
+                    m.d.usb += packet_pos.eq(packet_pos + 1)
+                    with m.If(packet_pos == 3):
+                        m.next = "IDLE"
+
+            if self.with_midi_in:
+                # F0 7C <tag high> | <tag low> F7 00
+                with m.State("SYSEX_PING"):
+                    with m.If(midi_stream.valid):
+                        m.d.usb += packet_pos.eq(packet_pos + 1)
+                        with m.Switch(packet_pos):
+                            with m.Case(3):
+                                m.d.usb += ping_tag[7:14].eq(midi_stream.payload[0:7])
+                            with m.Case(1):
+                                m.d.usb += ping_tag[0:7].eq(midi_stream.payload[0:7])
+                            with m.Case(2):
+                                with m.If(midi_stream.payload == 0xf7):
+                                    m.next = "SYSEX_PING_END"
+                                with m.Else():
+                                    m.next = "WAIT_END"
+
+                # skip the padding byte of the last packet
+                with m.State("SYSEX_PING_END"):
+                    with m.If(midi_stream.valid):
+                        m.next = "SYSEX_PING_QUEUE"
+
+                with m.State("SYSEX_PING_QUEUE"):
+                    m.d.comb += midi_stream.ready.eq(0)
+                    with m.If(readback):
+                        with m.If(self._readback_pending):
+                            m.next = "IDLE"
+                        with m.Elif(output_fifo.w_rdy):
+                            m.d.usb += [
+                                output_fifo.w_data.eq(Cat(ping_tag, Const(1, 1), Const(0, 1), Const(1, 1))),
+                                output_fifo.w_en.eq(1),
+                                self._readback_pending.eq(1),
+                                self._readback_tag.eq(ping_tag),
+                            ]
+                            m.next = "IDLE"
+                    with m.Elif(output_fifo.w_rdy):
+                        m.d.usb += [
+                            output_fifo.w_data.eq(Cat(ping_tag, Const(0, 2), Const(1, 1))),
+                            output_fifo.w_en.eq(1),
+                            self._queued_echo.eq(1),
+                            self._queued_tag.eq(ping_tag),
+                        ]
+                        m.next = "IDLE"
+
             with m.State("WAIT_END"):
                 with m.If(~midi_stream.valid):
                     m.next = "IDLE"
 
         return m
 
+    def elaborate_ping_echo(self, m):
+        """ sends the ping replies to midi_out """
+        # a ping queued while the previous echo is still pending replaces it,
+        # so the parser never stalls when the host does not read MIDI IN
+        self._queued_echo = Signal()
+        self._queued_tag  = Signal(14)
+
+        done_fifo = AsyncFIFO(width=14, depth=16, w_domain="jt51", r_domain="usb")
+        m.submodules.ping_done_fifo = done_fifo
+        m.d.comb += [
+            done_fifo.w_data.eq(self.ping_done_tag),
+            done_fifo.w_en.eq(self.ping_done),
+        ]
+
+        stage = Signal(7)
+        tag   = Signal(14)
+        reply = Array([
+            # code index 4: sysex starts, code index 7: sysex ends with 3 bytes
+            Const(0x04, 8), Const(0xf0, 8), Const(self.SYSEX_PING, 8), stage,
+            Const(0x07, 8), tag[7:14],      tag[0:7],                   Const(0xf7, 8),
+        ])
+        reply_index = Signal(3)
+        midi_out = self.midi_out
+
+        # the reply to a readback request, in USB MIDI event packets
+        self._readback_pending = Signal()
+        self._readback_tag     = Signal(14)
+        mirror_fifo = AsyncFIFO(width=9, depth=512, w_domain="jt51", r_domain="usb")
+        m.submodules.mirror_fifo = mirror_fifo
+        m.d.comb += [
+            mirror_fifo.w_data.eq(self.mirror.payload),
+            mirror_fifo.w_en.eq(self.mirror.valid),
+            self.mirror.ready.eq(mirror_fifo.w_rdy),
+        ]
+
+        # sysex bytes of the reply, and where its last packet starts
+        readback_length = 4 + 2 * Jt51Streamer.MIRROR_SLOTS + 1
+        last_packet     = (readback_length - 1) // 3 * 3
+        # position in the reply, counting the padding of the last packet
+        readback_pos    = Signal(range(last_packet + 3))
+        packet_byte     = Signal(2)
+        readback_byte   = Signal(8)
+        readback_valid  = Signal()
+        slot = mirror_fifo.r_data
+        with m.If(packet_byte == 0):
+            # code index 4: sysex starts or continues, 5, 6, 7: sysex ends with 1, 2 or 3 bytes
+            m.d.comb += [
+                readback_byte.eq(Mux(readback_pos == last_packet, 4 + readback_length - last_packet, 0x04)),
+                readback_valid.eq(1),
+            ]
+        with m.Elif(readback_pos >= readback_length):
+            m.d.comb += readback_valid.eq(1)
+        with m.Else():
+            m.d.comb += readback_valid.eq(1)
+            with m.Switch(readback_pos):
+                with m.Case(0):
+                    m.d.comb += readback_byte.eq(0xf0)
+                with m.Case(1):
+                    m.d.comb += readback_byte.eq(self.SYSEX_READBACK)
+                with m.Case(2):
+                    m.d.comb += readback_byte.eq(self._readback_tag[7:14])
+                with m.Case(3):
+                    m.d.comb += readback_byte.eq(self._readback_tag[0:7])
+                with m.Case(readback_length - 1):
+                    m.d.comb += readback_byte.eq(0xf7)
+                with m.Default():
+                    # the slots start at an even position, high nibble first
+                    m.d.comb += [
+                        readback_byte.eq(Mux(readback_pos[0], slot[0:4], slot[4:9])),
+                        readback_valid.eq(mirror_fifo.r_rdy),
+                    ]
+        readback_done = (packet_byte == 3) & (readback_pos >= last_packet)
+
+        # this comes before the MIDI parser, whose update of _queued_echo
+        # then takes precedence in the cycle in which both change it
+        with m.FSM(domain="usb", name="ping_echo_fsm"):
+            with m.State("IDLE"):
+                m.d.usb += [
+                    reply_index.eq(0),
+                    readback_pos.eq(0),
+                    packet_byte.eq(0),
+                ]
+                with m.If(self._queued_echo):
+                    m.d.usb += [
+                        stage.eq(self.PING_QUEUED),
+                        tag.eq(self._queued_tag),
+                        self._queued_echo.eq(0),
+                    ]
+                    m.next = "REPLY"
+                with m.Elif(done_fifo.r_rdy):
+                    m.d.comb += done_fifo.r_en.eq(1)
+                    m.d.usb += [
+                        stage.eq(self.PING_DONE),
+                        tag.eq(done_fifo.r_data),
+                    ]
+                    m.next = "REPLY"
+                with m.Elif(mirror_fifo.r_rdy):
+                    m.next = "READBACK"
+
+            with m.State("REPLY"):
+                m.d.comb += [
+                    midi_out.valid.eq(1),
+                    midi_out.payload.eq(reply[reply_index]),
+                    midi_out.first.eq(reply_index == 0),
+                    midi_out.last.eq(reply_index == 7),
+                ]
+                with m.If(midi_out.ready):
+                    m.d.usb += reply_index.eq(reply_index + 1)
+                    with m.If(reply_index == 7):
+                        m.next = "IDLE"
+
+            with m.State("READBACK"):
+                m.d.comb += [
+                    midi_out.valid.eq(readback_valid),
+                    midi_out.payload.eq(readback_byte),
+                    midi_out.first.eq((packet_byte == 0) & (readback_pos == 0)),
+                    midi_out.last.eq(readback_done),
+                ]
+                with m.If(midi_out.ready & readback_valid):
+                    m.d.usb += packet_byte.eq(packet_byte + 1)
+                    with m.If(packet_byte != 0):
+                        m.d.usb += readback_pos.eq(readback_pos + 1)
+                    # the low nibble is the second byte of a slot
+                    with m.If((packet_byte != 0) & (readback_pos >= 4) &
+                              (readback_pos < readback_length - 1) & readback_pos[0]):
+                        m.d.comb += mirror_fifo.r_en.eq(1)
+                    with m.If(readback_done):
+                        m.d.usb += self._readback_pending.eq(0)
+                        m.next = "IDLE"
+
 
 if __name__ == "__main__":
     m = MIDIController()
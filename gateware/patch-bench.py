@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+from midicontroller import MIDIController, PATCH_REGISTERS, keycode_table
+from amaranth.sim import Simulator, Tick, Settle, Passive
+
+if __name__ == "__main__":
+    dut = MIDIController()
+    payload = dut.midi_stream.payload
+    valid   = dut.midi_stream.valid
+    ready   = dut.midi_stream.ready
+    keycode = keycode_table()
+
+    # register writes which arrive at the JT51 side of the output FIFO
+    writes = []
+
+    def send_packet(*packet, wait=200):
+        """ sends 4 byte USB MIDI event packets, honouring ready """
+        yield valid.eq(1)
+        for byte in packet:
+            yield payload.eq(byte)
+            yield Settle()
+            while not (yield ready):
+                yield Tick("usb")
+                yield Settle()
+            yield Tick("usb")
+        yield valid.eq(0)
+        yield payload.eq(0)
+        for _ in range(wait):
+            yield Tick("usb")
+
+    def usb_midi_sysex(message):
+        # split a sysex message into 4 byte USB MIDI event packets
+        packets = []
+        for i in range(0, len(message), 3):
+            chunk = message[i:i + 3]
+            cin = 0x4 + len(chunk) if chunk[-1] == 0xf7 else 0x4
+            packets += [cin] + chunk + [0] * (3 - len(chunk))
+        return packets
+
+    def pack_7bit(data):
+        result = []
+        for i in range(0, len(data), 7):
+            group = data[i:i + 7]
+            result.append(sum(((byte >> 7) & 1) << n for n, byte in enumerate(group)))
+            result += [byte & 0x7f for byte in group]
+        return result
+
+    def upload_patch(program, patch):
+        message = [0xf0, MIDIController.SYSEX_PATCH, program] + pack_7bit(patch) + [0xf7]
+        yield from send_packet(*usb_midi_sysex(message))
+
+    def burst(voice, patch):
+        return [(address + voice, data) for address, data in zip(PATCH_REGISTERS, patch)]
+
+    def note_on(voice, note):
+        return [(0x08, voice), (0x28 + voice, keycode[note]), (0x30 + voice, 0), (0x08, 0x78 | voice)]
+
+    def take_writes():
+        result = list(writes)
+        writes.clear()
+        return result
+
+    def usb_process():
+        for _ in range(2**10 + 300):
+            yield Tick("usb")
+        writes.clear()
+
+        # the voices start out with the patch of the initialization, which is program 0
+        yield from send_packet(0x09, 0x90, 69, 100)
+        assert take_writes() == note_on(0, 69)
+
+        # uploads go to the patch store only, values with the MSB set check the unpacking
+        brass = [0x80 | i for i in range(len(PATCH_REGISTERS))]
+        yield from upload_patch(5, brass)
+        assert take_writes() == []
+
+        # program change loads the patch into the voice playing the channel
+        yield from send_packet(0x0c, 0xc0, 5, 0)
+        assert take_writes() == burst(0, brass)
+
+        # new notes of the channel load it into their voice after the key off
+        yield from send_packet(0x09, 0x90, 72, 100)
+        assert take_writes() == note_on(1, 72)[:1] + burst(1, brass) + note_on(1, 72)[1:]
+        # but only once
+        yield from send_packet(0x09, 0x90, 69, 100)
+        assert take_writes() == note_on(0, 69)
+
+        # other channels keep their program
+        yield from send_packet(0x09, 0x91, 60, 100)
+        assert take_writes() == note_on(2, 60)
+
+        # an upload of a program in use reloads it with the next note
+        strings = [i for i in range(len(PATCH_REGISTERS))]
+        yield from upload_patch(5, strings)
+        yield from send_packet(0x09, 0x90, 69, 100)
+        assert take_writes() == note_on(0, 69)[:1] + burst(0, strings) + note_on(0, 69)[1:]
+        print("patch store: all checks passed")
+
+    def jt51_process():
+        yield Passive()
+        yield dut.jt51_stream.ready.eq(1)
+        while True:
+            yield Tick("jt51")
+            if (yield dut.jt51_stream.valid):
+                entry = yield dut.jt51_stream.payload
+                writes.append(((entry >> 8) & 0xff, entry & 0xff))
+
+    sim = Simulator(dut)
+    sim.add_clock(1.0/60e6, domain="usb")
+    sim.add_clock(1.0/30e6, domain="jt51")
+    sim.add_sync_process(usb_process, domain="usb")
+    sim.add_sync_process(jt51_process, domain="jt51")
+
+    with sim.write_vcd(f'patch.vcd'):
+        sim.run()
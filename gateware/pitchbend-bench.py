@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+from midicontroller import MIDIController, keycode_table
+from amaranth.sim import Simulator, Tick, Settle, Passive
+
+if __name__ == "__main__":
+    # a short update interval keeps the simulation fast
+    dut = MIDIController(bend_interval=2000)
+    payload = dut.midi_stream.payload
+    valid   = dut.midi_stream.valid
+    ready   = dut.midi_stream.ready
+    keycode = keycode_table()
+
+    # register writes which arrive at the JT51 side of the output FIFO
+    writes = []
+
+    def send_packet(*packet, wait=32):
+        """ sends one 4 byte USB MIDI event packet, honouring ready """
+        yield valid.eq(1)
+        for byte in packet:
+            yield payload.eq(byte)
+            yield Settle()
+            while not (yield ready):
+                yield Tick("usb")
+                yield Settle()
+            yield Tick("usb")
+        yield valid.eq(0)
+        yield payload.eq(0)
+        for _ in range(wait):
+            yield Tick("usb")
+
+    def pitch_bend(channel, value, wait=32):
+        yield from send_packet(0x0e, 0xe0 | channel, value & 0x7f, value >> 7, wait=wait)
+
+    def take_writes():
+        result = list(writes)
+        writes.clear()
+        return result
+
+    def usb_process():
+        for _ in range(2**10 + 300):
+            yield Tick("usb")
+        writes.clear()
+
+        # A4 and C5 on channel 0 get voices 0 and 1, C4 on channel 1 gets voice 2
+        yield from send_packet(0x09, 0x90, 69, 100)
+        yield from send_packet(0x09, 0x90, 72, 100)
+        yield from send_packet(0x09, 0x91, 60, 100)
+        assert take_writes() == [
+            (0x08, 0), (0x28, keycode[69]), (0x30, 0), (0x08, 0x78),
+            (0x08, 1), (0x29, keycode[72]), (0x31, 0), (0x08, 0x79),
+            (0x08, 2), (0x2a, keycode[60]), (0x32, 0), (0x08, 0x7a),
+        ]
+
+        # a fast sweep of 21 bends results in one update right away
+        # and one after the rate limit interval, of the channel 0 voices only
+        for value in range(8192, 16384, 400):
+            yield from pitch_bend(0, value, wait=4)
+        for _ in range(3000):
+            yield Tick("usb")
+        # 16192 is 125/128 of the upper bend range of 2 semitones, which is
+        # 1 semitone and 61/64 above the note
+        assert take_writes() == [
+            (0x28, keycode[69]), (0x30, 0), (0x29, keycode[72]), (0x31, 0),
+            (0x28, keycode[70]), (0x30, 61 << 2), (0x29, keycode[73]), (0x31, 61 << 2),
+        ]
+
+        # full bend down is 2 semitones
+        yield from pitch_bend(0, 0)
+        for _ in range(3000):
+            yield Tick("usb")
+        assert take_writes() == [(0x28, keycode[67]), (0x30, 0), (0x29, keycode[70]), (0x31, 0)]
+
+        # new notes start with the bend of their channel
+        yield from send_packet(0x09, 0x90, 76, 100)
+        assert take_writes() == [(0x08, 3), (0x2b, keycode[74]), (0x33, 0), (0x08, 0x7b)]
+        print("pitch bend: all checks passed")
+
+    def jt51_process():
+        yield Passive()
+        yield dut.jt51_stream.ready.eq(1)
+        while True:
+            yield Tick("jt51")
+            if (yield dut.jt51_stream.valid):
+                entry = yield dut.jt51_stream.payload
+                writes.append(((entry >> 8) & 0xff, entry & 0xff))
+
+    sim = Simulator(dut)
+    sim.add_clock(1.0/60e6, domain="usb")
+    sim.add_clock(1.0/30e6, domain="jt51")
+    sim.add_sync_process(usb_process, domain="usb")
+    sim.add_sync_process(jt51_process, domain="jt51")
+
+    with sim.write_vcd(f'pitchbend.vcd'):
+        sim.run()
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+from amaranth import Module, Signal
+from amaranth.sim import Simulator, Tick, Settle, Passive
+from midicontroller import MIDIController
+from jt51 import Jt51Streamer
+
+class ChipBus:
+    """ the bus interface of the JT51, which is never busy here """
+    def __init__(self):
+        self.wr_n = Signal(reset=1)
+        self.a0   = Signal()
+        self.din  = Signal(8)
+        self.dout = Signal(8)
+
+def slot(address, data):
+    if address == 0x19 and data & 0x80:
+        return Jt51Streamer.PMD_SLOT
+    if address == 0x08:
+        return Jt51Streamer.KEY_ON_SLOT | data & 0x7
+    return address
+
+if __name__ == "__main__":
+    chip       = ChipBus()
+    controller = MIDIController(with_midi_in=True)
+    streamer   = Jt51Streamer(chip)
+    m = Module()
+    m.submodules.controller = controller
+    m.submodules.streamer   = streamer
+    m.d.comb += [
+        streamer.input_stream.payload.eq(controller.jt51_stream.payload),
+        streamer.input_stream.valid.eq(controller.jt51_stream.valid),
+        controller.jt51_stream.ready.eq(streamer.input_stream.ready),
+        controller.mirror.payload.eq(streamer.mirror.payload),
+        controller.mirror.valid.eq(streamer.mirror.valid),
+        streamer.mirror.ready.eq(controller.mirror.ready),
+        controller.ping_done.eq(streamer.ping_done),
+        controller.ping_done_tag.eq(streamer.ping_done_tag),
+    ]
+
+    payload = controller.midi_stream.payload
+    valid   = controller.midi_stream.valid
+    ready   = controller.midi_stream.ready
+
+    # register writes as seen by the chip, and the bytes sent to the host
+    writes   = []
+    midi_out = []
+
+    def send_packet(*packet, wait=200):
+        """ sends 4 byte USB MIDI event packets, honouring ready """
+        yield valid.eq(1)
+        for byte in packet:
+            yield payload.eq(byte)
+            yield Settle()
+            while not (yield ready):
+                yield Tick("usb")
+                yield Settle()
+            yield Tick("usb")
+        yield valid.eq(0)
+        yield payload.eq(0)
+        for _ in range(wait):
+            yield Tick("usb")
+
+    def usb_midi_sysex(message):
+        # split a sysex message into 4 byte USB MIDI event packets
+        packets = []
+        for i in range(0, len(message), 3):
+            chunk = message[i:i + 3]
+            cin = 0x4 + len(chunk) if chunk[-1] == 0xf7 else 0x4
+            packets += [cin] + chunk + [0] * (3 - len(chunk))
+        return packets
+
+    def pack_7bit(data):
+        result = []
+        for i in range(0, len(data), 7):
+            group = data[i:i + 7]
+            result.append(sum(((byte >> 7) & 1) << n for n, byte in enumerate(group)))
+            result += [byte & 0x7f for byte in group]
+        return result
+
+    def sysex_messages(packets):
+        """ the sysex messages of USB MIDI event packets """
+        messages, message = [], []
+        for i in range(0, len(packets), 4):
+            cin = packets[i] & 0xf
+            message += packets[i + 1:i + 1 + {0x4: 3, 0x5: 1, 0x6: 2, 0x7: 3}[cin]]
+            if cin != 0x4:
+                messages.append(message)
+                message = []
+        return messages
+
+    def readback(tag):
+        midi_out.clear()
+        yield from send_packet(*usb_midi_sysex([0xf0, MIDIController.SYSEX_READBACK, tag >> 7, tag & 0x7f, 0xf7]),
+                               wait=20000)
+        [message] = sysex_messages(midi_out)
+        assert message[:4] == [0xf0, MIDIController.SYSEX_READBACK, tag >> 7, tag & 0x7f], message[:4]
+        assert message[-1] == 0xf7 and len(message) == 5 + 2 * Jt51Streamer.MIRROR_SLOTS
+        slots = message[4:-1]
+        return [((high & 0xf) << 4 | low) if high & 0x10 else None for high, low in zip(slots[0::2], slots[1::2])]
+
+    def expected_mirror():
+        mirror = [None] * Jt51Streamer.MIRROR_SLOTS
+        for address, data in writes:
+            mirror[slot(address, data)] = data
+        return mirror
+
+    def usb_process():
+        yield controller.midi_out.ready.eq(1)
+        for _ in range(2**10 + 300):
+            yield Tick("usb")
+
+        # the initialization writes are in the mirror
+        mirror = yield from readback(0x1234)
+        assert mirror == expected_mirror(), mirror
+        assert mirror[0x20] == 0xfa and mirror[0x60] == 0x1f and mirror[0x10] is None
+
+        # AM and PM depth, and the key on state of a channel, each have their own slot
+        pairs = [0x19, 0x20, 0x19, 0x85, 0x18, 0xc3]
+        yield from send_packet(*usb_midi_sysex([0xf0, MIDIController.SYSEX_BULK] + pack_7bit(pairs) + [0xf7]))
+        yield from send_packet(0x09, 0x90, 69, 100)
+        mirror = yield from readback(5)
+        assert mirror == expected_mirror(), mirror
+        assert mirror[0x19] == 0x20 and mirror[Jt51Streamer.PMD_SLOT] == 0x85 and mirror[0x18] == 0xc3
+        assert mirror[Jt51Streamer.KEY_ON_SLOT] == 0x78
+
+        # address runs, with a step of 1 and a step of 8
+        data = [(i * 37) & 0xff for i in range(25)]
+        runs = [0x28, 3, 0x3a, 0x3b, 0x3c, 0x38, 0x80 | len(data)] + data
+        written = len(writes)
+        yield from send_packet(*usb_midi_sysex([0xf0, MIDIController.SYSEX_RUNS] + pack_7bit(runs) + [0xf7]),
+                               wait=4000)
+        assert writes[written:] == [(0x28, 0x3a), (0x29, 0x3b), (0x2a, 0x3c)] + \
+                                   [(0x38 + 8 * i, d) for i, d in enumerate(data)], writes[written:]
+        print("readback: all checks passed")
+
+    def midi_out_process():
+        yield Passive()
+        while True:
+            yield Tick("usb")
+            if (yield controller.midi_out.valid) and (yield controller.midi_out.ready):
+                midi_out.append((yield controller.midi_out.payload))
+
+    def chip_process():
+        yield Passive()
+        address = None
+        while True:
+            yield Tick("jt51")
+            if not (yield chip.wr_n):
+                if (yield chip.a0):
+                    writes.append((address, (yield chip.din)))
+                else:
+                    address = yield chip.din
+
+    sim = Simulator(m)
+    sim.add_clock(1.0/60e6, domain="usb")
+    sim.add_clock(1.0/3.584e6, domain="jt51")
+    sim.add_sync_process(usb_process, domain="usb")
+    sim.add_sync_process(midi_out_process, domain="usb")
+    sim.add_sync_process(chip_process, domain="jt51")
+
+    with sim.write_vcd(f'readback.vcd'):
+        sim.run()
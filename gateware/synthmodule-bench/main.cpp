@@ -1,4 +1,9 @@
 #include <verilated.h>
+#include <cstdio>
+#include <cstring>
+#include <vector>
+#include <chrono>
+#include <algorithm>
 #include <iostream>
 #include "Vsynthmodule.h"
 #include "verilated_fst_c.h"
@@ -14,38 +19,267 @@ const int usb_period  = 16,
           adat_period = 81,     // ADAT clock = 256 bit * 48kHz sample rate
           jt51_period = 279;    // 64 JT51 clock = 1 sample @ 56kHz
 
+// one time unit is a nanosecond
+const vluint64_t time_units_per_second = 1000000000;
+// keep simulating a bit after the last write, for the release of the notes
+const vluint64_t tail_time = time_units_per_second / 10;
+
 double sc_time_stamp() {        // Called by $time in Verilog
     return main_time;           // converts to double, to match
                                 // what SystemC does
 }
 
-bool send_midi(uint32_t num_cycles, const uint8_t *msg, vluint64_t time)
-{
-    vluint64_t first_msg_time = num_cycles * usb_period;
-    if (time < first_msg_time || time >= first_msg_time + 5 * usb_period) return false;
-    if (time == first_msg_time) {
-        top->payload = msg[0] >> 4;
-        top->valid = 1;
-        return true;
-    } else if (time == first_msg_time + 1 * usb_period) {
-        top->payload = msg[0];
-        return true;
-    } else if (time == first_msg_time + 2 * usb_period) {
-        top->payload = msg[1];
-        return true;
-    } else if (time == first_msg_time + 3 * usb_period) {
-        top->payload = msg[2];
+//
+// MIDI stream stimulus, as written by software/vgm-2151/vgm_stimulus.py
+//
+struct StimulusRecord {
+    vluint64_t           time;  // when the bytes are due, in simulation time units
+    std::vector<uint8_t> bytes; // USB MIDI event packets
+};
+
+struct Stimulus {
+    std::vector<StimulusRecord> records;
+    vluint64_t end_time = 0;
+
+    // position of the next byte to send
+    size_t record = 0;
+    size_t offset = 0;
+
+    bool load(const char *path) {
+        FILE *f = fopen(path, "rb");
+        if (!f) return false;
+
+        char     magic[4];
+        uint32_t sample_rate, total_samples;
+        if (fread(magic, 1, 4, f) != 4 || memcmp(magic, "VGMS", 4) != 0 ||
+            fread(&sample_rate, 4, 1, f) != 1 || fread(&total_samples, 4, 1, f) != 1) {
+            fclose(f);
+            return false;
+        }
+        end_time = to_time(total_samples, sample_rate);
+
+        uint32_t samples;
+        uint16_t length;
+        while (fread(&samples, 4, 1, f) == 1 && fread(&length, 2, 1, f) == 1) {
+            StimulusRecord r;
+            r.time = to_time(samples, sample_rate);
+            r.bytes.resize(length);
+            if (fread(r.bytes.data(), 1, length, f) != length) break;
+            records.push_back(std::move(r));
+        }
+        fclose(f);
         return true;
-    } else if (time == first_msg_time + 4 * usb_period) {
-        top->payload = 0;
-        top->valid = 0;
+    }
+
+    static vluint64_t to_time(uint32_t samples, uint32_t sample_rate) {
+        return vluint64_t(samples) * time_units_per_second / sample_rate;
+    }
+
+    bool done() const { return record >= records.size(); }
+
+    // the next byte, if it is due at time
+    bool next(vluint64_t time, uint8_t &byte) const {
+        if (done() || records[record].time > time) return false;
+        byte = records[record].bytes[offset];
         return true;
     }
-    return false;
-}
 
-const uint8_t note_on[3]  = { 0x93, 0x70 /* 69 */, 0x7f },
-              note_off[3] = { 0x83, 0x70 /* 69 */, 0x00 };
+    void advance() {
+        if (++offset >= records[record].bytes.size()) {
+            offset = 0;
+            record++;
+        }
+    }
+};
+
+// drives the midi_stream inputs with the stimulus bytes, one per USB clock cycle.
+// Called around every rising USB clock edge.
+struct MIDIStreamDriver {
+    Stimulus &stimulus;
+    MIDIStreamDriver(Stimulus &s) : stimulus(s) {}
+
+    void before_edge() {
+        // the byte on the bus is taken with this edge if MIDIController is ready
+        if (top->valid && top->ready) stimulus.advance();
+    }
+
+    void after_edge(vluint64_t time) {
+        uint8_t byte;
+        if (stimulus.next(time, byte)) {
+            top->payload = byte;
+            top->valid   = 1;
+        } else {
+            top->payload = 0;
+            top->valid   = 0;
+        }
+    }
+};
+
+//
+// ADAT decoder for the adat_out port, sampled once per ADAT clock cycle.
+// A frame is the sync pattern (ten 0s and a 1), four user bits and a 1,
+// and 8 channels of 24 bits, with a 1 after every nibble. Ones are
+// NRZI encoded as level changes.
+//
+struct ADATDecoder {
+    static const int channels       = 8;
+    static const int bits_per_frame = 5 + channels * 30;
+
+    uint8_t    last_level = 0;
+    int        zeros      = 0;
+    int        position   = -1;    // bit position in the frame after the sync, -1 = not in sync
+    uint32_t   word       = 0;
+    int32_t    samples[channels];
+    vluint64_t frames     = 0;
+    vluint64_t errors     = 0;
+
+    // returns true when a frame is complete
+    bool feed(uint8_t level) {
+        int bit = level != last_level;
+        last_level = level;
+
+        if (bit == 0) {
+            zeros++;
+        } else {
+            bool sync = zeros >= 10;
+            zeros = 0;
+            if (sync) {
+                // end of the sync pattern, the frame data starts with the next bit
+                position = 0;
+                word = 0;
+                return false;
+            }
+        }
+
+        if (position < 0 || position >= bits_per_frame) return false;
+
+        int p = position++;
+        if (p < 5) {
+            // user bits and their separator
+            if (p == 4 && bit != 1) lose_sync();
+            return false;
+        }
+
+        int channel = (p - 5) / 30;
+        int in_channel = (p - 5) % 30;
+        if (in_channel % 5 == 4) {
+            // nibble separator
+            if (bit != 1) { lose_sync(); return false; }
+            if (in_channel == 29) {
+                // sign extend the 24 bit sample
+                samples[channel] = int32_t(word << 8) >> 8;
+                word = 0;
+                if (channel == channels - 1) {
+                    frames++;
+                    return true;
+                }
+            }
+        } else {
+            word = (word << 1) | bit;
+        }
+        return false;
+    }
+
+    void lose_sync() {
+        errors++;
+        position = -1;
+        word = 0;
+    }
+};
+
+//
+// 16 bit stereo WAV writer
+//
+struct WAVWriter {
+    FILE    *f = nullptr;
+    uint32_t frames = 0;
+    uint32_t sample_rate;
+
+    WAVWriter(const char *path, uint32_t rate) : sample_rate(rate) {
+        f = fopen(path, "wb");
+        if (f) write_header();
+    }
+
+    void write_u32(uint32_t v) { fwrite(&v, 4, 1, f); }
+    void write_u16(uint16_t v) { fwrite(&v, 2, 1, f); }
+
+    void write_header() {
+        fwrite("RIFF", 1, 4, f); write_u32(36 + frames * 4);
+        fwrite("WAVE", 1, 4, f);
+        fwrite("fmt ", 1, 4, f); write_u32(16);
+        write_u16(1);                   // PCM
+        write_u16(2);                   // stereo
+        write_u32(sample_rate);
+        write_u32(sample_rate * 4);     // bytes per second
+        write_u16(4);                   // bytes per frame
+        write_u16(16);                  // bits per sample
+        fwrite("data", 1, 4, f); write_u32(frames * 4);
+    }
+
+    void write(int16_t left, int16_t right) {
+        fwrite(&left,  2, 1, f);
+        fwrite(&right, 2, 1, f);
+        frames++;
+    }
+
+    void close() {
+        if (!f) return;
+        fseek(f, 0, SEEK_SET);
+        write_header();
+        fclose(f);
+        f = nullptr;
+    }
+};
+
+// a free running clock, rising at multiples of the period
+struct Clock {
+    vluint64_t period;
+    vluint64_t rise = 0;        // time of the current or next rising edge
+    bool       high = false;
+
+    Clock(vluint64_t p) : period(p) {}
+
+    vluint64_t next() const { return high ? rise + period / 2 : rise; }
+
+    // returns the new level
+    bool toggle() {
+        if (high) rise += period;
+        high = !high;
+        return high;
+    }
+};
+
+// the FST trace is written for the simulation times [start, end)
+struct TraceWindow {
+    vluint64_t start = 0;
+    vluint64_t end   = ~vluint64_t(0);
+
+    // +trace traces everything, +trace_start=<seconds> and +trace_end=<seconds>
+    // limit the trace to a window, both enable tracing
+    bool parse() {
+        bool enabled = false;
+        double seconds;
+        const char *arg = Verilated::commandArgsPlusMatch("trace_start=");
+        if (arg[0] && sscanf(arg, "+trace_start=%lf", &seconds) == 1) {
+            start = vluint64_t(seconds * time_units_per_second);
+            enabled = true;
+        }
+        arg = Verilated::commandArgsPlusMatch("trace_end=");
+        if (arg[0] && sscanf(arg, "+trace_end=%lf", &seconds) == 1) {
+            end = vluint64_t(seconds * time_units_per_second);
+            enabled = true;
+        }
+        return enabled || strcmp(Verilated::commandArgsPlusMatch("trace"), "+trace") == 0;
+    }
+
+    bool contains(vluint64_t time) const { return time >= start && time < end; }
+};
+
+double wall_seconds()
+{
+    using namespace std::chrono;
+    return duration<double>(steady_clock::now().time_since_epoch()).count();
+}
 
 bool completed_changed(uint8_t completed)
 {
@@ -60,15 +294,38 @@ bool completed_changed(uint8_t completed)
 int main(int argc, char** argv) {
     Verilated::commandArgs(argc, argv);
 
+    if (argc < 3 || argv[1][0] == '+' || argv[2][0] == '+') {
+        fprintf(stderr, "usage: %s stimulus.bin output.wav [+trace | +trace_start=<s> +trace_end=<s>]\n"
+                        "       stimulus.bin is made by software/vgm-2151/vgm_stimulus.py\n", argv[0]);
+        return 1;
+    }
+
+    Stimulus stimulus;
+    if (!stimulus.load(argv[1])) {
+        fprintf(stderr, "could not read the stimulus file %s\n", argv[1]);
+        return 1;
+    }
+    MIDIStreamDriver midi(stimulus);
+    ADATDecoder      adat;
+    WAVWriter        wav(argv[2], 48000);
+    if (!wav.f) {
+        fprintf(stderr, "could not open %s\n", argv[2]);
+        return 1;
+    }
+
     top = new Vsynthmodule;
 
-    Verilated::traceEverOn(true);
-    VL_PRINTF("Enabling waves...\n");
-    VerilatedFstC* tfp = new VerilatedFstC;
-    top->trace (tfp, 99);	// Trace 99 levels of hierarchy
-    tfp->open ("synthmodule.fst");
+    TraceWindow    window;
+    VerilatedFstC* tfp = nullptr;
+    if (window.parse()) {
+        Verilated::traceEverOn(true);
+        VL_PRINTF("Enabling waves...\n");
+        tfp = new VerilatedFstC;
+        top->trace (tfp, 99);	// Trace 99 levels of hierarchy
+        tfp->open ("synthmodule.fst");
+    }
 
-    VL_PRINTF("Verilating...\n");
+    VL_PRINTF("Verilating %zu stimulus records...\n", stimulus.records.size());
 
     top->usb_rst  = 1;
     top->adat_rst = 1;
@@ -76,38 +333,69 @@ int main(int argc, char** argv) {
     top->synthmodule__02Erst = 1;
     top->eval();
 
-    const vluint64_t max_time = 3000000;
+    const vluint64_t max_time   = stimulus.end_time + tail_time;
+    const vluint64_t reset_time = 10;
+    bool  in_reset = true;
+
+    Clock usb(usb_period), adat_clock(adat_period), jt51(jt51_period);
+    vluint64_t evals = 0;
+    const double start = wall_seconds();
 
+    // jump from clock edge to clock edge, every edge time gets one eval
     while (main_time < max_time) {
-        bool needs_eval = false;
-        if (main_time > 10)                             { top->usb_rst = 0; top->adat_rst = 0; top->jt51_rst = 0; top->synthmodule__02Erst = 0; needs_eval = true; }
-        if ((main_time % usb_period) == 0)              { top->usb_clk = 1; top->synthmodule__02Eclk = 1; needs_eval = true; }
-        if ((main_time % usb_period) == usb_period/2)   { top->usb_clk = 0; top->synthmodule__02Eclk = 0; needs_eval = true; }
-        if ((main_time % adat_period) == 0)             { top->adat_clk = 1; needs_eval = true; }
-        if ((main_time % adat_period) == adat_period/2) { top->adat_clk = 0; needs_eval = true; }
-        if ((main_time % jt51_period) == 0)             { top->jt51_clk = 1; needs_eval = true; }
-        if ((main_time % jt51_period) == jt51_period/2) { top->jt51_clk = 0; needs_eval = true; }
-
-        needs_eval |= send_midi(10 * jt51_period, note_on, main_time);
-        needs_eval |= send_midi(max_time / 4 * 3 / usb_period, note_off, main_time);
-
-        if (needs_eval) {
-            top->eval();
-            if (tfp) tfp->dump (main_time);
-
-            uint8_t completed = uint8_t (main_time * 100 / max_time);
-            if (completed_changed(completed)) {
-                VL_PRINTF("%d%% ", completed);
-                fflush(stdout);
-            }
+        main_time = std::min({ usb.next(), adat_clock.next(), jt51.next() });
+
+        if (in_reset && main_time > reset_time) {
+            top->usb_rst = 0; top->adat_rst = 0; top->jt51_rst = 0; top->synthmodule__02Erst = 0;
+            in_reset = false;
         }
 
-        main_time++;
+        bool usb_edge  = false;
+        bool adat_edge = false;
+        if (usb.next() == main_time) {
+            if (!usb.high) midi.before_edge();
+            usb_edge = usb.toggle();
+            top->usb_clk = usb.high; top->synthmodule__02Eclk = usb.high;
+        }
+        if (adat_clock.next() == main_time) {
+            adat_edge = adat_clock.toggle();
+            top->adat_clk = adat_clock.high;
+        }
+        if (jt51.next() == main_time) {
+            jt51.toggle();
+            top->jt51_clk = jt51.high;
+        }
+
+        top->eval();
+        evals++;
+        if (tfp && window.contains(main_time)) tfp->dump (main_time);
+
+        if (usb_edge) midi.after_edge(main_time);
+        if (adat_edge && adat.feed(top->adat_out)) {
+            // SynthModule puts the 16 bit samples into the upper bits of the 24 bit ADAT words
+            wav.write(int16_t(adat.samples[0] >> 8), int16_t(adat.samples[1] >> 8));
+        }
+
+        uint8_t completed = uint8_t (main_time * 100 / max_time);
+        if (completed_changed(completed)) {
+            double simulated = double(main_time) / time_units_per_second;
+            VL_PRINTF("\r%d%% %.3fs simulated, %.4f simulated s/s ", completed,
+                      simulated, simulated / (wall_seconds() - start));
+            fflush(stdout);
+        }
     }
 
+    const double elapsed   = wall_seconds() - start;
+    const double simulated = double(main_time) / time_units_per_second;
+
     if (tfp) tfp->close();
     top->final();
-    VL_PRINTF("\ndone!\n");
+    wav.close();
+    VL_PRINTF("\ndone! %llu ADAT frames, %llu sync errors, %zu of %zu stimulus records sent\n",
+              (unsigned long long) adat.frames, (unsigned long long) adat.errors,
+              stimulus.record, stimulus.records.size());
+    VL_PRINTF("%.3f simulated seconds in %.1f wall clock seconds: %.4f simulated s/s, %.0f evals/s\n",
+              simulated, elapsed, simulated / elapsed, evals / elapsed);
 
     delete top;
-}
\ No newline at end of file
+}
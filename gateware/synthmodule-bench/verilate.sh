@@ -1,4 +1,10 @@
+# usage: ./verilate.sh song.vgz [output.wav] [+trace]
+# needs synthmodule.v, generated with: python3 ../synthmodule.py generate -t v synthmodule.v
+SONG=${1:?usage: $0 song.vgz [output.wav] [+trace]}
+WAV=${2:-$(basename "${SONG%.*}").wav}
+shift $(( $# < 2 ? $# : 2 ))
+python3 ../../software/vgm-2151/vgm_stimulus.py "$SONG" -o stimulus.bin || exit 1
 rm -rf obj_dir
 verilator -Wno-fatal --trace --trace-fst --cc --exe  synthmodule.v $(find ../jt51/hdl/ -name \*.v) main.cpp
 cd obj_dir
-make -j8 -f Vsynthmodule.mk && ./Vsynthmodule
\ No newline at end of file
+make -j8 -f Vsynthmodule.mk && ./Vsynthmodule ../stimulus.bin "../$WAV" "$@"
@@ -13,9 +13,12 @@ from midicontroller import MIDIController
 
 class SynthModule(Elaboratable):
     """ Main Synth module excluding USB, modularized to facilitate integration testing"""
-    def __init__(self) -> None:
-       self.midi_stream = StreamInterface(payload_width=8)
-       self.adat_out    = Signal()
+    def __init__(self, with_midi_in=False) -> None:
+       self.with_midi_in = with_midi_in
+       self.midi_stream  = StreamInterface(payload_width=8)
+       # replies to the host, with_midi_in only
+       self.midi_out     = StreamInterface(payload_width=8)
+       self.adat_out     = Signal()
 
     def elaborate(self, platform):
         m = Module()
@@ -23,9 +26,11 @@ class SynthModule(Elaboratable):
         #
         # Set up submodules
         #
-        m.submodules.midicontroller = midicontroller = MIDIController()
+        m.submodules.midicontroller = midicontroller = MIDIController(with_midi_in=self.with_midi_in)
         # connect USB to the MIDIController
         m.d.comb += midicontroller.midi_stream.stream_eq(self.midi_stream),
+        if self.with_midi_in:
+            m.d.comb += self.midi_out.stream_eq(midicontroller.midi_out)
 
         m.submodules.jt51instance = jt51instance = Jt51()
         m.submodules.jt51streamer = jt51streamer = Jt51Streamer(jt51instance)
@@ -54,7 +59,11 @@ class SynthModule(Elaboratable):
             jt51instance.cs_n.eq(0),
             jt51instance.cen.eq(1),
             jt51streamer.input_stream.stream_eq(midicontroller.jt51_stream),
+            midicontroller.ping_done.eq(jt51streamer.ping_done),
+            midicontroller.ping_done_tag.eq(jt51streamer.ping_done_tag),
         ]
+        if self.with_midi_in:
+            m.d.comb += midicontroller.mirror.stream_eq(jt51streamer.mirror)
 
         # make cen_p1 half the JT51 clock speed
         m.d.jt51 += jt51instance.cen_p1.eq(~jt51instance.cen_p1)
@@ -129,4 +138,4 @@ class SynthModule(Elaboratable):
 
 if __name__ == "__main__":
     m = SynthModule()
-    main(m, name="synthmodule", ports=[m.midi_stream.valid, m.midi_stream.payload, ClockSignal("adat"), ResetSignal("adat"), m.adat_out])
+    main(m, name="synthmodule", ports=[m.midi_stream.valid, m.midi_stream.payload, m.midi_stream.ready, ClockSignal("adat"), ResetSignal("adat"), m.adat_out])
@@ -11,9 +11,13 @@ from usb_protocol.emitters.descriptors        import midi1
 from amlib.stream                    import StreamInterface
 
 class USBMIDI(Elaboratable):
-    def __init__(self, use_ila=False):
-        self.stream_out = StreamInterface()
-        self._use_ila   = use_ila
+    def __init__(self, use_ila=False, with_midi_in=False):
+        self.stream_out   = StreamInterface()
+        # USB MIDI event packets to the host, only used with_midi_in.
+        # last flushes the IN packet, so replies are not held back until it is full
+        self.stream_in    = StreamInterface()
+        self._use_ila     = use_ila
+        self.with_midi_in = with_midi_in
         self.additional_endpoints = []
 
         # USB activity LEDs
@@ -23,8 +27,6 @@ class USBMIDI(Elaboratable):
         self.usb_reset_detected_out = Signal()
 
     MAX_PACKET_SIZE = 512
-    # we currently do not need MIDI feedback from the synth
-    with_midi_in = False
 
     def create_descriptors(self):
         """ Creates the descriptors that describe our MIDI topology. """
@@ -88,8 +90,8 @@ class USBMIDI(Elaboratable):
             streamingInterface.add_subordinate_descriptor(outMidiEndpoint)
 
             if self.with_midi_in:
-                inEndpoint = midi1.StandardMidiStreamingDataEndpointDescriptorEmitter()
-                inEndpoint.bEndpointAddress = USBDirection.IN.from_endpoint_address(1)
+                inEndpoint = midi1.StandardMidiStreamingBulkDataEndpointDescriptorEmitter()
+                inEndpoint.bEndpointAddress = USBDirection.IN.to_endpoint_address(1)
                 inEndpoint.wMaxPacketSize = self.MAX_PACKET_SIZE
                 streamingInterface.add_subordinate_descriptor(inEndpoint)
 
@@ -136,6 +138,7 @@ class USBMIDI(Elaboratable):
                 endpoint_number=1, # EP 1 IN
                 max_packet_size=self.MAX_PACKET_SIZE)
             usb.add_endpoint(ep1_in)
+            m.d.comb += ep1_in.stream.stream_eq(self.stream_in)
 
         for endpoint in self.additional_endpoints:
             usb.add_endpoint(endpoint)
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+from midicontroller import MIDIController
+from amaranth.sim import Simulator, Tick, Settle, Passive
+
+KEY_ON = 0x78
+
+if __name__ == "__main__":
+    dut = MIDIController()
+    payload = dut.midi_stream.payload
+    valid   = dut.midi_stream.valid
+    ready   = dut.midi_stream.ready
+
+    # register writes which arrive at the JT51 side of the output FIFO
+    writes = []
+
+    def send_packet(*packet):
+        """ sends one 4 byte USB MIDI event packet, honouring ready """
+        yield valid.eq(1)
+        for byte in packet:
+            yield payload.eq(byte)
+            yield Settle()
+            # the byte is taken at the clock edge at which ready is high
+            while not (yield ready):
+                yield Tick("usb")
+                yield Settle()
+            yield Tick("usb")
+        yield valid.eq(0)
+        yield payload.eq(0)
+        # let the register writes of this message pass the output FIFO
+        for _ in range(32):
+            yield Tick("usb")
+
+    def note_on(channel, note, velocity=0x7f):
+        yield from send_packet(0x09, 0x90 | channel, note, velocity)
+
+    def note_off(channel, note):
+        yield from send_packet(0x08, 0x80 | channel, note, 0)
+
+    def key_ons():
+        """ voices keyed on since the last call, with their key codes """
+        result = []
+        for i, (address, data) in enumerate(writes):
+            if address == 0x08 and data & KEY_ON:
+                voice = data & 0b111
+                key_code = [d for a, d in writes[:i] if a == 0x28 + voice][-1]
+                result.append((voice, key_code))
+        writes.clear()
+        return result
+
+    def key_offs():
+        result = [data & 0b111 for address, data in writes if address == 0x08 and not data & KEY_ON]
+        writes.clear()
+        return result
+
+    def usb_process():
+        # wait for the initialization writes
+        for _ in range(2**10 + 200):
+            yield Tick("usb")
+        writes.clear()
+
+        # a dense chord of 8 notes on one MIDI channel takes all 8 voices
+        chord = [48, 52, 55, 59, 62, 65, 69, 72]
+        for note in chord:
+            yield from note_on(0, note)
+        on = key_ons()
+        assert sorted(voice for voice, _ in on) == list(range(8)), on
+        voice_of = {note: voice for note, (voice, _) in zip(chord, on)}
+
+        # two more notes steal the two oldest voices
+        yield from note_on(0, 76)
+        yield from note_on(0, 79)
+        on = key_ons()
+        assert [voice for voice, _ in on] == [voice_of[48], voice_of[52]], on
+        voice_of[76], voice_of[79] = voice_of.pop(48), voice_of.pop(52)
+
+        # note off releases only the voice of that note
+        yield from note_off(0, 62)
+        assert key_offs() == [voice_of[62]]
+        # a note off of a stolen note does nothing
+        yield from note_off(0, 48)
+        assert key_offs() == []
+        # the same note on another MIDI channel is another voice
+        yield from note_off(1, 69)
+        assert key_offs() == []
+        # note on with velocity 0 is a note off
+        yield from note_on(0, 69, velocity=0)
+        assert key_offs() == [voice_of[69]]
+
+        # released voices are reused, the least recently released first
+        yield from note_on(3, 60)
+        yield from note_on(3, 64)
+        on = key_ons()
+        assert [voice for voice, _ in on] == [voice_of[62], voice_of[69]], on
+
+        # releasing the whole chord frees all voices
+        for note in [55, 59, 65, 72, 76, 79]:
+            yield from note_off(0, note)
+        for note in [60, 64]:
+            yield from note_off(3, note)
+        assert sorted(key_offs()) == list(range(8))
+        print("voice allocator: all checks passed")
+
+    def jt51_process():
+        yield Passive()
+        yield dut.jt51_stream.ready.eq(1)
+        while True:
+            yield Tick("jt51")
+            if (yield dut.jt51_stream.valid):
+                entry = yield dut.jt51_stream.payload
+                writes.append(((entry >> 8) & 0xff, entry & 0xff))
+
+    sim = Simulator(dut)
+    sim.add_clock(1.0/60e6, domain="usb")
+    sim.add_clock(1.0/30e6, domain="jt51")
+    sim.add_sync_process(usb_process, domain="usb")
+    sim.add_sync_process(jt51_process, domain="jt51")
+
+    with sim.write_vcd(f'voiceallocator.vcd'):
+        sim.run()
@@ -0,0 +1,99 @@
+from amaranth import *
+
+
+class VoiceAllocator(Elaboratable):
+    """ Assigns notes to the eight YM2151 channels.
+
+        The voices are kept in least recently used order. A note on takes
+        the voice which already plays that note, or else the least recently
+        used free voice, or else steals the least recently used voice.
+        A note off releases only the voice which plays that MIDI channel and note.
+        Both move the voice to the back of the order, so released voices
+        can ring out before they are reused.
+
+        voice and release_voice are combinational, allocate and release
+        commit them in the same cycle.
+    """
+    VOICES = 8
+
+    def __init__(self):
+        self.channel = Signal(4)
+        self.note    = Signal(7)
+
+        self.allocate = Signal()
+        self.voice    = Signal(3)
+        # the voice is playing another note, which gets cut off
+        self.steal    = Signal()
+
+        self.release       = Signal()
+        self.release_found = Signal()
+        self.release_voice = Signal(3)
+
+        # voice state, read by the pitch bend updates of MIDIController
+        self.active        = Signal(self.VOICES)
+        self.voice_note    = Array(Signal(7, name=f"voice_note_{i}")    for i in range(self.VOICES))
+        self.voice_channel = Array(Signal(4, name=f"voice_channel_{i}") for i in range(self.VOICES))
+
+    def elaborate(self, platform):
+        m = Module()
+
+        voice_note    = self.voice_note
+        voice_channel = self.voice_channel
+        # lru[0] is the least recently used voice
+        lru = Array(Signal(3, reset=i, name=f"lru_{i}") for i in range(self.VOICES))
+
+        active = self.active
+        is_active = Array(active[i] for i in range(self.VOICES))
+
+        # the voice which plays the note of channel
+        playing       = Signal(self.VOICES)
+        playing_voice = Signal(3)
+        m.d.comb += playing.eq(Cat(is_active[i] & (voice_note[i] == self.note) & (voice_channel[i] == self.channel)
+                                   for i in range(self.VOICES)))
+        for i in reversed(range(self.VOICES)):
+            with m.If(playing[i]):
+                m.d.comb += playing_voice.eq(i)
+
+        # least recently used free voice, or the least recently used one
+        free_position = Signal(3)
+        for i in reversed(range(self.VOICES)):
+            with m.If(~is_active[lru[i]]):
+                m.d.comb += free_position.eq(i)
+
+        with m.If(playing.any()):
+            m.d.comb += self.voice.eq(playing_voice)
+        with m.Else():
+            m.d.comb += [
+                self.voice.eq(lru[free_position]),
+                self.steal.eq(is_active[lru[free_position]]),
+            ]
+
+        m.d.comb += [
+            self.release_found.eq(playing.any()),
+            self.release_voice.eq(playing_voice),
+        ]
+
+        def touch(voice):
+            """ moves voice to the back of the LRU order """
+            position = Signal(3)
+            for i in range(self.VOICES):
+                with m.If(lru[i] == voice):
+                    m.d.comb += position.eq(i)
+            for i in range(self.VOICES - 1):
+                with m.If(i >= position):
+                    m.d.sync += lru[i].eq(lru[i + 1])
+            m.d.sync += lru[self.VOICES - 1].eq(voice)
+
+        with m.If(self.allocate):
+            m.d.sync += [
+                voice_note[self.voice].eq(self.note),
+                voice_channel[self.voice].eq(self.channel),
+                is_active[self.voice].eq(1),
+            ]
+            touch(self.voice)
+
+        with m.Elif(self.release & self.release_found):
+            m.d.sync += is_active[self.release_voice].eq(0)
+            touch(self.release_voice)
+
+        return m
@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+import argparse
+from vgm_play_usb import TRANSPORTS
+
+# see MIDIController.SYSEX_CC_MAP
+SYSEX_CC_MAP = 0x7b
+CURVES = {
+    "linear":      0,
+    "inverted":    1,
+    "attenuation": 2,
+    "squared":     3,
+}
+
+
+def cc_map_message(channel, cc, address, *, base=0, shift=0, width=7, curve="linear", per_voice=False):
+    """ maps CC number cc on MIDI channel channel to bits shift to shift + width - 1 of the
+        YM2151 register address, the other bits of the written value are base.
+        With per_voice, address is that of YM2151 channel 0 and the value is written
+        to every voice playing a note of the MIDI channel. Width 0 removes the mapping """
+    if not 0 <= width <= 7 or shift + width > 8:
+        raise ValueError(f"bit field of width {width} at bit {shift} does not fit into a register")
+    return [0xf0, SYSEX_CC_MAP, channel, cc,
+            address >> 4, address & 0xf, base >> 4, base & 0xf,
+            shift, width, CURVES[curve], int(per_voice), 0xf7]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="map a MIDI CC to a YM2151 register on the JT51-Synth")
+    parser.add_argument("channel", type=int, help="MIDI channel, 0-15")
+    parser.add_argument("cc", type=int, help="CC number")
+    parser.add_argument("address", type=lambda x: int(x, 0), help="register address, e.g. 0x19")
+    parser.add_argument("--base", type=lambda x: int(x, 0), default=0, help="bits outside the field")
+    parser.add_argument("--shift", type=int, default=0, help="lowest bit of the field")
+    parser.add_argument("--width", type=int, default=7, help="bits of the field, 0 removes the mapping")
+    parser.add_argument("--curve", choices=CURVES.keys(), default="linear")
+    parser.add_argument("--per-voice", action="store_true",
+                        help="write to all voices playing the MIDI channel, address is that of channel 0")
+    parser.add_argument("--transport", choices=TRANSPORTS.keys(), default="rtmidi",
+                        help="rtmidi: OS MIDI stack, usb: direct libusb bulk transfers")
+    args = parser.parse_args()
+
+    transport = TRANSPORTS[args.transport]()
+    try:
+        transport.send_message(cc_map_message(args.channel, args.cc, args.address, base=args.base,
+                                              shift=args.shift, width=args.width, curve=args.curve,
+                                              per_voice=args.per_voice))
+        transport.flush()
+    finally:
+        transport.close()
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+import time
+import argparse
+import numpy as np
+from midi_transport import RtMidiTransport, USBBulkTransport
+from vgm_play_usb import bulk_message, MAX_BULK_PAIRS
+from vgm_timing import SendTiming, histogram_lines
+
+# see MIDIController.SYSEX_PING, needs gateware built with JT51Synth.USE_MIDI_IN
+SYSEX_PING  = 0x7c
+PING_QUEUED = 0
+PING_DONE   = 1
+STAGES      = ["queued", "done"]
+
+# load: writes of (nearly) full attenuation to the total level of carrier C2 of
+# channel 7, which are inaudible. Jt51Streamer drops writes which repeat the
+# register value, so the value alternates to have every write reach the chip
+LOAD_REGISTER = 0x7f
+LOAD_VALUES   = [0x7f, 0x7e]
+
+TRANSPORTS = {
+    "rtmidi": lambda: RtMidiTransport(midi_in=True),
+    "usb":    USBBulkTransport,
+}
+
+
+def ping_message(tag):
+    return [0xf0, SYSEX_PING, (tag >> 7) & 0x7f, tag & 0x7f, 0xf7]
+
+def parse_echo(message):
+    """ returns stage and tag of a ping echo, or None for other messages """
+    if len(message) == 6 and message[0] == 0xf0 and message[1] == SYSEX_PING:
+        return message[2], (message[3] << 7) | message[4]
+    return None
+
+def measure(transport, count, load, *, timeout=0.5, interval=0.01):
+    """ sends count pings, each behind load register writes.
+        Returns the round trip times in seconds as (count, 2) array,
+        one column per stage, NaN where the echo did not arrive within timeout """
+    results = np.full((count, len(STAGES)), np.nan)
+    writes  = [byte for i in range(load) for byte in (LOAD_REGISTER, LOAD_VALUES[i % 2])]
+    for n in range(count):
+        tag = n & 0x3fff
+        for i in range(0, len(writes), 2 * MAX_BULK_PAIRS):
+            transport.send_message(bulk_message(writes[i:i + 2 * MAX_BULK_PAIRS]))
+        # the USB transport sends the load and the ping in one transfer,
+        # so its round trip includes the transfer of the load
+        start = time.perf_counter()
+        transport.send_message(ping_message(tag))
+        transport.flush()
+
+        deadline = start + timeout
+        while np.isnan(results[n]).any():
+            message = transport.receive(deadline - time.perf_counter())
+            if message is None:
+                break
+            echo = parse_echo(message)
+            # echoes of earlier, timed out pings are ignored
+            if echo is not None and echo[1] == tag and echo[0] < len(STAGES):
+                results[n, echo[0]] = time.perf_counter() - start
+        time.sleep(interval)
+    return results
+
+def report(load, results):
+    lines = [f"load of {load} writes per ping:"]
+    for stage, times in zip(STAGES, results.T):
+        received = times[~np.isnan(times)]
+        lost     = len(times) - len(received)
+        if not len(received):
+            lines.append(f"    {stage}: no echo received")
+            continue
+        p50, p99 = np.percentile(received, [50, 99])
+        lines.append(f"    {stage}: round trip p50 {p50 * 1e3:.3f}ms, p99 {p99 * 1e3:.3f}ms, "
+                     f"max {received.max() * 1e3:.3f}ms" + (f", {lost} lost" if lost else ""))
+        lines += histogram_lines(f"{stage} histogram", SendTiming.histogram(received))
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="measure the round trip latency to the JT51-Synth "
+                                                 "with sysex pings echoed over MIDI IN")
+    parser.add_argument("--transport", choices=TRANSPORTS.keys(), default="usb",
+                        help="rtmidi: OS MIDI stack, usb: direct libusb bulk transfers")
+    parser.add_argument("-n", "--count", type=int, default=200, help="pings per load")
+    parser.add_argument("--loads", default="0,16,256,1024",
+                        help="comma separated numbers of register writes sent ahead of each ping")
+    parser.add_argument("--interval", type=float, default=0.01, help="seconds between two pings")
+    parser.add_argument("-o", "--output", help="save all round trip times to this CSV file")
+    args = parser.parse_args()
+
+    loads     = [int(load) for load in args.loads.split(",")]
+    transport = TRANSPORTS[args.transport]()
+    rows = []
+    try:
+        for load in loads:
+            results = measure(transport, args.count, load, interval=args.interval)
+            print(report(load, results))
+            rows += [(load, queued, done) for queued, done in results]
+    finally:
+        transport.close()
+
+    if args.output:
+        np.savetxt(args.output, np.array(rows), delimiter=",", header="load,queued,done",
+                   comments="", fmt=["%d", "%.9f", "%.9f"])
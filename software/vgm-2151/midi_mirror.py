@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+import time
+import argparse
+from midi_latency import TRANSPORTS
+from ym2151 import YM2151Shadow, PMD_SLOT
+
+# see MIDIController.SYSEX_READBACK, needs gateware built with JT51Synth.USE_MIDI_IN
+SYSEX_READBACK = 0x79
+# see Jt51Streamer: the 256 registers, the PM depth at PMD_SLOT
+# and the last key on write of each channel
+MIRROR_SLOTS = 0x110
+KEY_ON_SLOT  = 0x108
+
+def readback_message(tag):
+    return [0xf0, SYSEX_READBACK, (tag >> 7) & 0x7f, tag & 0x7f, 0xf7]
+
+def parse_readback(message):
+    """ returns tag and register state of a readback reply, or None for other messages.
+        Registers which have not been written since the synth was reset are None """
+    if len(message) != 5 + 2 * MIRROR_SLOTS or message[0] != 0xf0 or message[1] != SYSEX_READBACK:
+        return None
+    tag   = (message[2] << 7) | message[3]
+    # <known << 4 | high nibble> <low nibble> per slot
+    slots = [((high & 0xf) << 4) | low if high & 0x10 else None
+             for high, low in zip(message[4:-1:2], message[5:-1:2])]
+
+    state = YM2151Shadow()
+    state.registers[:256]     = slots[:256]
+    state.registers[PMD_SLOT] = slots[PMD_SLOT]
+    state.key_on = [(data >> 3) & 0xf if data is not None else 0
+                    for data in slots[KEY_ON_SLOT:KEY_ON_SLOT + 8]]
+    return tag, state
+
+def read_mirror(transport, *, tag=0, timeout=0.5):
+    """ the register state of the synth after all writes sent so far, or None on timeout """
+    transport.send_message(readback_message(tag))
+    transport.flush()
+    # one timeout for the reply, however many other messages arrive before it
+    deadline = time.perf_counter() + timeout
+    while True:
+        message = transport.receive(deadline - time.perf_counter())
+        if message is None:
+            return None
+        reply = parse_readback(message)
+        # skips ping echoes and replies to earlier, timed out requests
+        if reply is not None and reply[0] == tag:
+            return reply[1]
+
+def format_mirror(state):
+    lines = ["    " + " ".join(f"{low:x} " for low in range(16))]
+    for high in range(16):
+        row = state.registers[high << 4:(high + 1) << 4]
+        lines.append(f"{high:x}0: " + " ".join("--" if data is None else f"{data:02x}" for data in row))
+    pmd = state.registers[PMD_SLOT]
+    lines.append("PMD: " + ("--" if pmd is None else f"{pmd & 0x7f:02x}"))
+    lines.append("key on (C2 M2 C1 M1): " + " ".join(f"{slots:04b}" for slots in state.key_on))
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="read back the YM2151 register state of the JT51-Synth")
+    parser.add_argument("--transport", choices=TRANSPORTS.keys(), default="usb",
+                        help="rtmidi: OS MIDI stack, usb: direct libusb bulk transfers")
+    parser.add_argument("--timeout", type=float, default=0.5, help="seconds to wait for the reply")
+    args = parser.parse_args()
+
+    transport = TRANSPORTS[args.transport]()
+    try:
+        state = read_mirror(transport, timeout=args.timeout)
+    finally:
+        transport.close()
+
+    if state is None:
+        print("no reply, is the gateware built with USE_MIDI_IN?")
+    else:
+        print(format_mirror(state))
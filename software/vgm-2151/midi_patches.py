@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+import argparse
+import vgm
+from ym2151 import YM2151Shadow
+from vgm_play_usb import TRANSPORTS, pack_7bit
+
+# see MIDIController.SYSEX_PATCH
+SYSEX_PATCH = 0x7a
+# see midicontroller.PATCH_REGISTERS, the registers of YM2151 channel 0 in patch order
+PATCH_REGISTERS = [0x20, 0x38] + [base + operator * 8
+                                  for base in range(0x40, 0x100, 0x20) for operator in range(4)]
+
+
+def patch_message(program, patch):
+    """ stores patch, the values of PATCH_REGISTERS, as program in the patch store of the synth """
+    if len(patch) != len(PATCH_REGISTERS):
+        raise ValueError(f"a patch has {len(PATCH_REGISTERS)} registers, not {len(patch)}")
+    return [0xf0, SYSEX_PATCH, program] + pack_7bit(patch) + [0xf7]
+
+def program_change(channel, program):
+    return [0xc0 | channel, program]
+
+def patch_from_shadow(shadow, channel):
+    """ the patch of YM2151 channel channel, registers which were never written are 0 """
+    return [shadow.registers[address + channel] or 0 for address in PATCH_REGISTERS]
+
+def patch_from_vgm(path, channel, seconds):
+    """ the patch of YM2151 channel channel at seconds into the song """
+    with open(path, "rb") as file:
+        reader = vgm.VGMStreamReader.from_file(file)
+    shadow   = YM2151Shadow()
+    stop_at  = round(seconds * vgm.SAMPLE_RATE)
+    for events in reader.iter_events():
+        for time, kind, a, b, c in events:
+            if time > stop_at:
+                return patch_from_shadow(shadow, channel)
+            if kind == vgm.EVENT_YM2151:
+                shadow.write(a, b)
+    return patch_from_shadow(shadow, channel)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="upload a voice patch from a VGM file into the "
+                                                 "patch store of the JT51-Synth")
+    parser.add_argument("file", help="VGM file to take the patch from")
+    parser.add_argument("program", type=int, help="program number to store the patch as, 0-127")
+    parser.add_argument("--channel", type=int, default=0, help="YM2151 channel of the patch in the song")
+    parser.add_argument("--time", type=float, default=0.0, help="take the patch at this many seconds into the song")
+    parser.add_argument("--select", type=int, metavar="MIDI_CHANNEL",
+                        help="also send a program change to this MIDI channel")
+    parser.add_argument("--transport", choices=TRANSPORTS.keys(), default="rtmidi",
+                        help="rtmidi: OS MIDI stack, usb: direct libusb bulk transfers")
+    args = parser.parse_args()
+
+    patch = patch_from_vgm(args.file, args.channel, args.time)
+    print(" ".join(f"{address:02x}:{data:02x}" for address, data in zip(PATCH_REGISTERS, patch)))
+
+    transport = TRANSPORTS[args.transport]()
+    try:
+        transport.send_message(patch_message(args.program, patch))
+        if args.select is not None:
+            transport.send_message(program_change(args.select, args.program))
+        transport.flush()
+    finally:
+        transport.close()
@@ -0,0 +1,188 @@
+import sys
+import time
+from collections import deque
+
+
+__all__ = ["RtMidiTransport", "USBBulkTransport", "usb_midi_packets", "usb_midi_messages"]
+
+
+VENDOR_ID  = 0x16d0
+PRODUCT_ID = 0x0f3b
+
+
+def usb_midi_packets(message, cable=0):
+    """ converts a MIDI message into 4 byte USB MIDI event packets """
+    header = cable << 4
+    if message[0] == 0xf0:
+        packets = bytearray()
+        for i in range(0, len(message), 3):
+            chunk = message[i:i + 3]
+            if chunk[-1] == 0xf7:
+                # code index 5, 6, 7: sysex ends with 1, 2 or 3 bytes
+                cin = 0x4 + len(chunk)
+            else:
+                # code index 4: sysex starts or continues
+                cin = 0x4
+            packets.append(header | cin)
+            packets += bytes(chunk)
+            packets += bytes(3 - len(chunk))
+        return packets
+    else:
+        # channel voice messages: the code index is the upper status nibble
+        return bytes([header | (message[0] >> 4)] + list(message) + [0] * (3 - len(message)))
+
+
+# number of MIDI bytes in a USB MIDI event packet, by code index number
+_CIN_LENGTHS = {
+    0x4: 3, 0x5: 1, 0x6: 2, 0x7: 3,
+    0x8: 3, 0x9: 3, 0xa: 3, 0xb: 3, 0xc: 2, 0xd: 2, 0xe: 3,
+}
+
+
+def usb_midi_messages(packets, sysex):
+    """ converts 4 byte USB MIDI event packets back into MIDI messages.
+        sysex is a bytearray which collects a sysex message across calls """
+    messages = []
+    for i in range(0, len(packets) - 3, 4):
+        cin    = packets[i] & 0xf
+        length = _CIN_LENGTHS.get(cin)
+        if length is None:
+            continue
+        data = packets[i + 1:i + 1 + length]
+        if cin == 0x4:
+            sysex += data
+        elif cin <= 0x7:
+            sysex += data
+            messages.append(list(sysex))
+            sysex.clear()
+        else:
+            messages.append(list(data))
+    return messages
+
+
+class RtMidiTransport:
+    """ sends MIDI messages through the operating system's MIDI stack,
+        with midi_in it also opens the synth's MIDI input for receive() """
+    # poll interval of receive()
+    POLL_SECONDS = 0.0001
+
+    def __init__(self, port_name="JT51-Synth", *, midi_in=False):
+        import rtmidi
+
+        self.midiout = rtmidi.MidiOut()
+        available_ports = self.midiout.get_ports()
+
+        synthport = [i for i in available_ports if port_name in i]
+        if not synthport:
+            print(f"{port_name} not connected!")
+            sys.exit(1)
+
+        self.midiout.open_port(available_ports.index(synthport[0]))
+
+        self.midiin = None
+        if midi_in:
+            self.midiin = rtmidi.MidiIn()
+            input_ports = [i for i in self.midiin.get_ports() if port_name in i]
+            if not input_ports:
+                print(f"{port_name} has no MIDI input, is the gateware built with USE_MIDI_IN?")
+                sys.exit(1)
+            self.midiin.open_port(self.midiin.get_ports().index(input_ports[0]))
+            self.midiin.ignore_types(sysex=False)
+
+    def send_message(self, message):
+        self.midiout.send_message(message)
+
+    def flush(self):
+        pass
+
+    def receive(self, timeout):
+        """ returns the next MIDI message from the synth, or None after timeout seconds """
+        deadline = time.perf_counter() + timeout
+        while True:
+            received = self.midiin.get_message()
+            if received is not None:
+                return received[0]
+            if time.perf_counter() >= deadline:
+                return None
+            time.sleep(self.POLL_SECONDS)
+
+    def close(self):
+        self.midiout.close_port()
+        if self.midiin is not None:
+            self.midiin.close_port()
+
+
+class USBBulkTransport:
+    """ talks to the synth's MIDI streaming endpoint directly via libusb
+
+        MIDI messages are converted to USB MIDI event packets and collected,
+        until flush() sends them all in one bulk transfer, which libusb
+        splits into full 512 byte high speed packets.
+    """
+    INTERFACE       = 0
+    ENDPOINT_OUT    = 0x01 # EP 1 OUT
+    ENDPOINT_IN     = 0x81 # EP 1 IN, only with USE_MIDI_IN gateware
+    MAX_PACKET_SIZE = 512
+
+    def __init__(self, *, cable=0, timeout=1000):
+        import usb.core
+        import usb.util
+
+        self.cable   = cable
+        self.timeout = timeout
+        self.buffer  = bytearray()
+        # messages read from EP 1 IN, and an unfinished sysex message
+        self.received = deque()
+        self.sysex    = bytearray()
+
+        self.device = usb.core.find(idVendor=VENDOR_ID, idProduct=PRODUCT_ID)
+        if self.device is None:
+            print("JT51-Synth not connected!")
+            sys.exit(1)
+
+        # the MIDI streaming interface is usually claimed by the OS MIDI driver
+        self.reattach_kernel_driver = False
+        try:
+            if self.device.is_kernel_driver_active(self.INTERFACE):
+                self.device.detach_kernel_driver(self.INTERFACE)
+                self.reattach_kernel_driver = True
+        except NotImplementedError:
+            pass
+
+        usb.util.claim_interface(self.device, self.INTERFACE)
+
+    def send_message(self, message):
+        self.buffer += usb_midi_packets(message, self.cable)
+        # bound the size, and thereby the duration, of a single transfer
+        if len(self.buffer) >= 8 * self.MAX_PACKET_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.device.write(self.ENDPOINT_OUT, self.buffer, self.timeout)
+            self.buffer = bytearray()
+
+    def receive(self, timeout):
+        """ returns the next MIDI message from the synth, or None after timeout seconds """
+        import usb.core
+
+        deadline = time.perf_counter() + timeout
+        while not self.received:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                return None
+            try:
+                packets = self.device.read(self.ENDPOINT_IN, self.MAX_PACKET_SIZE, max(1, round(remaining * 1e3)))
+            except usb.core.USBTimeoutError:
+                return None
+            self.received.extend(usb_midi_messages(packets, self.sysex))
+        return self.received.popleft()
+
+    def close(self):
+        import usb.util
+
+        self.flush()
+        usb.util.release_interface(self.device, self.INTERFACE)
+        if self.reattach_kernel_driver:
+            self.device.attach_kernel_driver(self.INTERFACE)
+        usb.util.dispose_resources(self.device)
@@ -1,16 +1,129 @@
 import io
+import copy
 import gzip
+import mmap
+import bisect
+import shutil
 import struct
+import tempfile
 from fractions import Fraction
 
+from ym2151 import YM2151Shadow
 
-__all__ = ["VGMStreamPlayer", "VGMStreamReader"]
+
+__all__ = ["VGMStreamPlayer", "VGMStreamReader", "VGMHeader", "read_header", "parse_gd3",
+           "GD3_FIELDS", "HEADER_SIZE", "EVENT_BATCH_DTYPE",
+           "EVENT_WAIT", "EVENT_SN76489", "EVENT_YM2612", "EVENT_YM2151",
+           "EVENT_YM3812", "EVENT_YM3526", "EVENT_YMF262", "EVENT_DATA_BLOCK"]
 
 
 SAMPLE_RATE = 48000
 
 
+_structs = {}
+_seconds = {}
+
+def _struct(fmt):
+    try:
+        return _structs[fmt]
+    except KeyError:
+        _structs[fmt] = result = struct.Struct(fmt)
+        return result
+
+
+# Event kinds, as yielded by VGMStreamReader.iter_events().
+# Events are (time, kind, a, b, c) tuples, time is the sample number
+# counted from where the iteration started:
+#   EVENT_WAIT:       a = samples, b = offset of the command after the wait
+#   EVENT_SN76489:    a = data
+#   EVENT_YM2612:     a = port, b = address, c = data
+#   EVENT_YM2151, EVENT_YM3812, EVENT_YM3526:
+#                     a = address, b = data
+#   EVENT_YMF262:     a = port << 8 | address, b = data
+#   EVENT_DATA_BLOCK: a = block type, b = offset of the data in the file, c = size
+EVENT_WAIT       = 0
+EVENT_SN76489    = 1
+EVENT_YM2612     = 2
+EVENT_YM2151     = 3
+EVENT_YM3812     = 4
+EVENT_YM3526     = 5
+EVENT_YMF262     = 6
+EVENT_DATA_BLOCK = 7
+
+# further command kinds of the opcode dispatch table
+_UNKNOWN    = 8
+_END        = 9
+_WAIT_N     = 10 # 16 bit wait operand
+_SEGA_PCM   = 11
+_STREAM     = 12
+
+# NumPy dtype of the event arrays of VGMStreamReader.iter_events(as_array=True)
+EVENT_BATCH_DTYPE = [
+    ("time", "<u8"),
+    ("kind", "u1"),
+    ("a",    "<u4"),
+    ("b",    "<u4"),
+    ("c",    "<u4"),
+]
+
+# opcode -> (kind, operand length in bytes, argument)
+_DISPATCH = [(_UNKNOWN, 0, 0)] * 256
+_DISPATCH[0x50] = (EVENT_SN76489,     1, 0)
+_DISPATCH[0x52] = (EVENT_YM2612,      2, 0)     # port 0
+_DISPATCH[0x53] = (EVENT_YM2612,      2, 1)     # port 1
+_DISPATCH[0x54] = (EVENT_YM2151,      2, 0)
+_DISPATCH[0x5A] = (EVENT_YM3812,      2, 0)
+_DISPATCH[0x5B] = (EVENT_YM3526,      2, 0)
+_DISPATCH[0x5E] = (EVENT_YMF262,      2, 0x000) # port 0
+_DISPATCH[0x5F] = (EVENT_YMF262,      2, 0x100) # port 1
+_DISPATCH[0x61] = (_WAIT_N,           2, 0)
+_DISPATCH[0x62] = (EVENT_WAIT,        0, 735)   # 1/60 s
+_DISPATCH[0x63] = (EVENT_WAIT,        0, 882)   # 1/50 s
+_DISPATCH[0x66] = (_END,              0, 0)
+_DISPATCH[0x67] = (EVENT_DATA_BLOCK,  0, 0)
+for _command in range(0x70, 0x80):
+    _DISPATCH[_command] = (EVENT_WAIT,        0, (_command & 0xf) + 1)
+_DISPATCH[0x90] = (_STREAM,           4, 0)
+_DISPATCH[0x91] = (_STREAM,           4, 0)
+_DISPATCH[0x92] = (_STREAM,           5, 0)
+_DISPATCH[0x93] = (_STREAM,          10, 0)
+_DISPATCH[0x94] = (_STREAM,           1, 0)
+_DISPATCH[0x95] = (_STREAM,           4, 0)
+_DISPATCH[0xC0] = (_SEGA_PCM,         3, 0)
+
+_DISPATCH_ARRAYS = None
+
+def _dispatch_arrays():
+    """ _DISPATCH as NumPy arrays of the command lengths including the opcode, kinds and
+        arguments. The end command, unknown commands and data blocks have length 0 """
+    global _DISPATCH_ARRAYS
+    if _DISPATCH_ARRAYS is None:
+        import numpy as np
+        lengths = np.array([0 if kind in (_UNKNOWN, _END, EVENT_DATA_BLOCK) else 1 + length
+                            for kind, length, _ in _DISPATCH], dtype=np.int64)
+        kinds   = np.array([kind for kind, _, _ in _DISPATCH], dtype=np.uint8)
+        args    = np.array([arg  for _, _, arg in _DISPATCH], dtype=np.uint32)
+        _DISPATCH_ARRAYS = lengths, kinds, args
+    return _DISPATCH_ARRAYS
+
+
 class VGMStreamPlayer:
+    # set by enable_ym2151_shadow()
+    ym2151_shadow = None
+
+    def enable_ym2151_shadow(self):
+        """ drops YM2151 writes which would not change the chip state,
+            before they reach ym2151_write of the player """
+        self.ym2151_shadow = shadow = YM2151Shadow()
+        write = self.ym2151_write
+
+        async def ym2151_write(address, data):
+            if shadow.write(address, data):
+                await write(address, data)
+
+        self.ym2151_write = ym2151_write
+        return shadow
+
     async def sn76489_write(self, data):
         raise NotImplementedError("VGMStream.sn76489_write not implemented")
 
@@ -29,222 +142,755 @@ class VGMStreamPlayer:
     async def ymf262_write(self, address, data):
         raise NotImplementedError("VGMStream.ymf262_write not implemented")
 
+    async def data_block(self, block_type, data):
+        # data is a memoryview of the block contents.
+        # DAC stream data is handled by the reader, so players
+        # only need this for other kinds of data blocks
+        pass
+
     async def wait_seconds(self, delay):
         raise NotImplementedError("VGMStream.wait_seconds not implemented")
 
+    async def wait_samples(self, samples):
+        # the reader reports waits as integer sample counts,
+        # players which work in seconds only need to implement wait_seconds
+        try:
+            seconds = _seconds[samples]
+        except KeyError:
+            seconds = _seconds[samples] = Fraction(samples, SAMPLE_RATE)
+        await self.wait_seconds(seconds)
 
-class VGMStreamReader:
-    @classmethod
-    def from_file(cls, file):
-        if file.name.endswith(".vgz") or file.name.endswith(".gz"):
-            return cls(gzip.GzipFile(fileobj=file))
-        else:
-            return cls(file)
 
-    def _offset(self):
-        return self._input.tell() - self._start
+# layout of the VGM header up to 0xB8, fields named None are reserved
+_HEADER_FIELDS = [
+    # @ 0x00 (Fixed header)
+    ("ident",          "4s"),
+    ("eof_offset",     "L"),
+    ("version",        "L"),
+    ("sn76489_clk",    "L"),
+    ("ym2413_clk",     "L"),
+    ("gd3_offset",     "L"),
+    ("total_samples",  "L"),
+    ("loop_offset",    "L"),
+    ("loop_samples",   "L"),
+    # if version >= 0x1_01:
+    ("rate",           "L"),
+    # if version >= 0x1_10:
+    ("sn76489_fb",     "H"),
+    ("sn76489_srw",    "B"),
+    ("sn76489_flags",  "B"),
+    ("ym2612_clk",     "L"),
+    ("ym2151_clk",     "L"),
+    # if version >= 0x1_50:
+    ("data_offset",    "L"),
+    # if version >= 0x1_51:
+    ("sega_pcm_clk",   "L"),
+    ("sega_pcm_reg",   "L"),
+    # @ 0x40 (Extended header)
+    ("rf5c68_clk",     "L"),
+    ("ym2203_clk",     "L"),
+    ("ym2608_clk",     "L"),
+    ("ym2610_clk",     "L"),
+    ("ym3812_clk",     "L"),
+    ("ym3526_clk",     "L"),
+    ("y8950_clk",      "L"),
+    ("ymf262_clk",     "L"),
+    ("ymf278b_clk",    "L"),
+    ("ymf271_clk",     "L"),
+    ("ymz280b_clk",    "L"),
+    ("rf5c164_clk",    "L"),
+    ("pwm_clk",        "L"),
+    ("ay8910_clk",     "L"),
+    ("ay8910_type",    "B"),
+    ("ay8910_flags",   "B"),
+    ("ym2203_flags",   "B"),
+    ("ym2608_flags",   "B"),
+    ("volume_mod",     "B"),
+    (None,             "B"),
+    ("loop_base",      "B"),
+    ("loop_modifier",  "B"),
+    ("gameboy_dmg_clk","L"),
+    ("nes_apu_clk",    "L"),
+    ("multipcm_clk",   "L"),
+    ("upd7759_clk",    "L"),
+    ("okim6258_clk",   "L"),
+    ("okim6258_flags", "B"),
+    ("k054539_flags",  "B"),
+    ("c140_chip_type", "B"),
+    (None,             "B"),
+    ("okim6295_clk",   "L"),
+    ("k051649_clk",    "L"),
+    ("k054539_clk",    "L"),
+    ("huc6280_clk",    "L"),
+    ("c140_clk",       "L"),
+    ("k053260_clk",    "L"),
+    ("pokey_clk",      "L"),
+    ("qsound_clk",     "L"),
+]
+_HEADER        = struct.Struct("<" + "".join(fmt if name else "x" for name, fmt in _HEADER_FIELDS))
+_HEADER_NAMES  = [name for name, _ in _HEADER_FIELDS if name]
+# the extended header starts here, the part of it behind the data offset is zero
+_EXTENDED_HEADER = 0x40
+# the header is read in one piece of this size
+HEADER_SIZE      = 0x100
 
-    def _read(self, fmt):
-        return struct.unpack(fmt, self._input.read(struct.calcsize(fmt)))
+# chip name -> header field with the clock of the chip
+_CHIP_CLOCKS = [
+    ("SN76489",     "sn76489_clk"),
+    ("YM2413",      "ym2413_clk"),
+    ("YM2612",      "ym2612_clk"),
+    ("YM2151",      "ym2151_clk"),
+    ("Sega PCM",    "sega_pcm_clk"),
+    ("RF5C68",      "rf5c68_clk"),
+    ("YM2203",      "ym2203_clk"),
+    ("YM2608",      "ym2608_clk"),
+    ("YM2610/B",    "ym2610_clk"),
+    ("YM3812",      "ym3812_clk"),
+    ("YM3526",      "ym3526_clk"),
+    ("Y8950",       "y8950_clk"),
+    ("YMF262",      "ymf262_clk"),
+    ("YMF278B",     "ymf278b_clk"),
+    ("YMF271",      "ymf271_clk"),
+    ("YMZ280B",     "ymz280b_clk"),
+    ("RF5C164",     "rf5c164_clk"),
+    ("PWM",         "pwm_clk"),
+    ("AY8910",      "ay8910_clk"),
+    ("GameBoy DMG", "gameboy_dmg_clk"),
+    ("NES APU",     "nes_apu_clk"),
+    ("MultiPCM",    "multipcm_clk"),
+    ("uPD7759",     "upd7759_clk"),
+    ("OKIM6258",    "okim6258_clk"),
+    ("OKIM6295",    "okim6295_clk"),
+    ("K051649",     "k051649_clk"),
+    ("K054539",     "k054539_clk"),
+    ("HuC6280",     "huc6280_clk"),
+    ("C140",        "c140_clk"),
+    ("K053260",     "k053260_clk"),
+    ("Pokey",       "pokey_clk"),
+    ("QSound",      "qsound_clk"),
+]
 
-    def _read0(self, fmt):
-        return self._read(fmt)[0]
+# strings of the GD3 tag, in file order
+GD3_FIELDS = [
+    "title", "title_jp",
+    "game", "game_jp",
+    "system", "system_jp",
+    "author", "author_jp",
+    "release_date",
+    "converter",
+    "notes",
+]
+_GD3_HEADER = struct.Struct("<4sLL")
 
-    def __init__(self, stream):
-        self._input  = stream
-        self._start  = stream.tell()
 
-        # @ 0x00 (Fixed header)
-        if self._read0("4s") != b"Vgm ":
+class VGMHeader:
+    """ The fields of a VGM file header.
+
+        Only needs the first HEADER_SIZE bytes of the file,
+        which are unpacked in one go. Offsets are converted
+        from relative to absolute file offsets.
+    """
+    def __init__(self, header):
+        header = bytes(header[:HEADER_SIZE])
+        if header[:4] != b"Vgm ":
             raise ValueError("The input is not a VGM file")
-        self.eof_offset    = self._offset() + self._read0("<L")
-        self.version       = self._read0("<L")
-        self.sn76489_clk   = self._read0("<L")
-        self.ym2413_clk    = self._read0("<L")
-        self.gd3_offset    = self._offset() + self._read0("<L")
-        self.total_samples = self._read0("<L")
+        data_offset = 0x34 + (_struct("<L").unpack_from(header, 0x34)[0] or 0x0C)
+        # everything from the data offset on is command data, not header
+        end = max(data_offset, _EXTENDED_HEADER)
+        header = header[:end].ljust(HEADER_SIZE, b"\x00")
+
+        self.__dict__.update(zip(_HEADER_NAMES, _HEADER.unpack_from(header)))
+        del self.ident
+        self.eof_offset   += 0x04
+        self.gd3_offset   += 0x14
+        self.loop_offset  += 0x1C
+        self.data_offset   = data_offset
         self.total_seconds = Fraction(self.total_samples, SAMPLE_RATE)
-        self.loop_offset   = self._offset() + self._read0("<L")
-        self.loop_samples  = self._read0("<L")
         self.loop_seconds  = Fraction(self.loop_samples, SAMPLE_RATE)
-        # if self._version >= 0x1_01:
-        self.rate          = self._read0("<L")
-        # if self._version >= 0x1_10:
-        self.sn76489_fb    = self._read0("<H")
-        self.sn76489_srw   = self._read0("B")
-        self.sn76489_flags = self._read0("B")
-        self.ym2612_clk    = self._read0("<L")
-        self.ym2151_clk    = self._read0("<L")
-        # if self._version >= 0x1_50:
-        self.data_offset   = self._offset() + (self._read0("<L") or 0x0000000C)
-        # if self._version >= 0x1_51:
-        self.sega_pcm_clk  = self._read0("<L")
-        self.sega_pcm_reg  = self._read0("<L")
-
-        # @0 x40 (Extended header)
-        extended_header = self._input.read(self.data_offset - self._offset())
-        extended_header = extended_header.ljust(0x100, b"\x00")
-        data_input, self._input = self._input, io.BytesIO(extended_header)
-
-        self.rf5c68_clk        = self._read0("<L")
-        self.ym2203_clk        = self._read0("<L")
-        self.ym2608_clk        = self._read0("<L")
-        self.ym2610_clk        = self._read0("<L")
-        self.ym3812_clk        = self._read0("<L")
-        self.ym3526_clk        = self._read0("<L")
-        self.y8950_clk         = self._read0("<L")
-        self.ymf262_clk        = self._read0("<L")
-        self.ymf278b_clk       = self._read0("<L")
-        self.ymf271_clk        = self._read0("<L")
-        self.ymz280b_clk       = self._read0("<L")
-        self.rf5c164_clk       = self._read0("<L")
-        self.pwm_clk           = self._read0("<L")
-        self.ay8910_clk        = self._read0("<L")
-        self.ay8910_type       = self._read0("B")
-        self.ay8910_flags      = self._read0("B")
-        self.ym2203_flags      = self._read0("B")
-        self.ym2608_flags      = self._read0("B")
-        self.volume_mod        = self._read0("B")
-        _                      = self._read0("B")
-        self.loop_base         = self._read0("B")
-        self.loop_modifier     = self._read0("B")
-        self.gameboy_dmg_clk   = self._read0("<L")
-        self.nes_apu_clk       = self._read0("<L")
-        self.multipcm_clk      = self._read0("<L")
-        self.upd7759_clk       = self._read0("<L")
-        self.okim6258_clk      = self._read0("<L")
-        self.okim6258_flags    = self._read0("B")
-        self.k054539_flags     = self._read0("B")
-        self.c140_chip_type    = self._read0("B")
-        _                      = self._read0("B")
-        self.okim6295_clk      = self._read0("<L")
-        self.k051649_clk       = self._read0("<L")
-        self.k054539_clk       = self._read0("<L")
-        self.huc6280_clk       = self._read0("<L")
-        self.c140_clk          = self._read0("<L")
-        self.k053260_clk       = self._read0("<L")
-        self.pokey_clk         = self._read0("<L")
-        self.qsound_clk        = self._read0("<L")
-
-        self._input = data_input
+
+    @property
+    def has_gd3(self):
+        # a relative GD3 offset of 0 means there is no tag
+        return self.gd3_offset != 0x14
 
     def chips(self):
-        chips = []
-        if self.sn76489_clk     > 0: chips.append("SN76489")
-        if self.ym2413_clk      > 0: chips.append("YM2413")
-        if self.ym2612_clk      > 0: chips.append("YM2612")
-        if self.ym2151_clk      > 0: chips.append("YM2151")
-        if self.sega_pcm_clk    > 0: chips.append("Sega PCM")
-        if self.rf5c68_clk      > 0: chips.append("RF5C68")
-        if self.ym2203_clk      > 0: chips.append("YM2203")
-        if self.ym2608_clk      > 0: chips.append("YM2608")
-        if self.ym2610_clk      > 0: chips.append("YM2610/B")
-        if self.ym3812_clk      > 0: chips.append("YM3812")
-        if self.ym3526_clk      > 0: chips.append("YM3526")
-        if self.y8950_clk       > 0: chips.append("Y8950")
-        if self.ymf262_clk      > 0: chips.append("YMF262")
-        if self.ymf278b_clk     > 0: chips.append("YMF278B")
-        if self.ymf271_clk      > 0: chips.append("YMF271")
-        if self.ymz280b_clk     > 0: chips.append("YMZ280B")
-        if self.rf5c164_clk     > 0: chips.append("RF5C164")
-        if self.pwm_clk         > 0: chips.append("PWM")
-        if self.ay8910_clk      > 0: chips.append("AY8910")
-        if self.gameboy_dmg_clk > 0: chips.append("GameBoy DMG")
-        if self.nes_apu_clk     > 0: chips.append("NES APU")
-        if self.multipcm_clk    > 0: chips.append("MultiPCM")
-        if self.upd7759_clk     > 0: chips.append("uPD7759")
-        if self.okim6258_clk    > 0: chips.append("OKIM6258")
-        if self.okim6295_clk    > 0: chips.append("OKIM6295")
-        if self.k051649_clk     > 0: chips.append("K051649")
-        if self.k054539_clk     > 0: chips.append("K054539")
-        if self.huc6280_clk     > 0: chips.append("HuC6280")
-        if self.c140_clk        > 0: chips.append("C140")
-        if self.k053260_clk     > 0: chips.append("K053260")
-        if self.pokey_clk       > 0: chips.append("Pokey")
-        if self.qsound_clk      > 0: chips.append("QSound")
-        return chips
-
-    async def parse_data(self, player):
+        return [chip for chip, clock in _CHIP_CLOCKS if getattr(self, clock) > 0]
+
+    def clocks(self):
+        """ chip name -> clock in Hz, the top bits of the clock fields hold chip flags """
+        return {chip: getattr(self, clock) & 0x3fffffff
+                for chip, clock in _CHIP_CLOCKS if getattr(self, clock) > 0}
+
+
+def parse_gd3(buffer, offset=0):
+    """ parses the GD3 tag at offset into a dict with the keys of GD3_FIELDS """
+    ident, version, size = _GD3_HEADER.unpack_from(buffer, offset)
+    if ident != b"Gd3 ":
+        raise ValueError("no GD3 tag at offset {:#x}".format(offset))
+    start   = offset + _GD3_HEADER.size
+    strings = bytes(buffer[start:start + size]).decode("utf-16-le", errors="replace").split("\0")
+    strings += [""] * (len(GD3_FIELDS) - len(strings))
+    return dict(zip(GD3_FIELDS, strings))
+
+
+def read_header(file):
+    """ reads the header and GD3 tag of an open VGM file,
+        without reading the command data in between.
+        Returns the VGMHeader and the GD3 dict, which is empty without a tag """
+    if file.name.endswith(".vgz") or file.name.endswith(".gz"):
+        # the tag is at the end, so compressed files have to be decompressed completely anyway
+        file.seek(-4, io.SEEK_END)
+        size = _struct("<L").unpack(file.read(4))[0]
+        file.seek(0)
+        if size <= VGMStreamReader.SPILL_THRESHOLD:
+            file = io.BytesIO(gzip.decompress(file.read()))
+        else:
+            # seeking forward decompresses, but does not keep the data
+            file = gzip.GzipFile(fileobj=file)
+    header = VGMHeader(file.read(HEADER_SIZE))
+    tags = {}
+    if header.has_gd3:
+        file.seek(header.gd3_offset)
+        ident, version, size = _GD3_HEADER.unpack(file.read(_GD3_HEADER.size))
+        tags = parse_gd3(_GD3_HEADER.pack(ident, version, size) + file.read(size))
+    return header, tags
+
+
+class VGMStreamReader(VGMHeader):
+    # compressed files which are larger than this when decompressed
+    # are decompressed into a memory mapped temporary file
+    SPILL_THRESHOLD = 64 * 1024 * 1024
+
+    @classmethod
+    def from_file(cls, file):
+        if file.name.endswith(".vgz") or file.name.endswith(".gz"):
+            # the gzip trailer holds the uncompressed size (modulo 2^32)
+            file.seek(-4, io.SEEK_END)
+            size = _struct("<L").unpack(file.read(4))[0]
+            file.seek(0)
+            if size <= cls.SPILL_THRESHOLD:
+                # decompress once up front, the parser then works on the whole buffer
+                return cls(gzip.decompress(file.read()))
+
+            spill = tempfile.TemporaryFile()
+            with gzip.GzipFile(fileobj=file) as decompressed:
+                shutil.copyfileobj(decompressed, spill, 1 << 20)
+            spill.flush()
+            reader = cls(mmap.mmap(spill.fileno(), 0, access=mmap.ACCESS_READ))
+            reader._spill = spill
+            return reader
+        else:
+            return cls(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def __init__(self, stream):
+        # accepts either a file like object, which is read completely,
+        # or a buffer (bytes, mmap) holding the whole VGM file
+        if not isinstance(stream, (bytes, bytearray, memoryview, mmap.mmap)):
+            stream = stream.read()
+        super().__init__(stream)
+        self._buffer = stream
+        self._pos    = self.data_offset
+
+        # data banks of DAC stream data, by block type
+        self._banks       = {}
+        self._bank_blocks = set()
+        self._streams     = _DACStreams(self._banks)
+
+    def gd3(self):
+        """ the GD3 tag of the file, as dict with the keys of GD3_FIELDS """
+        return parse_gd3(self._buffer, self.gd3_offset) if self.has_gd3 else {}
+
+    def tell(self):
+        """ offset of the next command to be parsed """
+        return self._pos
+
+    def seek(self, offset):
+        """ continue parsing at the command at offset, which has to be the start of a command """
+        self._pos = offset
+
+    def stream_state(self):
+        """ a snapshot of the DAC stream playback state, see restore_stream_state.
+            The data banks are shared, they only grow while parsing """
+        return copy.deepcopy(self._streams, {id(self._banks): self._banks})
+
+    def restore_stream_state(self, state=None):
+        """ continues the DAC streams from a stream_state snapshot,
+            or with all streams stopped and unconfigured if state is None """
+        if state is None:
+            self._streams = _DACStreams(self._banks)
+        else:
+            self._streams = copy.deepcopy(state, {id(self._banks): self._banks})
+
+    def iter_commands(self, start, stop):
+        """ yields offset and opcode of the commands from start up to stop,
+            without decoding them. start has to be the start of a command """
+        buffer = self._buffer
+        offset = start
+        while offset < stop:
+            command = buffer[offset]
+            kind, length, arg = _DISPATCH[command]
+            if kind == _UNKNOWN:
+                raise NotImplementedError("Unknown VGM command {:#04x} at stream offset {}"
+                                          .format(command, offset))
+            yield offset, command
+            if kind == EVENT_DATA_BLOCK:
+                # 0x66, type and a 32 bit size precede the block data
+                length = 6 + _struct("<L").unpack_from(buffer, offset + 3)[0]
+            offset += 1 + length
+
+    def iter_events(self, batch=4096, *, loops=0, as_array=False):
+        """ decodes the commands into lists of at least batch events, up to the end
+            of the data. See the EVENT_* constants for the layout of the events.
+            A batch is complete at the first wait after batch events, so batches
+            never end within a run of writes. If the song has a loop, it is repeated
+            loops more times, or forever if loops is None. With as_array the batches
+            are NumPy record arrays of EVENT_BATCH_DTYPE instead of lists of tuples """
+        if as_array:
+            yield from self._iter_event_arrays(batch, loops)
+            return
+
+        buffer   = self._buffer
+        offset   = self._pos
+        dispatch = _DISPATCH
+        streams  = self._streams
+        time     = 0
+        events   = []
+        append   = events.append
         while True:
-            command = self._read0("B")
-            if command == 0x50:
-                await player.sn76489_write(self._read0("B"))
-            elif command == 0x52:
-                await player.ym2612_write(0,*self._read("BB"))
-            elif command == 0x53:
-                await player.ym2612_write(1, *self._read("BB"))
-            elif command == 0x54:
-                await player.ym2151_write(*self._read("BB"))
-            elif command == 0x5A:
-                await player.ym3812_write(*self._read("BB"))
-            elif command == 0x5B:
-                await player.ym3526_write(*self._read("BB"))
-            elif command in (0x5E, 0x5F):
-                address, data = self._read("BB")
-                await player.ymf262_write(address|((command & 1) << 8), data)
-            elif command == 0x61:
-                samples = self._read0("<H")
-                await player.wait_seconds(Fraction(samples, SAMPLE_RATE))
-            elif command == 0x62:
-                samples = 735
-                await player.wait_seconds(Fraction(samples, SAMPLE_RATE))
-            elif command == 0x63:
-                samples = 882
-                await player.wait_seconds(Fraction(samples, SAMPLE_RATE))
-            elif command == 0x66:
-                break
-            elif command == 0x67:
-                b = self._read("B")
-                if b == 0x66:
-                    print(f"second byte should be 0x66 in a data block, but was: {b:02x}")
-                compression_type = self._read0("B")
-                size = self._read0("I")
-                print(f"======================== got data block of type 0x{compression_type:02x}  and size {size} ======================== ")
-                if compression_type & 0b11000000 == 0x80:
-                    datasize = self._read0("I")
-                    address = self._read0("I")
-                    print(f"ROM/RAM Image dump at address: 0x{address:08x} size: 0x{datasize:08x}")
-                    size -= 8
-                data = ""
-                for i in range(size):
-                    databyte = self._read0("B")
-                    data += f"{databyte:02x} "
-                    if i % 16 == 15:
-                        data +="\n"
-                print(data)
-            elif command in range(0x70, 0x80):
-                samples = (command & 0xf) + 1
-                await player.wait_seconds(Fraction(samples, SAMPLE_RATE))
-            elif command == 0xc0:
-                addr_lsb = self._read0("B")
-                addr_msb = self._read0("B")
-                addr = addr_msb << 8 | addr_lsb
-                databyte = self._read0("B")
+            command = buffer[offset]
+            kind, length, arg = dispatch[command]
+            operands = offset + 1
+            offset   = operands + length
+
+            # most frequent commands first
+            if kind == EVENT_YM2151:
+                append((time, EVENT_YM2151, buffer[operands], buffer[operands + 1], 0))
+            elif kind == EVENT_WAIT or kind == _WAIT_N:
+                samples = arg if kind == EVENT_WAIT else buffer[operands] | (buffer[operands + 1] << 8)
+                if streams.active:
+                    streams.wait(append, time, samples, offset)
+                else:
+                    append((time, EVENT_WAIT, samples, offset, 0))
+                time += samples
+                if len(events) >= batch:
+                    self._pos = offset
+                    yield events
+                    events = []
+                    append = events.append
+            elif kind == EVENT_SN76489:
+                append((time, EVENT_SN76489, buffer[operands], 0, 0))
+            elif kind == EVENT_YM2612:
+                append((time, EVENT_YM2612, arg, buffer[operands], buffer[operands + 1]))
+            elif kind == EVENT_YM3812 or kind == EVENT_YM3526:
+                append((time, kind, buffer[operands], buffer[operands + 1], 0))
+            elif kind == EVENT_YMF262:
+                append((time, EVENT_YMF262, buffer[operands] | arg, buffer[operands + 1], 0))
+            elif kind == _END:
+                if loops == 0 or self.loop_samples == 0:
+                    # stay at the end command, so parsing on from here ends right away
+                    offset = operands - 1
+                    break
+                if loops is not None:
+                    loops -= 1
+                offset = self.loop_offset
+            elif kind == EVENT_DATA_BLOCK:
+                block_type, start, size = self._parse_data_block(operands)
+                append((time, EVENT_DATA_BLOCK, block_type, start, size))
+                offset = start + size
+            elif kind == _SEGA_PCM:
+                addr = buffer[operands + 1] << 8 | buffer[operands]
+                databyte = buffer[operands + 2]
                 print(f"SEGA PCM write to {addr:04x}: {databyte:02x}")
-            elif command == 0x90:
-                stream_id = self._read0("B")
-                chip_type = self._read0("B")
-                register  = self._read0("B")
-                port      = self._read0("B")
-                print(f"Setup Stream Control stream_id: {stream_id:02x} chip type {chip_type:02x} port {port:02x} register {register:02x}")
-            elif command == 0x91:
-                stream_id = self._read0("B")
-                bank_id   = self._read0("B")
-                step_size = self._read0("B")
-                step_base = self._read0("B")
-                print(f"Set Stream Data stream_id: {stream_id:02x} bank {bank_id:02x} step size {step_size:02x} base {step_base:02x}")
-            elif command == 0x92:
-                stream_id = self._read0("B")
-                freq = self._read0("I")
-                print(f"Set Stream Frequency stream_id: {stream_id:02x} freq: {freq}")
-            elif command == 0x95:
-                stream_id = self._read0("B")
-                block_id = self._read0("H")
-                flags = self._read0("B")
-                print(f"Start Stream stream_id: {stream_id:02x}, block id {block_id:04x}, flags {flags:02x}")
-            elif command == 0x94:
-                stream_id = self._read0("B")
-                print(f"Stop Stream stream_id: {stream_id:02x}")
+            elif kind == _STREAM:
+                streams.command(command, buffer, operands)
             else:
+                # hand out what has been decoded up to here first
+                self._pos = operands - 1
+                if events:
+                    yield events
                 raise NotImplementedError("Unknown VGM command {:#04x} at stream offset {}"
-                                          .format(command, self._input.tell() - 1))
+                                          .format(command, operands - 1))
+
+        self._pos = offset
+        if events:
+            yield events
+
+    def _iter_event_arrays(self, batch, loops):
+        """ iter_events with as_array. Each pass through the data is decoded
+            with NumPy as a whole, without building the event tuples """
+        import numpy as np
+        first = self._decode_pass(self._pos)
+        loop  = None
+        if loops != 0 and self.loop_samples != 0 and first[3] is None:
+            loop = self._decode_pass(self.loop_offset)
+        if first[0] is None or (loop is not None and loop[0] is None) or self._streams.active:
+            # DAC streams turn waits into writes from their state, decode command by command
+            for events in self.iter_events(batch, loops=loops):
+                yield np.array(events, dtype=EVENT_BATCH_DTYPE)
+            return
+
+        def iter_passes():
+            yield first
+            if loop is None:
+                return
+            repeats = loops
+            while repeats is None or repeats > 0:
+                yield loop
+                if repeats is not None:
+                    repeats -= 1
+
+        time    = 0
+        pending = first[0][:0]
+        for events, samples, end, error in iter_passes():
+            if time:
+                events = events.copy()
+                events["time"] += time
+            time += samples
+            if len(pending):
+                events = np.concatenate((pending, events))
+
+            # like the tuple path, a batch is complete at the first wait after batch events
+            waits = np.flatnonzero(events["kind"] == EVENT_WAIT)
+            start = 0
+            while True:
+                i = np.searchsorted(waits, start + batch - 1)
+                if i == len(waits):
+                    break
+                stop = waits[i] + 1
+                self._pos = int(events["b"][stop - 1])
+                yield events[start:stop]
+                start = stop
+            pending = events[start:]
+            self._pos = end
+
+            if error is not None:
+                if len(pending):
+                    yield pending
+                raise NotImplementedError("Unknown VGM command {:#04x} at stream offset {}"
+                                          .format(error, end))
+        if len(pending):
+            yield pending
+
+    def _decode_pass(self, start):
+        """ decodes the commands from start up to the end command into an array of
+            EVENT_BATCH_DTYPE. Returns the events, their duration in samples, the offset
+            of the last command and the unknown opcode found there, or None instead of
+            the events if the commands control DAC streams """
+        import numpy as np
+        lengths, kinds, args = _dispatch_arrays()
+        buffer   = self._buffer
+        data     = np.frombuffer(buffer, dtype=np.uint8)[start:]
+        size     = len(data)
+
+        # offset of the following command, for every byte a command might start at.
+        # The end command and unknown commands point to themselves, anything past
+        # the end of the data to the sentinel at size
+        jump     = np.arange(size, dtype=np.int64) + lengths[data]
+        blocks   = np.flatnonzero(data == 0x67)
+        blocks   = blocks[blocks + 7 <= size]
+        block_sizes = data[blocks + 3].astype(np.int64)
+        for shift, operand in ((8, 4), (16, 5), (24, 6)):
+            block_sizes |= data[blocks + operand].astype(np.int64) << shift
+        # 0x67 0x66, type and a 32 bit size precede the block data
+        jump[blocks] += 7 + block_sizes
+        jump     = np.append(np.minimum(jump, size), size)
+
+        # mark the commands reached from start by pointer doubling, after
+        # round n all commands up to 2**n steps away from start are known
+        reached = np.zeros(size + 1, dtype=bool)
+        reached[0] = True
+        commands = np.zeros(1, dtype=np.int64)
+        while True:
+            following = jump[commands]
+            if reached[following].all():
+                break
+            reached[following] = True
+            commands = np.flatnonzero(reached)
+            jump = jump[jump]
+
+        last     = commands[-1]
+        commands = commands[:-1]
+        if last == size:
+            # the data ran out without an end command
+            last, error = size - 1, None
+        else:
+            error = None if data[last] == 0x66 else int(data[last])
+        opcodes  = data[commands]
+        if ((opcodes >= 0x90) & (opcodes <= 0x95)).any():
+            return None, 0, start + last, error
+
+        padded   = np.append(data, np.zeros(2, dtype=np.uint8))
+        operand1 = padded[commands + 1].astype(np.uint32)
+        operand2 = padded[commands + 2].astype(np.uint32)
+        kind     = kinds[opcodes]
+        arg      = args[opcodes]
+        after    = start + commands + lengths[opcodes]
+
+        samples  = np.where(kind == EVENT_WAIT, arg, 0)
+        wait_n   = kind == _WAIT_N
+        samples[wait_n] = operand1[wait_n] | (operand2[wait_n] << 8)
+        kind[wait_n] = EVENT_WAIT
+        time     = np.cumsum(samples, dtype=np.uint64)
+        duration = int(time[-1]) if len(time) else 0
+        time    -= samples
+
+        for i in np.flatnonzero(opcodes == 0xC0):
+            operands = start + commands[i] + 1
+            addr = buffer[operands + 1] << 8 | buffer[operands]
+            print(f"SEGA PCM write to {addr:04x}: {buffer[operands + 2]:02x}")
+
+        keep     = kind <= EVENT_DATA_BLOCK
+        kind     = kind[keep]
+        events   = np.zeros(len(kind), dtype=EVENT_BATCH_DTYPE)
+        events["time"] = time[keep]
+        events["kind"] = kind
+        operand1 = operand1[keep]
+        operand2 = operand2[keep]
+        arg      = arg[keep]
+        events["a"] = np.select([kind == EVENT_WAIT, kind == EVENT_YM2612],
+                                [samples[keep], arg], operand1 | arg)
+        events["b"] = np.select([kind == EVENT_WAIT, kind == EVENT_YM2612, kind == EVENT_SN76489],
+                                [after[keep], operand1, 0], operand2)
+        events["c"] = np.where(kind == EVENT_YM2612, operand2, 0)
+
+        commands = commands[keep]
+        for i in np.flatnonzero(kind == EVENT_DATA_BLOCK):
+            block_type, block_start, block_size = self._parse_data_block(start + int(commands[i]) + 1)
+            events["a"][i] = block_type
+            events["b"][i] = block_start
+            events["c"][i] = block_size
+        return events, duration, start + last, error
+
+    async def play_events(self, player, batches):
+        """ feeds batches of events, as yielded by iter_events, into the player """
+        buffer         = memoryview(self._buffer)
+        ym2151_write   = player.ym2151_write
+        wait_samples   = player.wait_samples
+        sn76489_write  = player.sn76489_write
+        ym2612_write   = player.ym2612_write
+        for events in batches:
+            for time, kind, a, b, c in events:
+                if kind == EVENT_YM2151:
+                    await ym2151_write(a, b)
+                elif kind == EVENT_WAIT:
+                    await wait_samples(a)
+                elif kind == EVENT_SN76489:
+                    await sn76489_write(a)
+                elif kind == EVENT_YM2612:
+                    await ym2612_write(a, b, c)
+                elif kind == EVENT_YM3812:
+                    await player.ym3812_write(a, b)
+                elif kind == EVENT_YM3526:
+                    await player.ym3526_write(a, b)
+                elif kind == EVENT_YMF262:
+                    await player.ymf262_write(a, b)
+                elif kind == EVENT_DATA_BLOCK:
+                    # a view into the file buffer, the block data is never copied
+                    await player.data_block(a, buffer[b:b + c])
+
+    async def parse_data(self, player, *, loops=0, batch=256):
+        """ feeds the commands into the player, up to the end of the data.
+            If the song has a loop, it is repeated loops more times,
+            or forever if loops is None """
+        await self.play_events(player, self.iter_events(batch, loops=loops))
+
+    def _parse_data_block(self, offset):
+        """ returns type, start offset and size of the data block at offset """
+        buffer = self._buffer
+        if buffer[offset] != 0x66:
+            print(f"second byte should be 0x66 in a data block, but was: {buffer[offset]:02x}")
+        block_type = buffer[offset + 1]
+        size  = _struct("<L").unpack_from(buffer, offset + 2)[0]
+        start = offset + 6
+        if block_type < 0x40 and start not in self._bank_blocks:
+            # uncompressed stream data, blocks of the same type form a data bank.
+            # Blocks are only added once, when looping or seeking parses them again
+            self._bank_blocks.add(start)
+            self._banks.setdefault(block_type, _DataBank()).add(memoryview(buffer)[start:start + size])
+        return block_type, start, size
+
+
+class _DataBank:
+    """ concatenation of the data blocks of one type, kept as views into the file buffer """
+    def __init__(self):
+        self.blocks = []
+        self.starts = []
+        self.size   = 0
+
+    def add(self, block):
+        self.starts.append(self.size)
+        self.blocks.append(block)
+        self.size += len(block)
+
+    def __getitem__(self, position):
+        i = bisect.bisect_right(self.starts, position) - 1
+        return self.blocks[i][position - self.starts[i]]
+
+
+class _DACStream:
+    def __init__(self):
+        # set up by 0x90
+        self.chip_type = 0
+        self.port      = 0
+        self.register  = 0
+        # set up by 0x91
+        self.bank_id   = None
+        self.step_size = 1
+        self.step_base = 0
+        # set up by 0x92
+        self.frequency = 0
+        # set up by 0x93, 0x95
+        self.start     = 0
+        self.commands  = 0
+        self.loop      = False
+        # playback state: index of the next command, and when it is due
+        self.index     = 0
+        self.timebase  = 0
+        self.timebase_index = 0
+        self.due       = 0
+
+
+class _DACStreams:
+    """ Expands the DAC stream control commands 0x90-0x95 into timed chip writes.
+
+        Running streams write the next byte of their data bank to the
+        configured chip register at their frequency. The writes are
+        interleaved with the waits of the command stream.
+    """
+    def __init__(self, banks):
+        self.banks   = banks
+        self.streams = {}
+        # running streams
+        self.active  = []
+        # stream time in samples, it only needs to advance while streams are running
+        self.now     = 0
+
+    def _stream(self, stream_id):
+        try:
+            return self.streams[stream_id]
+        except KeyError:
+            stream = self.streams[stream_id] = _DACStream()
+            return stream
+
+    def _schedule(self, stream):
+        stream.due = stream.timebase + \
+            (stream.index - stream.timebase_index) * SAMPLE_RATE // stream.frequency
+
+    def _start(self, stream, start, commands, loop):
+        bank = self.banks.get(stream.bank_id)
+        if bank is None or stream.frequency == 0:
+            self._stop(stream)
+            return
+        stream.start    = start
+        stream.commands = commands
+        stream.loop     = loop
+        stream.index    = 0
+        stream.timebase = self.now
+        stream.timebase_index = 0
+        self._schedule(stream)
+        if stream not in self.active:
+            self.active.append(stream)
+
+    def _stop(self, stream):
+        if stream in self.active:
+            self.active.remove(stream)
+
+    def _bank_commands(self, stream, length):
+        """ number of commands in length bytes of stream data """
+        return max(0, (length - stream.step_base + stream.step_size - 1) // stream.step_size)
+
+    def command(self, command, buffer, offset):
+        stream = self._stream(buffer[offset])
+
+        if command == 0x90:
+            stream.chip_type, stream.port, stream.register = buffer[offset + 1:offset + 4]
+
+        elif command == 0x91:
+            stream.bank_id, step_size, stream.step_base = buffer[offset + 1:offset + 4]
+            stream.step_size = step_size or 1
+
+        elif command == 0x92:
+            stream.frequency = _struct("<L").unpack_from(buffer, offset + 1)[0]
+            if stream in self.active:
+                if stream.frequency == 0:
+                    self._stop(stream)
+                else:
+                    stream.timebase = self.now
+                    stream.timebase_index = stream.index
+                    self._schedule(stream)
+
+        elif command == 0x93:
+            start, mode, length = _struct("<LBL").unpack_from(buffer, offset + 1)
+            bank = self.banks.get(stream.bank_id)
+            if start == 0xffffffff:
+                start = stream.start
+            if mode & 0x0f == 1:
+                commands = length
+            elif mode & 0x0f == 2:
+                # length in milliseconds
+                commands = length * stream.frequency // 1000
+            elif mode & 0x0f == 3 and bank is not None:
+                # until the end of the bank
+                commands = self._bank_commands(stream, bank.size - start)
+            else:
+                commands = stream.commands
+            self._start(stream, start, commands, loop=bool(mode & 0x80))
+
+        elif command == 0x94:
+            if buffer[offset] == 0xff:
+                self.active = []
+            else:
+                self._stop(stream)
+
+        elif command == 0x95:
+            block_id, flags = _struct("<HB").unpack_from(buffer, offset + 1)
+            bank = self.banks.get(stream.bank_id)
+            if bank is None or block_id >= len(bank.blocks):
+                self._stop(stream)
+                return
+            commands = self._bank_commands(stream, len(bank.blocks[block_id]))
+            self._start(stream, bank.starts[block_id], commands, loop=bool(flags & 0x01))
+
+    def _write(self, append, time, stream):
+        bank = self.banks[stream.bank_id]
+        position = stream.start + stream.step_base + stream.index * stream.step_size
+        if position < bank.size:
+            data = bank[position]
+            chip = stream.chip_type & 0x7f
+            if chip == 0x00:
+                append((time, EVENT_SN76489, data, 0, 0))
+            elif chip == 0x02:
+                append((time, EVENT_YM2612, stream.port, stream.register, data))
+            elif chip == 0x03:
+                append((time, EVENT_YM2151, stream.register, data, 0))
+
+        stream.index += 1
+        if stream.index >= stream.commands or position >= bank.size:
+            if stream.loop and stream.commands > 0:
+                # the first command of the next round is due one period after this one
+                stream.index = 0
+                stream.timebase = stream.due
+                stream.timebase_index = -1
+            else:
+                self._stop(stream)
+                return
+        self._schedule(stream)
+
+    def wait(self, append, time, samples, offset):
+        """ appends the wait events for samples, starting at the event time time,
+            with the stream writes which are due in between """
+        # event time of the stream time 0
+        base = time - self.now
+        end  = self.now + samples
+        while self.active:
+            stream = min(self.active, key=lambda stream: stream.due)
+            if stream.due >= end:
+                break
+            if stream.due > self.now:
+                append((base + self.now, EVENT_WAIT, stream.due - self.now, offset, 0))
+                self.now = stream.due
+            self._write(append, base + self.now, stream)
+
+        if end > self.now:
+            append((base + self.now, EVENT_WAIT, end - self.now, offset, 0))
+        self.now = end
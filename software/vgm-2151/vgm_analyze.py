@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+import os
+import csv
+import sys
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import vgm
+
+# upper bounds of the buckets of the writes per wait histogram
+BURST_BUCKETS = [1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024]
+SAMPLES_PER_MS = vgm.SAMPLE_RATE // 1000
+
+
+def burst_bucket_name(index):
+    if index == len(BURST_BUCKETS):
+        return f"burst_gt{BURST_BUCKETS[-1]}"
+    return f"burst_le{BURST_BUCKETS[index]}"
+
+COLUMNS = (["path", "error", "chips", "seconds", "loop_seconds", "ym2151_writes",
+            "max_burst", "peak_writes_per_ms"]
+           + [burst_bucket_name(i) for i in range(len(BURST_BUCKETS) + 1)]
+           + [f"reg_{address:02x}" for address in range(256)])
+
+
+def write_statistics(events):
+    """ YM2151 write statistics of the decoded events of a whole song """
+    is_write = events["kind"] == vgm.EVENT_YM2151
+    is_wait  = events["kind"] == vgm.EVENT_WAIT
+    writes   = events[is_write]
+    times    = writes["time"].astype(np.int64)
+
+    registers = np.bincount(writes["a"], minlength=256)
+
+    # number of writes between two waits
+    burst_ids = np.cumsum(is_wait)[is_write]
+    bursts    = np.bincount(burst_ids) if len(burst_ids) else np.zeros(0, dtype=np.int64)
+    bursts    = bursts[bursts > 0]
+    buckets   = np.bincount(np.searchsorted(BURST_BUCKETS, bursts, side="left"),
+                            minlength=len(BURST_BUCKETS) + 1)
+
+    # writes in the 1ms window which ends at each write
+    window_start = np.searchsorted(times, times - SAMPLES_PER_MS, side="right")
+    per_ms = np.arange(len(times)) - window_start + 1
+
+    return dict(registers=registers,
+                bursts=buckets,
+                max_burst=int(bursts.max(initial=0)),
+                peak_per_ms=int(per_ms.max(initial=0)))
+
+
+def analyze_file(path):
+    row = dict.fromkeys(COLUMNS, 0)
+    row.update(path=path, error="", chips="")
+    try:
+        with open(path, "rb") as file:
+            reader = vgm.VGMStreamReader.from_file(file)
+        row.update(chips="+".join(reader.chips()),
+                   seconds=float(reader.total_seconds),
+                   loop_seconds=float(reader.loop_seconds))
+
+        batches = list(reader.iter_events(1 << 16, as_array=True))
+        events  = np.concatenate(batches) if batches else np.empty(0, dtype=vgm.EVENT_BATCH_DTYPE)
+        stats   = write_statistics(events)
+    except Exception as e:
+        row["error"] = f"{type(e).__name__}: {e}"
+        return row
+
+    row.update(ym2151_writes=int(stats["registers"].sum()),
+               max_burst=stats["max_burst"],
+               peak_writes_per_ms=stats["peak_per_ms"])
+    for i, count in enumerate(stats["bursts"]):
+        row[burst_bucket_name(i)] = int(count)
+    for address, count in enumerate(stats["registers"]):
+        row[f"reg_{address:02x}"] = int(count)
+    return row
+
+
+def find_vgm_files(root):
+    for directory, _, files in os.walk(root):
+        for name in sorted(files):
+            if name.endswith((".vgm", ".vgz")):
+                yield os.path.join(directory, name)
+
+
+def write_table(rows, output):
+    if output.endswith(".parquet"):
+        import pyarrow
+        import pyarrow.parquet
+        table = pyarrow.Table.from_pylist(rows)
+        pyarrow.parquet.write_table(table, output)
+    else:
+        with open(output, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=COLUMNS)
+            writer.writeheader()
+            writer.writerows(rows)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="collect YM2151 write statistics of a tree of VGM files")
+    parser.add_argument("directory")
+    parser.add_argument("-o", "--output", default="vgm-stats.csv", help="output table, .csv or .parquet")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="number of worker processes")
+    args = parser.parse_args()
+
+    paths = list(find_vgm_files(args.directory))
+    rows  = []
+    with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        futures = [executor.submit(analyze_file, path) for path in paths]
+        for n, future in enumerate(as_completed(futures), 1):
+            rows.append(future.result())
+            print(f"\r{n}/{len(paths)}", end="", file=sys.stderr)
+    print(file=sys.stderr)
+
+    rows.sort(key=lambda row: row["path"])
+    write_table(rows, args.output)
+
+    worst = max(rows, key=lambda row: row["max_burst"], default=None)
+    if worst:
+        print(f"largest burst: {worst['max_burst']} writes in {worst['path']}, "
+              f"peak {max(row['peak_writes_per_ms'] for row in rows)} writes per ms")
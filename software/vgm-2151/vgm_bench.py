@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+import io
+import os
+import sys
+import time
+import gzip
+import struct
+import asyncio
+import contextlib
+from fractions import Fraction
+import vgm
+from vgm_dump import VGMDumper
+
+class CountingPlayer(vgm.VGMStreamPlayer):
+    """ consumes all commands without doing anything, to measure pure parsing speed """
+    def __init__(self):
+        self.commands = 0
+
+    async def sn76489_write(self, data):
+        self.commands += 1
+
+    async def ym2612_write(self, port, address, data):
+        self.commands += 1
+
+    async def ym2151_write(self, address, data):
+        self.commands += 1
+
+    async def ym3526_write(self, address, data):
+        self.commands += 1
+
+    async def ym3812_write(self, address, data):
+        self.commands += 1
+
+    async def ymf262_write(self, address, data):
+        self.commands += 1
+
+    async def wait_seconds(self, duration):
+        self.commands += 1
+
+    async def wait_samples(self, samples):
+        self.commands += 1
+
+class BaselineReader:
+    """ the command loop of VGMStreamReader before it became table driven,
+        reading each operand with struct.unpack from a file like stream """
+    def __init__(self, data):
+        self._input = io.BytesIO(data)
+        self._input.seek(vgm.VGMStreamReader(data).data_offset)
+
+    def _read(self, fmt):
+        return struct.unpack(fmt, self._input.read(struct.calcsize(fmt)))
+
+    def _read0(self, fmt):
+        return self._read(fmt)[0]
+
+    async def parse_data(self, player):
+        SAMPLE_RATE = vgm.SAMPLE_RATE
+        while True:
+            command = self._read0("B")
+            if command == 0x50:
+                await player.sn76489_write(self._read0("B"))
+            elif command == 0x52:
+                await player.ym2612_write(0,*self._read("BB"))
+            elif command == 0x53:
+                await player.ym2612_write(1, *self._read("BB"))
+            elif command == 0x54:
+                await player.ym2151_write(*self._read("BB"))
+            elif command == 0x5A:
+                await player.ym3812_write(*self._read("BB"))
+            elif command == 0x5B:
+                await player.ym3526_write(*self._read("BB"))
+            elif command in (0x5E, 0x5F):
+                address, data = self._read("BB")
+                await player.ymf262_write(address|((command & 1) << 8), data)
+            elif command == 0x61:
+                samples = self._read0("<H")
+                await player.wait_seconds(Fraction(samples, SAMPLE_RATE))
+            elif command == 0x62:
+                samples = 735
+                await player.wait_seconds(Fraction(samples, SAMPLE_RATE))
+            elif command == 0x63:
+                samples = 882
+                await player.wait_seconds(Fraction(samples, SAMPLE_RATE))
+            elif command == 0x66:
+                break
+            elif command == 0x67:
+                b = self._read("B")
+                compression_type = self._read0("B")
+                size = self._read0("I")
+                print(f"======================== got data block of type 0x{compression_type:02x}  and size {size} ======================== ")
+                if compression_type & 0b11000000 == 0x80:
+                    datasize = self._read0("I")
+                    address = self._read0("I")
+                    print(f"ROM/RAM Image dump at address: 0x{address:08x} size: 0x{datasize:08x}")
+                    size -= 8
+                data = ""
+                for i in range(size):
+                    databyte = self._read0("B")
+                    data += f"{databyte:02x} "
+                    if i % 16 == 15:
+                        data +="\n"
+                print(data)
+            elif command in range(0x70, 0x80):
+                samples = (command & 0xf) + 1
+                await player.wait_seconds(Fraction(samples, SAMPLE_RATE))
+            elif command == 0xc0:
+                addr = self._read0("<H")
+                databyte = self._read0("B")
+                print(f"SEGA PCM write to {addr:04x}: {databyte:02x}")
+            elif command == 0x90:
+                print("Setup Stream Control", *self._read("BBBB"))
+            elif command == 0x91:
+                print("Set Stream Data", *self._read("BBBB"))
+            elif command == 0x92:
+                print("Set Stream Frequency", *self._read("<BI"))
+            elif command == 0x95:
+                print("Start Stream", *self._read("<BHB"))
+            elif command == 0x94:
+                print("Stop Stream", self._read0("B"))
+            else:
+                raise NotImplementedError("Unknown VGM command {:#04x} at stream offset {}"
+                                          .format(command, self._input.tell() - 1))
+
+def bench_parse(data, repeat, reader_class=vgm.VGMStreamReader):
+    commands = 0
+    start = time.perf_counter()
+    for _ in range(repeat):
+        reader = reader_class(data)
+        player = CountingPlayer()
+        asyncio.run(reader.parse_data(player))
+        commands += player.commands
+    elapsed = time.perf_counter() - start
+    return commands, elapsed
+
+def bench_iter(data, repeat, as_array=False):
+    events = 0
+    start = time.perf_counter()
+    for _ in range(repeat):
+        reader = vgm.VGMStreamReader(data)
+        for batch in reader.iter_events(as_array=as_array):
+            events += len(batch)
+    elapsed = time.perf_counter() - start
+    return events, elapsed
+
+def bench_dump(data, repeat, format):
+    commands = bench_parse(data, 1)[0] * repeat
+    start = time.perf_counter()
+    with open(os.devnull, "w") as out:
+        for _ in range(repeat):
+            reader = vgm.VGMStreamReader(data)
+            dumper = VGMDumper(out, format)
+            dumper.dump(reader)
+            dumper.flush()
+    elapsed = time.perf_counter() - start
+    return commands, elapsed
+
+if __name__ == "__main__":
+    arg = sys.argv[1]
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    with open(arg, "rb") as f:
+        data = f.read()
+    if arg.endswith(".vgz"):
+        data = gzip.decompress(data)
+
+    # the baseline prints data blocks and stream commands, which are not part of the timing
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        baseline_commands, baseline_elapsed = bench_parse(data, repeat, BaselineReader)
+    print(f"parse_data (baseline): {baseline_commands} commands in {baseline_elapsed:.3f}s: "
+          f"{baseline_commands / baseline_elapsed:,.0f} commands/s")
+
+    commands, elapsed = bench_parse(data, repeat)
+    print(f"parse_data: {commands} commands in {elapsed:.3f}s: {commands / elapsed:,.0f} commands/s, "
+          f"{(commands / elapsed) / (baseline_commands / baseline_elapsed):.1f}x the baseline")
+
+    for as_array in [False, True]:
+        events, elapsed = bench_iter(data, repeat, as_array)
+        name = "iter_events(as_array)" if as_array else "iter_events"
+        print(f"{name}: {events} events in {elapsed:.3f}s: {events / elapsed:,.0f} events/s")
+
+    for format in ["text", "jsonl", "csv"]:
+        commands, elapsed = bench_dump(data, repeat, format)
+        print(f"dump {format:5}: {commands} commands in {elapsed:.3f}s: {commands / elapsed:,.0f} commands/s")
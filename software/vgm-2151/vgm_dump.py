@@ -1,7 +1,8 @@
 #!/usr/bin/env python3
 import sys
-import gzip
-import asyncio
+import argparse
+import contextlib
+from fractions import Fraction
 import vgm
 
 lfowaves = {
@@ -43,116 +44,332 @@ def channel_env(paramno):
     op = paramno // 8
     return f"ch{channel}-op{opmap[op]}"
 
+#
+# human readable decoders, one per register group
+#
+def decode_key_switch(address, data):
+    channel   = data & 0x7
+    slot_bits = (data >> 3) & 0xf
+    modulator1 =  slot_bits & 0b0001
+    carrier1   = (slot_bits & 0b0010) >> 1
+    modulator2 = (slot_bits & 0b0100) >> 2
+    carrier2   = (slot_bits & 0b1000) >> 3
+    return "KEY SWITCH : CHANNEL {}: CARRIER1: {} MODULATOR1: {} CARRIER2: {} MODULATOR2: {}"\
+                .format(channel, onoff[carrier1], onoff[modulator1], onoff[carrier2], onoff[modulator2])
+
+def decode_test(address, data):
+    if (data == 0x02):
+        return "LFO RESET"
+    elif data == 0:
+        return "LFO RST OFF"
+    else:
+        return "*** TEST MODE: {:02x} ***".format(data)
+
+def decode_lfo_freq(address, data):
+    return f"LFO FREQ   : {data}"
+
+def decode_modulation_depth(address, data):
+    modulation_type = "PM DEPTH" if data & 0b10000000 > 0 else "AM DEPTH"
+    value = data & 0x7f
+    return f"{modulation_type}   : {value}"
+
+def decode_lfo_waveform(address, data):
+    ct = data >> 6
+    wave = data & 0b11
+    return f"LFO WAVEFRM: {lfowaves[wave]} CT: {bin(ct)}"
+
+def decode_key_code(address, data):
+    channel = 0x7 & address
+    note = data & 0xf
+    octave = (data >> 4) & 0x7
+    return "KEY CODE   : CHANNEL {}: OCTAVE: {} NOTE: {}".format(channel, octave, notes.get(note, "?"))
+
+def decode_connection(address, data):
+    operator = address & 0x7
+    rl = bin(data >> 6)
+    feedback = (data >> 3) & 0x7
+    connection = data & 0x7
+    return f"OPERATOR {operator} : CONNECTION: {connection} FEEDBACK: {feedback} RL: {rl}"
+
+def decode_sensitivity(address, data):
+    operator = address & 0b111
+    am_sensitivity = 0x3 & data
+    pm_sensitivity = 0x7 & (data >> 4)
+    return f"OPERATOR {operator} : PM SENSITIVITY: {pm_sensitivity} AM SENSITIVITY: {am_sensitivity}"
+
+def decode_key_fraction(address, data):
+    channel = 0x7 & address
+    fraction = (data >> 2) & 0x3f
+    return "KEY FRAC   : channel {}: fraction: {}".format(channel, fraction)
+
+def decode_phase_generator(address, data):
+    envelope = address & 0x1f
+    detune1 = (data >> 4) & 0x7
+    phase_multiply = data & 0xf
+    return "PHASEGEN {}: DETUNE1: {:02d} PHASE MULTIPLY: {:02d}".format(channel_env(envelope), detune1, phase_multiply)
+
+def decode_total_level(address, data):
+    envelope = address & 0x1f
+    level = data &  0x7f
+    return "ENVELOPE {}: TOTAL LEVEL : {}".format(channel_env(envelope), level)
+
+def decode_attack(address, data):
+    envelope = address & 0x1f
+    keyscaling = data >> 6
+    attack_rate = data & 0b11111
+    result = "ENVELOPE {}: ".format(channel_env(envelope))
+    if attack_rate > 0:
+        result += "ATTACK RATE: {:02d}".format(attack_rate)
+    if keyscaling > 0:
+        result += " KEYSCALING: {:02d}".format(keyscaling)
+    return result
+
+def decode_decay1(address, data):
+    envelope = address & 0x1f
+    first_decay_rate = data & 0b11111
+    am_sensitivity_en = data >> 7
+    result = "ENVELOPE {}: DECAY1 RATE: {:02d}".format(channel_env(envelope), first_decay_rate)
+    result += " AM SENSITIVITY ENABLE: {}".format(am_sensitivity_en)
+    return result
+
+def decode_decay2(address, data):
+    envelope = address & 0x1f
+    detune2 = data >> 6
+    second_decay_rate = data & 0b11111
+    result = "ENVELOPE {}: DECAY2 RATE: {:02d}".format(channel_env(envelope), second_decay_rate)
+    result += " PHASEGEN {}: DETUNE2: {:02d}".format(channel_env(envelope), detune2)
+    return result
+
+def decode_release(address, data):
+    envelope = address & 0x1f
+    release_rate = data & 0xf
+    decay1_level = (data >> 4) & 0xf
+    result = "ENVELOPE {}:".format(channel_env(envelope))
+    if decay1_level > 0:
+        result += " DECAY1 LEVEL: {:02d}".format(decay1_level)
+    if release_rate > 0:
+        result += " RELEASE: {:02d}".format(release_rate)
+    return result
+
+def decode_unknown(address, data):
+    return ""
+
+# address -> human readable decoder
+TEXT_DECODERS = [decode_unknown] * 256
+TEXT_DECODERS[0x01] = decode_test
+TEXT_DECODERS[0x08] = decode_key_switch
+TEXT_DECODERS[0x18] = decode_lfo_freq
+TEXT_DECODERS[0x19] = decode_modulation_depth
+TEXT_DECODERS[0x1b] = decode_lfo_waveform
+for _channel in range(8):
+    TEXT_DECODERS[0x20 + _channel] = decode_connection
+    TEXT_DECODERS[0x28 + _channel] = decode_key_code
+    TEXT_DECODERS[0x30 + _channel] = decode_key_fraction
+    TEXT_DECODERS[0x38 + _channel] = decode_sensitivity
+for _slot in range(32):
+    TEXT_DECODERS[0x40 + _slot] = decode_phase_generator
+    TEXT_DECODERS[0x60 + _slot] = decode_total_level
+    TEXT_DECODERS[0x80 + _slot] = decode_attack
+    TEXT_DECODERS[0xa0 + _slot] = decode_decay1
+    TEXT_DECODERS[0xc0 + _slot] = decode_decay2
+    TEXT_DECODERS[0xe0 + _slot] = decode_release
+
+#
+# machine readable decoding: per address the channel, operator
+# and the (field name, shift, mask) of the bit fields in the data byte
+#
+def _fields(*fields):
+    return tuple(fields)
+
+# address -> (channel, operator, fields)
+FIELD_DECODERS = [(None, None, ())] * 256
+FIELD_DECODERS[0x01] = (None, None, _fields(("lfo_reset", 1, 0x1), ("test", 0, 0xff)))
+# the channel of the key on register is in the data, see decode_fields
+FIELD_DECODERS[0x08] = (None, None, _fields(("key_on_m1", 3, 0x1), ("key_on_c1", 4, 0x1),
+                                            ("key_on_m2", 5, 0x1), ("key_on_c2", 6, 0x1)))
+FIELD_DECODERS[0x0f] = (None, None, _fields(("noise_enable", 7, 0x1), ("noise_freq", 0, 0x1f)))
+FIELD_DECODERS[0x10] = (None, None, _fields(("clka_msb", 0, 0xff),))
+FIELD_DECODERS[0x11] = (None, None, _fields(("clka_lsb", 0, 0x3),))
+FIELD_DECODERS[0x12] = (None, None, _fields(("clkb", 0, 0xff),))
+FIELD_DECODERS[0x14] = (None, None, _fields(("csm", 7, 0x1), ("reset_b", 5, 0x1), ("reset_a", 4, 0x1),
+                                            ("irq_en_b", 3, 0x1), ("irq_en_a", 2, 0x1),
+                                            ("load_b", 1, 0x1), ("load_a", 0, 0x1)))
+FIELD_DECODERS[0x18] = (None, None, _fields(("lfo_freq", 0, 0xff),))
+# 0x19 is AMD or PMD, depending on bit 7, see decode_fields
+FIELD_DECODERS[0x19] = (None, None, _fields(("amd", 0, 0x7f),))
+FIELD_DECODERS[0x1b] = (None, None, _fields(("ct", 6, 0x3), ("lfo_waveform", 0, 0x3)))
+for _channel in range(8):
+    FIELD_DECODERS[0x20 + _channel] = (_channel, None, _fields(("rl", 6, 0x3), ("feedback", 3, 0x7), ("connection", 0, 0x7)))
+    FIELD_DECODERS[0x28 + _channel] = (_channel, None, _fields(("octave", 4, 0x7), ("note", 0, 0xf)))
+    FIELD_DECODERS[0x30 + _channel] = (_channel, None, _fields(("key_fraction", 2, 0x3f),))
+    FIELD_DECODERS[0x38 + _channel] = (_channel, None, _fields(("pms", 4, 0x7), ("ams", 0, 0x3)))
+for _slot in range(32):
+    _channel, _operator = _slot % 8, opmap[_slot // 8]
+    FIELD_DECODERS[0x40 + _slot] = (_channel, _operator, _fields(("dt1", 4, 0x7), ("mul", 0, 0xf)))
+    FIELD_DECODERS[0x60 + _slot] = (_channel, _operator, _fields(("tl", 0, 0x7f),))
+    FIELD_DECODERS[0x80 + _slot] = (_channel, _operator, _fields(("ks", 6, 0x3), ("ar", 0, 0x1f)))
+    FIELD_DECODERS[0xa0 + _slot] = (_channel, _operator, _fields(("ams_en", 7, 0x1), ("d1r", 0, 0x1f)))
+    FIELD_DECODERS[0xc0 + _slot] = (_channel, _operator, _fields(("dt2", 6, 0x3), ("d2r", 0, 0x1f)))
+    FIELD_DECODERS[0xe0 + _slot] = (_channel, _operator, _fields(("d1l", 4, 0xf), ("rr", 0, 0xf)))
+
+PMD_FIELDS = _fields(("pmd", 0, 0x7f),)
+
+def decode_fields(address, data):
+    """ returns channel, operator and the (field name, shift, mask) tuples of a register write """
+    channel, operator, fields = FIELD_DECODERS[address]
+    if address == 0x08:
+        channel = data & 0x7
+    elif address == 0x19 and data & 0x80:
+        fields = PMD_FIELDS
+    return channel, operator, fields
+
+
+CSV_HEADER = "time,address,data,channel,operator,field,value"
+
 class VGMDumper(vgm.VGMStreamPlayer):
+    """ dumps a VGM stream as text (default), jsonl or csv.
+        Output lines are collected and written in blocks """
+    FLUSH_LINES = 4096
+
+    def __init__(self, out=sys.stdout, format="text"):
+        self.out     = out
+        self.format  = format
+        self.lines   = []
+        self.samples = 0
+        self.wait_text = {}
+
+        if format == "csv":
+            self.lines.append(CSV_HEADER)
+
+        self._ym2151 = {
+            "text":  self._ym2151_text,
+            "jsonl": self._ym2151_jsonl,
+            "csv":   self._ym2151_csv,
+        }[format]
+
+    def _emit(self, line):
+        self.lines.append(line)
+        if len(self.lines) >= self.FLUSH_LINES:
+            self.flush()
+
+    def flush(self):
+        if self.lines:
+            self.out.write("\n".join(self.lines))
+            self.out.write("\n")
+            self.lines = []
+
+    def dump(self, reader):
+        """ dumps all events of the reader, without going through the async player interface """
+        ym2151 = self._ym2151
+        wait   = self._wait
+        for events in reader.iter_events():
+            for time, kind, a, b, c in events:
+                if kind == vgm.EVENT_YM2151:
+                    ym2151(a, b)
+                elif kind == vgm.EVENT_WAIT:
+                    wait(a)
+                elif kind == vgm.EVENT_SN76489:
+                    self._sn76489(a)
+                elif kind == vgm.EVENT_YM2612:
+                    self._ym2612(a, b, c)
+                elif kind == vgm.EVENT_YM3812:
+                    self._chip_write("YM3812", a, b)
+                elif kind == vgm.EVENT_YM3526:
+                    self._chip_write("YM3526", a, b)
+                elif kind == vgm.EVENT_YMF262:
+                    self._chip_write("YMF262", a & 0xff, b, port=a >> 8)
+                elif kind == vgm.EVENT_DATA_BLOCK:
+                    self._data_block(a, c)
+
+    def _sn76489(self, data):
+        if self.format == "text":
+            self._emit(f"SN76489 write: {data:02x}")
+
+    def _ym2612(self, port, address, data):
+        if self.format == "text":
+            self._emit(f"YM2612 write at port {port}, address: {address:02x} data: {data:02x}")
+
+    def _chip_write(self, chip, address, data, port=None):
+        """ generic decoder for the other chips """
+        if self.format == "text":
+            port = "" if port is None else f"port {port}, "
+            self._emit(f"{chip} write at {port}address: {address:02x} data: {data:02x}")
+
+    def _data_block(self, block_type, size):
+        if self.format == "text":
+            self._emit(f"DATA BLOCK : TYPE {block_type:02x} SIZE {size}")
+
+    def _ym2151_text(self, address, data):
+        self._emit(f"          => {address:02x}: {data:02X}    {TEXT_DECODERS[address](address, data)}")
+
+    def _ym2151_jsonl(self, address, data):
+        time = self.samples / vgm.SAMPLE_RATE
+        channel, operator, fields = decode_fields(address, data)
+        channel  = "null" if channel  is None else channel
+        operator = "null" if operator is None else operator
+        for name, shift, mask in fields:
+            self._emit(f'{{"time": {time}, "address": {address}, "data": {data}, "channel": {channel}, '
+                       f'"operator": {operator}, "field": "{name}", "value": {(data >> shift) & mask}}}')
+
+    def _ym2151_csv(self, address, data):
+        time = self.samples / vgm.SAMPLE_RATE
+        channel, operator, fields = decode_fields(address, data)
+        channel  = "" if channel  is None else channel
+        operator = "" if operator is None else operator
+        for name, shift, mask in fields:
+            self._emit(f"{time},{address},{data},{channel},{operator},{name},{(data >> shift) & mask}")
+
+    def _wait(self, samples):
+        self.samples += samples
+        if self.format == "text":
+            try:
+                text = self.wait_text[samples]
+            except KeyError:
+                text = self.wait_text[samples] = f"({Fraction(samples, vgm.SAMPLE_RATE)*1e6:.0f})"
+            self._emit(text)
+
     async def sn76489_write(self, data):
-        print(f"SN76489 write: {data:02x}")
+        self._sn76489(data)
 
     async def ym2612_write(self, port, address, data):
-        result = f"YM2612 write at port {port}, address: {address:02x} data: {data:02x}"
-        print(result)
+        self._ym2612(port, address, data)
 
     async def ym2151_write(self, address, data):
-        result = ""
-        if address == 0x08:
-            channel   = data & 0x7
-            slot_bits = (data >> 3) & 0xf
-            modulator1 =  slot_bits & 0b0001
-            carrier1   = (slot_bits & 0b0010) >> 1
-            modulator2 = (slot_bits & 0b0100) >> 2
-            carrier2   = (slot_bits & 0b1000) >> 3
-            result = "KEY SWITCH : CHANNEL {}: CARRIER1: {} MODULATOR1: {} CARRIER2: {} MODULATOR2: {}"\
-                        .format(channel, onoff[carrier1], onoff[modulator1], onoff[carrier2], onoff[modulator2])
-        elif address == 0x01:
-            if (data == 0x02):
-                result = "LFO RESET"
-            elif data == 0:
-                result = "LFO RST OFF"
-            else:
-                result = "*** TEST MODE: {:02x} ***".format(data)
-        elif address == 0x18:
-            result = f"LFO FREQ   : {data}"
-        elif address == 0x19:
-            modulation_type = "PM DEPTH" if data & 0b10000000 > 0 else "AM DEPTH"
-            value = data & 0x7f
-            result = f"{modulation_type}   : {value}"
-        elif address == 0x1b:
-            ct = data >> 6
-            wave = data & 0b11
-            result = f"LFO WAVEFRM: {lfowaves[wave]} CT: {bin(ct)}"
-        elif address & 0xf8 == 0x28:
-            channel = 0x7 & address
-            note = data & 0xf
-            octave = (data >> 4) & 0x7
-            result = "KEY CODE   : CHANNEL {}: OCTAVE: {} NOTE: {}".format(channel, octave, notes[note])
-        elif address & 0b11111000 == 0x20:
-            operator = address & 0x7
-            rl = bin(data >> 6)
-            feedback = (data >> 3) & 0x7
-            connection = data & 0x7
-            result = f"OPERATOR {operator} : CONNECTION: {connection} FEEDBACK: {feedback} RL: {rl}"
-        elif address & 0xf8 == 0x38:
-            operator = address & 0b111
-            am_sensitivity = 0x3 & data
-            pm_sensitivity = 0x7 & (data >> 4)
-            result = f"OPERATOR {operator} : PM SENSITIVITY: {pm_sensitivity} AM SENSITIVITY: {am_sensitivity}"
-        elif address & 0xf8 == 0x30:
-            channel = 0x7 & address
-            fraction = (data >> 2) & 0x3f
-            result = "KEY FRAC   : channel {}: fraction: {}".format(channel, fraction)
-        elif address & 0xe0 == 0x40:
-            envelope = address & 0x1f
-            detune1 = (data >> 4) & 0x7
-            phase_multiply = data & 0xf
-            result += "PHASEGEN {}: DETUNE1: {:02d}".format(channel_env(envelope), detune1)
-            result += " PHASE MULTIPLY: {:02d}".format(phase_multiply)
-        elif address & 0x60 == 0x60:
-            envelope = address & 0x1f
-            level = data &  0x7f
-            result = "ENVELOPE {}: TOTAL LEVEL : {}".format(channel_env(envelope), level)
-        elif address & 0xe0 == 0x80:
-            envelope = address & 0x1f
-            keyscaling = data >> 6
-            attack_rate = data & 0b11111
-            result = "ENVELOPE {}: ".format(channel_env(envelope))
-            if attack_rate > 0:
-                result += "ATTACK RATE: {:02d}".format(envelope, attack_rate)
-            if keyscaling > 0:
-                result += " KEYSCALING: {:02d}".format(envelope, keyscaling)
-        elif address & 0xe0 == 0xa0:
-            envelope = address & 0x1f
-            first_decay_rate = data & 0b11111
-            am_sensitivity_en = data >> 7
-            result = "ENVELOPE {}: DECAY1 RATE: {:02d}".format(channel_env(envelope), first_decay_rate)
-            result += " AM SENSITIVITY ENABLE: {}".format(am_sensitivity_en)
-        elif address & 0xc0 == 0xc0:
-            envelope = address & 0x1f
-            detune2 = data >> 6
-            second_decay_rate = data & 0b11111
-            result += "ENVELOPE {}: DECAY2 RATE: {:02d}".format(channel_env(envelope), second_decay_rate)
-            result += " PHASEGEN {}: DETUNE2: {:02d}".format(channel_env(envelope), detune2)
-        elif address & 0xe0 == 0xe0:
-            envelope = address & 0x1f
-            release_rate = data & 0xf
-            decay1_level = (data >> 4) & 0xf
-            result = "ENVELOPE {}:".format(channel_env(envelope))
-            if decay1_level > 0:
-                result += " DECAY1 LEVEL: {:02d}".format(decay1_level)
-            if release_rate > 0:
-                result += " RELEASE: {:02d}".format(release_rate)
-
-        result = f"          => {address:02x}: {data:02X}    {result}"
-
-        print("" + result)
+        self._ym2151(address, data)
+
+    async def ym3812_write(self, address, data):
+        self._chip_write("YM3812", address, data)
+
+    async def ym3526_write(self, address, data):
+        self._chip_write("YM3526", address, data)
+
+    async def ymf262_write(self, address, data):
+        self._chip_write("YMF262", address & 0xff, data, port=address >> 8)
+
+    async def data_block(self, block_type, data):
+        self._data_block(block_type, len(data))
+
+    async def wait_samples(self, samples):
+        self._wait(samples)
 
     async def wait_seconds(self, duration):
-        print(f"({duration*1e6:.0f})")
+        await self.wait_samples(round(duration * vgm.SAMPLE_RATE))
 
 if __name__ == "__main__":
-    arg = sys.argv[1]
-    if arg.endswith(".vgz"):
-        reader = vgm.VGMStreamReader(gzip.GzipFile(arg, "rb"))
-        player = VGMDumper()
-        asyncio.run(reader.parse_data(player))
+    parser = argparse.ArgumentParser(description="dump the commands of a VGM file")
+    parser.add_argument("file")
+    parser.add_argument("-f", "--format", choices=["text", "jsonl", "csv"], default="text")
+    parser.add_argument("-o", "--output", help="output file, default: stdout")
+    args = parser.parse_args()
+
+    if args.file.endswith(".vgz"):
+        with open(args.file, "rb") as file:
+            reader = vgm.VGMStreamReader.from_file(file)
+        # stdout is not closed afterwards
+        with open(args.output, "w") if args.output else contextlib.nullcontext(sys.stdout) as out:
+            player = VGMDumper(out, args.format)
+            player.dump(reader)
+            player.flush()
     else:
         print("Unrecognized format!")
         exit(1)
@@ -0,0 +1,185 @@
+import os
+import json
+import hashlib
+import numpy as np
+import vgm
+
+
+__all__ = ["VGMEventTable"]
+
+
+EVENT_DTYPE = np.dtype([
+    ("time",    "<u4"), # absolute sample time @ vgm.SAMPLE_RATE
+    ("address", "u1"),
+    ("data",    "u1"),
+])
+
+# bump this whenever the layout of the compiled event files changes
+FORMAT_VERSION = 2
+
+# number of events play() converts to Python values at a time
+PLAY_CHUNK = 4096
+
+
+class VGMEventTable:
+    """ Compiled YM2151 command stream of a VGM file.
+
+        The events are stored as one packed record array with the columns
+        time (absolute sample number), address and data.
+        The array can be saved to a .npy sidecar next to the source file
+        and is memory mapped when loaded again, so playback can start
+        without decompressing or parsing the VGM file.
+    """
+    def __init__(self, events, *, total_samples, loop_samples=0, loop_index=None):
+        self.events        = events
+        self.time          = events["time"]
+        self.address       = events["address"]
+        self.data          = events["data"]
+        self.total_samples = total_samples
+        self.loop_samples  = loop_samples
+        # index of the first event in the looped part, None if the song does not loop
+        self.loop_index    = loop_index
+
+    def __len__(self):
+        return len(self.events)
+
+    @classmethod
+    def compile(cls, reader):
+        batches = list(reader.iter_events(1 << 16, as_array=True))
+        decoded = np.concatenate(batches) if batches else np.empty(0, dtype=vgm.EVENT_BATCH_DTYPE)
+        writes  = decoded[decoded["kind"] == vgm.EVENT_YM2151]
+
+        events = np.empty(len(writes), dtype=EVENT_DTYPE)
+        events["time"]    = writes["time"]
+        events["address"] = writes["a"]
+        events["data"]    = writes["b"]
+
+        loop_index = None
+        if reader.loop_samples > 0:
+            # several events can share the time of the loop start, so the index
+            # is found by the command offset: the writes up to the last wait
+            # which ends at or before loop_offset come before the loop, and so
+            # do those of the commands between that wait and loop_offset
+            kinds  = decoded["kind"]
+            before = np.flatnonzero((kinds == vgm.EVENT_WAIT) & (decoded["b"] <= reader.loop_offset))
+            last   = before[-1] + 1 if len(before) else 0
+            start  = int(decoded["b"][last - 1]) if last else reader.data_offset
+            loop_index = int(np.count_nonzero(kinds[:last] == vgm.EVENT_YM2151)) + \
+                sum(1 for offset, command in reader.iter_commands(start, reader.loop_offset) if command == 0x54)
+
+        return cls(events,
+                   total_samples=reader.total_samples,
+                   loop_samples=reader.loop_samples,
+                   loop_index=loop_index)
+
+    @staticmethod
+    def sidecar_paths(path, cache_dir=None):
+        if cache_dir is not None:
+            path = os.path.join(cache_dir, os.path.basename(path))
+        return path + ".events.npy", path + ".events.json"
+
+    @staticmethod
+    def _hash_file(path):
+        sha = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                sha.update(chunk)
+        return sha.hexdigest()
+
+    def save(self, path, *, key, cache_dir=None):
+        events_path, meta_path = self.sidecar_paths(path, cache_dir)
+        np.save(events_path, self.events, allow_pickle=False)
+        meta = dict(key,
+            format_version = FORMAT_VERSION,
+            total_samples  = self.total_samples,
+            loop_samples   = self.loop_samples,
+            loop_index     = self.loop_index,
+        )
+        with open(meta_path, "w") as f:
+            json.dump(meta, f)
+
+    @classmethod
+    def load(cls, path, *, cache_dir=None):
+        """ returns the cached event table of the VGM file at path,
+            or None if there is none or it is out of date """
+        events_path, meta_path = cls.sidecar_paths(path, cache_dir)
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        if meta.get("format_version") != FORMAT_VERSION or not os.path.exists(events_path):
+            return None
+
+        stat = os.stat(path)
+        if (meta["mtime_ns"], meta["size"]) != (stat.st_mtime_ns, stat.st_size):
+            # the file has been touched, only rebuild if the contents really changed
+            if meta["sha256"] != cls._hash_file(path):
+                return None
+            meta.update(mtime_ns=stat.st_mtime_ns, size=stat.st_size)
+            with open(meta_path, "w") as f:
+                json.dump(meta, f)
+
+        events = np.load(events_path, mmap_mode="r", allow_pickle=False)
+        return cls(events,
+                   total_samples=meta["total_samples"],
+                   loop_samples=meta["loop_samples"],
+                   loop_index=meta["loop_index"])
+
+    @classmethod
+    def from_file(cls, path, *, cache_dir=None):
+        """ loads the event table of the VGM file at path from its sidecar,
+            compiling and caching it first if needed """
+        table = cls.load(path, cache_dir=cache_dir)
+        if table is not None:
+            return table
+
+        stat = os.stat(path)
+        key = dict(sha256=cls._hash_file(path), mtime_ns=stat.st_mtime_ns, size=stat.st_size)
+        with open(path, "rb") as file:
+            table = cls.compile(vgm.VGMStreamReader.from_file(file))
+
+        try:
+            table.save(path, key=key, cache_dir=cache_dir)
+        except OSError as e:
+            print(f"Could not write event cache for {path}: {e}")
+
+        return table
+
+    async def _play(self, player, start, shift, now):
+        """ replays the events from index start on, with their times shifted
+            by shift samples. now is the current song time, returns the song
+            time of the last event """
+        times        = self.time
+        addresses    = self.address
+        datas        = self.data
+        ym2151_write = player.ym2151_write
+        wait_samples = player.wait_samples
+        # the columns may be memory mapped, only one chunk at a time is copied
+        for chunk in range(start, len(self), PLAY_CHUNK):
+            rows = slice(chunk, chunk + PLAY_CHUNK)
+            for time, address, data in zip(times[rows].tolist(), addresses[rows].tolist(), datas[rows].tolist()):
+                time += shift
+                if time != now:
+                    await wait_samples(time - now)
+                    now = time
+                await ym2151_write(address, data)
+        return now
+
+    async def play(self, player, *, loops=0):
+        """ replays the events into a VGMStreamPlayer. If the song has a loop,
+            it is repeated loops more times, or forever if loops is None """
+        now = await self._play(player, 0, 0, 0)
+        end = self.total_samples
+        while self.loop_index is not None and loops != 0:
+            if loops is not None:
+                loops -= 1
+            if end > now:
+                await player.wait_samples(end - now)
+            # the loop part starts over at the end of the previous round
+            now = await self._play(player, self.loop_index, end - (self.total_samples - self.loop_samples), end)
+            end += self.loop_samples
+
+        if end > now:
+            await player.wait_samples(end - now)
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+import os
+import sys
+import json
+import sqlite3
+import argparse
+import vgm
+
+
+__all__ = ["VGMLibrary"]
+
+
+# bump this whenever the table layout or the meaning of a column changes
+SCHEMA_VERSION = 1
+
+_TAG_COLUMNS = ["title", "game", "system", "author", "release_date"]
+
+_SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS tracks (
+    path          TEXT PRIMARY KEY,
+    mtime_ns      INTEGER NOT NULL,
+    size          INTEGER NOT NULL,
+    error         TEXT,
+    version       INTEGER,
+    chips         TEXT,
+    clocks        TEXT,
+    total_samples INTEGER,
+    loop_samples  INTEGER,
+    seconds       REAL,
+    loop_seconds  REAL,
+    {", ".join(f"{column} TEXT" for column in _TAG_COLUMNS)}
+);
+CREATE INDEX IF NOT EXISTS tracks_game ON tracks (game);
+"""
+
+_COLUMNS = (["path", "mtime_ns", "size", "error", "version", "chips", "clocks",
+             "total_samples", "loop_samples", "seconds", "loop_seconds"] + _TAG_COLUMNS)
+
+
+def find_vgm_files(root):
+    for directory, _, files in os.walk(root):
+        for name in sorted(files):
+            if name.endswith((".vgm", ".vgz")):
+                yield os.path.join(directory, name)
+
+
+def read_track(path, stat):
+    """ the table row of a VGM file, from its header and GD3 tag only """
+    row = dict.fromkeys(_COLUMNS)
+    row.update(path=path, mtime_ns=stat.st_mtime_ns, size=stat.st_size)
+    try:
+        with open(path, "rb") as file:
+            header, tags = vgm.read_header(file)
+    except Exception as e:
+        row["error"] = f"{type(e).__name__}: {e}"
+        return row
+
+    row.update(version=header.version,
+               # chip names are stored with separators on both ends, so they can be matched with LIKE
+               chips="," + ",".join(header.chips()) + ",",
+               clocks=json.dumps(header.clocks()),
+               total_samples=header.total_samples,
+               loop_samples=header.loop_samples,
+               seconds=float(header.total_seconds),
+               loop_seconds=float(header.loop_seconds))
+    for column in _TAG_COLUMNS:
+        row[column] = tags.get(column, "")
+    return row
+
+
+class VGMLibrary:
+    """ Persistent index of the headers and GD3 tags of a VGM collection.
+
+        The index is kept in a SQLite database. update() only reads the
+        header and tag of files which are new or whose mtime or size
+        changed since the last run, and drops files which have gone.
+    """
+    def __init__(self, database):
+        self.db = sqlite3.connect(database)
+        self.db.row_factory = sqlite3.Row
+        version = self.db.execute("PRAGMA user_version").fetchone()[0]
+        if version != SCHEMA_VERSION:
+            self.db.execute("DROP TABLE IF EXISTS tracks")
+            self.db.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        self.db.executescript(_SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def update(self, root):
+        """ brings the entries below root up to date,
+            returns the numbers of (re)read and removed files """
+        root  = os.path.abspath(root)
+        known = {row["path"]: (row["mtime_ns"], row["size"]) for row in
+                 self.db.execute("SELECT path, mtime_ns, size FROM tracks WHERE path LIKE ? ESCAPE '\\'",
+                                 (self._like_prefix(root),))}
+
+        changed = []
+        for path in find_vgm_files(root):
+            stat = os.stat(path)
+            if known.pop(path, None) != (stat.st_mtime_ns, stat.st_size):
+                changed.append(read_track(path, stat))
+
+        with self.db:
+            self.db.executemany(
+                f"INSERT OR REPLACE INTO tracks ({', '.join(_COLUMNS)}) "
+                f"VALUES ({', '.join(':' + column for column in _COLUMNS)})", changed)
+            self.db.executemany("DELETE FROM tracks WHERE path = ?", [(path,) for path in known])
+        return len(changed), len(known)
+
+    @staticmethod
+    def _like_prefix(directory):
+        escaped = directory.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        return escaped + os.sep + "%"
+
+    def tracks(self, *, chip=None, search=None, max_seconds=None, looped=None):
+        """ the indexed tracks, optionally filtered by chip name, a text
+            in title or game, the maximum length and whether they loop """
+        where, args = ["error IS NULL"], []
+        if chip is not None:
+            where.append("chips LIKE ?")
+            args.append(f"%,{chip},%")
+        if search is not None:
+            where.append("(title LIKE ? OR game LIKE ?)")
+            args += [f"%{search}%"] * 2
+        if max_seconds is not None:
+            where.append("seconds <= ?")
+            args.append(max_seconds)
+        if looped is not None:
+            where.append("loop_samples > 0" if looped else "loop_samples = 0")
+        query = f"SELECT * FROM tracks WHERE {' AND '.join(where)} ORDER BY game, path"
+        return self.db.execute(query, args).fetchall()
+
+    def errors(self):
+        return self.db.execute("SELECT path, error FROM tracks WHERE error IS NOT NULL ORDER BY path").fetchall()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="index the headers and tags of a tree of VGM files")
+    parser.add_argument("directory")
+    parser.add_argument("-d", "--database", default="vgm-library.sqlite")
+    parser.add_argument("-c", "--chip", help="only list tracks using this chip, e.g. YM2151")
+    parser.add_argument("-s", "--search", help="only list tracks with this text in title or game")
+    parser.add_argument("-l", "--list", action="store_true", help="list the matching tracks")
+    args = parser.parse_args()
+
+    library = VGMLibrary(args.database)
+    updated, removed = library.update(args.directory)
+    print(f"{updated} files read, {removed} removed", file=sys.stderr)
+    for row in library.errors():
+        print(f"{row['path']}: {row['error']}", file=sys.stderr)
+
+    if args.list or args.chip or args.search:
+        for row in library.tracks(chip=args.chip, search=args.search):
+            minutes, seconds = divmod(int(row["seconds"]), 60)
+            print(f"{minutes:3}:{seconds:02} {row['game']} - {row['title']}  [{row['chips'].strip(',')}]  {row['path']}")
+    library.close()
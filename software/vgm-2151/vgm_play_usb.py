@@ -1,35 +1,224 @@
 #!/usr/bin/env python3
-import sys
-import time
-import gzip
+import argparse
 import asyncio
 import vgm
-import rtmidi
+import vgm_events
+import vgm_prefetch
+from vgm_seek import VGMSeekIndex
+from vgm_scheduler import DeadlineScheduler
+from vgm_timing import SendTiming
+from vgm_sender import RealtimeSender
+from midi_transport import RtMidiTransport, USBBulkTransport
 
-midiout = rtmidi.MidiOut()
-available_ports = midiout.get_ports()
+# first sysex byte of a bulk register write, see MIDIController.SYSEX_BULK
+SYSEX_BULK = 0x7d
+# first sysex byte of an address run register write, see MIDIController.SYSEX_RUNS
+SYSEX_RUNS = 0x78
+# longest address run, the count has 7 bits
+MAX_RUN    = 127
+# keep bulk messages well below the depth of the MIDIController output FIFO
+MAX_BULK_PAIRS = 256
 
-synthport = [i for i in available_ports if "JT51-Synth" in i]
-if not synthport:
-    print("JT51-Synth not connected!")
-    sys.exit(1)
+TRANSPORTS = {
+    "rtmidi": RtMidiTransport,
+    "usb":    USBBulkTransport,
+}
 
-midiout.open_port(available_ports.index(synthport[0]))
+def single_message(address, data):
+    return [0xf0, address >> 4, address & 0xf, data >> 4, data & 0xf, 0xf7]
 
-def send(address, data):
-     msg = [0xf0, address >> 4, address & 0xf, data >> 4, data & 0xf, 0xf7]
-     midiout.send_message(msg)
+def pack_7bit(data):
+    """ packs 8 bit bytes into 7 bit MIDI data bytes:
+        each group of up to 7 bytes is preceded by a byte holding their MSBs """
+    result = []
+    for i in range(0, len(data), 7):
+        group = data[i:i + 7]
+        result.append(sum(((byte >> 7) & 1) << n for n, byte in enumerate(group)))
+        result += [byte & 0x7f for byte in group]
+    return result
+
+def bulk_message(writes):
+    """ writes is a flat list of address, data, address, data... """
+    return [0xf0, SYSEX_BULK] + pack_7bit(writes) + [0xf7]
+
+def address_runs(writes):
+    """ splits a flat list of address, data... into runs of writes to addresses
+        which are 1 or 8 apart, like the channel or operator registers of a voice.
+        Yields the start address, the step and the data of each run """
+    pairs = list(zip(writes[0::2], writes[1::2]))
+    i = 0
+    while i < len(pairs):
+        start = pairs[i][0]
+        step  = 1
+        if i + 1 < len(pairs) and pairs[i + 1][0] - start == 8:
+            step = 8
+        end = i + 1
+        while end < len(pairs) and end - i < MAX_RUN and pairs[end][0] == start + (end - i) * step:
+            end += 1
+        yield start, step, [data for address, data in pairs[i:end]]
+        i = end
+
+def runs_message(writes):
+    """ writes is a flat list of address, data, address, data...
+        Each address run is sent as <start address> <step 8 << 7 | count> <data>... """
+    runs = []
+    for start, step, data in address_runs(writes):
+        runs += [start, (step == 8) << 7 | len(data)] + data
+    return [0xf0, SYSEX_RUNS] + pack_7bit(runs) + [0xf7]
+
+def write_messages(writes):
+    """ the sysex messages for a flat list of address, data... pairs: a single pair
+        message, or for each MAX_BULK_PAIRS pairs the shorter one of the bulk and
+        the address run encoding """
+    if len(writes) == 2:
+        return [single_message(*writes)]
+    messages = []
+    for i in range(0, len(writes), 2 * MAX_BULK_PAIRS):
+        chunk = writes[i:i + 2 * MAX_BULK_PAIRS]
+        messages.append(min(bulk_message(chunk), runs_message(chunk), key=len))
+    return messages
 
 class USBStreamPlayer(vgm.VGMStreamPlayer):
+    def __init__(self, transport, scheduler=None):
+        self.transport = transport
+        # all writes between two waits are sent as one bulk sysex message
+        self.pending   = []
+        self.scheduler = scheduler or DeadlineScheduler()
+        # set by enable_timing()
+        self.timing    = None
+
+    def enable_timing(self, capacity=1 << 20):
+        """ records the scheduled and actual send time of every YM2151 write """
+        self.timing = timing = SendTiming(capacity)
+        scheduler = self.scheduler
+        write = self.ym2151_write
+
+        async def ym2151_write(address, data):
+            if scheduler.start_time is None:
+                scheduler.start()
+            timing.schedule(scheduler.position)
+            await write(address, data)
+
+        self.ym2151_write = ym2151_write
+        return timing
+
+    def send_bulk(self, writes):
+        for message in write_messages(writes):
+            self.transport.send_message(message)
+
+    def flush(self):
+        if self.pending:
+            self.send_bulk(self.pending)
+            self.pending = []
+        self.transport.flush()
+        if self.timing is not None and self.timing.pending:
+            self.timing.mark_sent(self.scheduler.elapsed())
+
     async def ym2151_write(self, address, data):
-        send(address, data)
+        self.pending += (address, data)
+
+    async def wait_samples(self, samples):
+        # short waits are merged into the next deadline,
+        # so their writes go out together with the following ones
+        if self.scheduler.advance(samples):
+            self.flush()
+            self.scheduler.wait()
 
     async def wait_seconds(self, duration):
-        time.sleep(float(duration))
+        await self.wait_samples(round(duration * vgm.SAMPLE_RATE))
 
 if __name__ == "__main__":
-    arg = sys.argv[1]
-    if arg.endswith(".vgz"):
-        reader = vgm.VGMStreamReader(gzip.GzipFile(arg, "rb"))
-        player = USBStreamPlayer()
-        asyncio.run(reader.parse_data(player))
+    parser = argparse.ArgumentParser(description="play a YM2151 VGM file on the JT51-Synth")
+    parser.add_argument("file")
+    parser.add_argument("--transport", choices=TRANSPORTS.keys(), default="rtmidi",
+                        help="rtmidi: OS MIDI stack, usb: direct libusb bulk transfers")
+    parser.add_argument("--stream", action="store_true",
+                        help="decompress and parse the file in a background thread during playback, "
+                             "instead of using the compiled event cache")
+    parser.add_argument("--read-ahead", type=int, default=64,
+                        help="number of event chunks the background parser may run ahead")
+    parser.add_argument("--start", type=float, default=0.0,
+                        help="start playback at this many seconds into the song")
+    parser.add_argument("--loops", type=int, default=0,
+                        help="repeat the looped part of the song this many times, -1 loops forever")
+    parser.add_argument("--shadow", action="store_true",
+                        help="drop register writes which do not change the chip state")
+    parser.add_argument("--resync", action="store_true",
+                        help="like --shadow, but start from the register state read back from the synth, "
+                             "so only the differences are sent. Needs gateware built with USE_MIDI_IN")
+    parser.add_argument("--timing", metavar="FILE",
+                        help="record the send time of every write and save it to FILE (.csv or .npz)")
+    parser.add_argument("--realtime", action="store_true",
+                        help="send from a dedicated thread, fed by the parser through a ring buffer")
+    parser.add_argument("--ring-size", type=int, default=1 << 16,
+                        help="capacity of the --realtime ring buffer in writes, a power of two")
+    parser.add_argument("--priority", type=int,
+                        help="run the --realtime sender thread with SCHED_FIFO at this priority")
+    args = parser.parse_args()
+
+    if args.file.endswith(".vgz"):
+        if args.stream:
+            source = vgm_prefetch.VGMPrefetchReader(args.file, read_ahead=args.read_ahead)
+            play = source.parse_data
+        elif args.start:
+            with open(args.file, "rb") as file:
+                reader = vgm.VGMStreamReader.from_file(file)
+
+            async def play(player):
+                index = VGMSeekIndex.build(reader)
+                await player.wait_samples(await index.seek(player, round(args.start * vgm.SAMPLE_RATE),
+                                                           loop=args.loops != 0))
+                await reader.parse_data(player, loops=None if args.loops < 0 else args.loops)
+        else:
+            # compiled once, then loaded from the memory mapped sidecar on later runs
+            source = vgm_events.VGMEventTable.from_file(args.file)
+
+            async def play(player):
+                await source.play(player, loops=None if args.loops < 0 else args.loops)
+
+        if args.resync:
+            # midi_mirror gets its transports from midi_latency, which imports this module
+            import midi_mirror
+        transport = (midi_mirror.TRANSPORTS if args.resync else TRANSPORTS)[args.transport]()
+        player = USBStreamPlayer(transport)
+        # before the shadow, so only the writes which are sent get recorded
+        if args.timing:
+            player.enable_timing()
+        sender = None
+        if args.realtime:
+            sender = RealtimeSender(player, capacity=args.ring_size, priority=args.priority)
+            # the shadow filters the writes before they go into the ring
+            shadowed = sender.writer
+        else:
+            shadowed = player
+        if args.shadow or args.resync:
+            shadowed.enable_ym2151_shadow()
+        if args.resync:
+            state = midi_mirror.read_mirror(transport)
+            if state is None:
+                print("no register readback from the synth, sending everything")
+            else:
+                shadowed.ym2151_shadow.load(state)
+        try:
+            if sender:
+                sender.run(play)
+            else:
+                asyncio.run(play(player))
+                player.flush()
+                player.scheduler.wait()
+        finally:
+            transport.close()
+
+        song_seconds = player.scheduler.position / vgm.SAMPLE_RATE
+        elapsed      = player.scheduler.elapsed()
+        print(f"played {elapsed:.3f}s of {song_seconds:.3f}s song, off by {(elapsed - song_seconds) * 1e3:.1f}ms")
+        print(player.scheduler.report())
+        if args.stream:
+            print(source.report())
+        if sender:
+            print(sender.report())
+        if shadowed.ym2151_shadow:
+            print(shadowed.ym2151_shadow.report())
+        if player.timing:
+            print(player.timing.report())
+            player.timing.export(args.timing)
@@ -0,0 +1,80 @@
+import time
+import itertools
+import queue
+import threading
+import vgm
+
+
+__all__ = ["VGMPrefetchReader"]
+
+
+class VGMPrefetchReader:
+    """ Decompresses and parses a VGM file in a background thread.
+
+        The producer thread runs ahead of playback and hands the batches of
+        VGMStreamReader.iter_events() with at least chunk_size events over through
+        a queue which holds at most read_ahead chunks. parse_data() only pops
+        events and calls the player, so it can be used in place of VGMStreamReader.parse_data().
+        Every time the consumer finds the queue empty it counts an underrun.
+    """
+    _END = None
+
+    def __init__(self, path, *, read_ahead=64, chunk_size=256):
+        self.path       = path
+        self.chunk_size = chunk_size
+        self._ring      = queue.Queue(maxsize=read_ahead)
+        self._error     = None
+        # set by the producer before it hands out the first chunk
+        self._reader    = None
+
+        # statistics
+        self.underruns       = 0
+        self.underrun_time   = 0.0
+        self.events          = 0
+
+        self._producer = threading.Thread(target=self._produce, name="vgm-prefetch", daemon=True)
+        self._producer.start()
+
+    def _produce(self):
+        try:
+            with open(self.path, "rb") as file:
+                self._reader = vgm.VGMStreamReader.from_file(file)
+            for events in self._reader.iter_events(self.chunk_size):
+                # blocks while the consumer is read_ahead chunks behind
+                self._ring.put(events)
+        except Exception as e:
+            self._error = e
+        finally:
+            self._ring.put(self._END)
+
+    def _pop_chunk(self):
+        try:
+            return self._ring.get_nowait()
+        except queue.Empty:
+            self.underruns += 1
+            start = time.perf_counter()
+            chunk = self._ring.get()
+            self.underrun_time += time.perf_counter() - start
+            return chunk
+
+    def _chunks(self):
+        # waiting for the first chunk is start up latency, not an underrun
+        chunk = self._ring.get()
+        while chunk is not self._END:
+            self.events += len(chunk)
+            yield chunk
+            chunk = self._pop_chunk()
+
+    async def parse_data(self, player):
+        chunks = self._chunks()
+        first  = next(chunks, None)
+        if first is not None:
+            await self._reader.play_events(player, itertools.chain([first], chunks))
+
+        self._producer.join()
+        if self._error is not None:
+            raise self._error
+
+    def report(self):
+        return (f"prefetch: {self.events} events, {self.underruns} underruns, "
+                f"{self.underrun_time * 1e3:.1f}ms spent waiting for the parser")
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+import time
+import wave
+import argparse
+from fractions import Fraction
+import numpy as np
+import vgm
+from ym2151_model import YM2151Model, JT51_CLOCK, CYCLES_PER_SAMPLE
+
+
+# SynthModule resamples the 56 kHz JT51 output by 6/7 to 48 kHz, which
+# resample() does with 6 filter branches. Rate ratios without such a small
+# integer form, as with other chip clocks, use this many filter branches,
+# with the position of each output sample rounded to 1/PHASES input samples
+PHASES = 256
+# taps per polyphase branch of the resampling filter
+FILTER_TAPS = 24
+CUTOFF      = 20e3
+# output samples computed at a time
+RESAMPLE_BLOCK = 1 << 16
+
+
+def render_events(reader, model, *, loops=0):
+    """ plays the YM2151 writes of the reader into the model,
+        returns the (samples, 2) float output at the model sample rate """
+    chunks   = []
+    rendered = 0
+    # chip samples per song sample, as exact integer ratio
+    numerator, denominator = model.clock, CYCLES_PER_SAMPLE * vgm.SAMPLE_RATE
+    end = 0
+    for events in reader.iter_events(loops=loops):
+        for time, kind, a, b, c in events:
+            if kind == vgm.EVENT_YM2151:
+                due = time * numerator // denominator
+                if due > rendered:
+                    chunks.append(model.render(due - rendered))
+                    rendered = due
+                model.write(a, b)
+            elif kind == vgm.EVENT_WAIT:
+                end = time + a
+    due = end * numerator // denominator
+    if due > rendered:
+        chunks.append(model.render(due - rendered))
+    return np.concatenate(chunks) if chunks else np.zeros((0, 2))
+
+
+def _resampling_filter(rate, up):
+    """ windowed sinc low pass at the upsampled rate, split into up branches """
+    taps = up * FILTER_TAPS
+    n    = np.arange(taps) - (taps - 1) / 2
+    h    = 2 * CUTOFF / rate * np.sinc(2 * CUTOFF / rate * n) * np.kaiser(taps, 8.0)
+    h   *= up / h.sum()
+    return h.reshape(FILTER_TAPS, up).T[:, ::-1]
+
+
+def resample(signal, input_rate, output_rate=48000):
+    """ resamples from input_rate, which may be a Fraction, to output_rate.
+        For the JT51 clock this is the 6/7 of the FractionalResampler in SynthModule """
+    ratio    = Fraction(output_rate) / Fraction(input_rate)
+    up       = min(ratio.numerator, PHASES)
+    branches = _resampling_filter(float(input_rate) * up, up)
+    length   = int(len(signal) * ratio)
+    padded   = np.concatenate([np.zeros((FILTER_TAPS - 1, signal.shape[1])), signal])
+    windows  = np.lib.stride_tricks.sliding_window_view(padded, FILTER_TAPS, axis=0)
+    result   = np.empty((length, signal.shape[1]))
+    for start in range(0, length, RESAMPLE_BLOCK):
+        # output sample m is at input position m / ratio, in units of 1/up input samples,
+        # filtered by the branch of its phase
+        position = np.arange(start, min(start + RESAMPLE_BLOCK, length)) * (up * ratio.denominator) // ratio.numerator
+        index, branch = position // up, position % up
+        result[start:start + len(position)] = np.einsum("mct,mt->mc", windows[index], branches[branch])
+    return result
+
+
+def write_wav(path, signal, sample_rate):
+    pcm = np.round(np.clip(signal, -1.0, 1.0) * 32767).astype("<i2")
+    with wave.open(path, "wb") as f:
+        f.setnchannels(2)
+        f.setsampwidth(2)
+        f.setframerate(sample_rate)
+        f.writeframes(pcm.tobytes())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="render the YM2151 part of a VGM file to a WAV file")
+    parser.add_argument("file")
+    parser.add_argument("-o", "--output", help="output WAV file, default: the input name with .wav")
+    parser.add_argument("-r", "--rate", type=int, choices=[56000, 48000], default=56000,
+                        help="sample rate of the WAV file, 56000: the JT51 output rate, the JT51 clock / 64, "
+                             "48000: the ADAT output rate. Songs for other clocks are resampled to it")
+    parser.add_argument("--clock", type=int,
+                        help="YM2151 clock in Hz, default: the clock in the VGM header, or the JT51 clock without one")
+    parser.add_argument("--loops", type=int, default=0, help="how often to repeat the looped part")
+    args = parser.parse_args()
+
+    with open(args.file, "rb") as file:
+        reader = vgm.VGMStreamReader.from_file(file)
+    # the pitch of the song depends on the clock it was made for
+    model = YM2151Model(args.clock or reader.clocks().get("YM2151") or JT51_CLOCK)
+
+    start  = time.perf_counter()
+    signal = render_events(reader, model, loops=args.loops)
+    # the model runs at the clock / 64, which is 56 kHz only for the JT51 clock
+    rate   = args.rate
+    if model.sample_rate != rate:
+        signal = resample(signal, Fraction(model.clock, CYCLES_PER_SAMPLE), rate)
+    elapsed = time.perf_counter() - start
+
+    output = args.output or args.file.rsplit(".", 1)[0] + ".wav"
+    write_wav(output, signal, rate)
+    seconds = len(signal) / rate
+    print(f"{output}: {seconds:.1f}s rendered in {elapsed:.1f}s, {seconds / elapsed:.1f}x real time")
@@ -0,0 +1,76 @@
+import time
+import vgm
+
+
+__all__ = ["DeadlineScheduler"]
+
+
+class DeadlineScheduler:
+    """ Keeps playback in sync with the absolute song position.
+
+        Every wait moves the target time of the next event forward,
+        measured from the start of the song, so neither sleep granularity
+        nor the time spent sending accumulates into drift.
+        Deadlines closer than merge_seconds are not waited for at all,
+        the following events are sent right away and the time is caught up
+        at the next longer wait. The final spin_seconds before a deadline
+        are busy waited, because sleep() wakes up too late.
+    """
+    def __init__(self, *, merge_seconds=0.001, spin_seconds=0.002, clock=time.perf_counter):
+        self.merge_seconds = merge_seconds
+        self.spin_seconds  = spin_seconds
+        self.clock         = clock
+
+        self.start_time = None
+        # song position in samples
+        self.position   = 0
+
+        # lateness statistics
+        self.waits      = 0
+        self.late_count = 0
+        self.late_total = 0.0
+        self.late_max   = 0.0
+
+    def start(self):
+        self.start_time = self.clock()
+
+    def deadline(self):
+        return self.start_time + self.position / vgm.SAMPLE_RATE
+
+    def elapsed(self):
+        return self.clock() - self.start_time
+
+    def advance(self, samples):
+        """ moves the song position forward.
+            Returns True if the new deadline is far enough away to be waited for """
+        if self.start_time is None:
+            self.start()
+        self.position += samples
+        remaining = self.deadline() - self.clock()
+        if remaining < 0:
+            # already behind schedule
+            self._record_lateness(-remaining)
+        return remaining >= self.merge_seconds
+
+    def wait(self):
+        """ blocks until the deadline of the current song position """
+        deadline  = self.deadline()
+        remaining = deadline - self.clock()
+        if remaining > self.spin_seconds:
+            time.sleep(remaining - self.spin_seconds)
+        while self.clock() < deadline:
+            pass
+        self._record_lateness(self.clock() - deadline)
+
+    def _record_lateness(self, late):
+        self.waits      += 1
+        self.late_total += late
+        self.late_max    = max(self.late_max, late)
+        if late > self.merge_seconds:
+            self.late_count += 1
+
+    def report(self):
+        average = self.late_total / self.waits if self.waits else 0.0
+        return (f"{self.waits} waits, average lateness {average * 1e6:.0f}us, "
+                f"max lateness {self.late_max * 1e6:.0f}us, "
+                f"{self.late_count} waits more than {self.merge_seconds * 1e3:g}ms late")
@@ -0,0 +1,106 @@
+import bisect
+import vgm
+from ym2151 import YM2151Shadow
+
+
+__all__ = ["VGMSeekIndex"]
+
+
+def _fast_forward(reader, shadow, stop_at):
+    """ follows the YM2151 register state from the reader position without playing
+        anything, up to the first wait which reaches stop_at. Leaves the reader
+        right after that wait and returns the sample time there, or None at the
+        end of the song, with the reader at the end command """
+    # batches of one wait, so the DAC stream state of the reader is that of
+    # the offset where it stops, and a wait split up by stream writes is complete
+    for events in reader.iter_events(1):
+        for time, kind, a, b, c in events:
+            if kind == vgm.EVENT_YM2151:
+                shadow.write(a, b)
+        time, kind, a, b, c = events[-1]
+        if kind == vgm.EVENT_WAIT and time + a >= stop_at:
+            reader.seek(b)
+            return time + a
+    return None
+
+
+class VGMSeekIndex:
+    """ Maps song positions to command offsets in a VGMStreamReader.
+
+        For every interval (in samples) of the song the index stores the
+        position of the first command after that time, together with a
+        snapshot of the YM2151 registers and of the DAC stream state at this
+        point. To start playback in the middle of a song, the player gets the
+        register differences to the snapshot and the reader continues at the
+        stored offset. The data banks need no snapshot: building the index
+        has parsed all data blocks of the song into the reader.
+    """
+    def __init__(self, reader, *, interval=vgm.SAMPLE_RATE):
+        self.reader   = reader
+        self.interval = interval
+        # entries are sorted by time
+        self.times    = []
+        self.offsets  = []
+        self.states   = []
+        self.streams  = []
+
+    @classmethod
+    def build(cls, reader, *, interval=vgm.SAMPLE_RATE):
+        index  = cls(reader, interval=interval)
+        shadow = YM2151Shadow()
+        time   = 0
+
+        reader.seek(reader.data_offset)
+        reader.restore_stream_state(None)
+        index._add(time, reader, shadow)
+        while True:
+            stop_at = (time // interval + 1) * interval
+            elapsed = _fast_forward(reader, shadow, stop_at - time)
+            if elapsed is None:
+                break
+            # the reader has stopped right after the wait which crossed the interval
+            time += elapsed
+            index._add(time, reader, shadow)
+
+        reader.seek(reader.data_offset)
+        reader.restore_stream_state(None)
+        return index
+
+    def _add(self, time, reader, shadow):
+        self.times.append(time)
+        self.offsets.append(reader.tell())
+        self.states.append(shadow.copy())
+        self.streams.append(reader.stream_state())
+
+    async def seek(self, player, samples, *, loop=False):
+        """ positions the reader at the song time samples and brings the chip into
+            the state it would have there. Returns the number of samples until the
+            next command is due, which the player has to wait before parsing on.
+            Times past the end of the song are wrapped into the looped part if
+            loop is set and the song has a loop, otherwise they seek to the end """
+        reader = self.reader
+        if samples >= reader.total_samples:
+            if loop and reader.loop_samples > 0:
+                loop_start = reader.total_samples - reader.loop_samples
+                samples = loop_start + (samples - loop_start) % reader.loop_samples
+            else:
+                samples = reader.total_samples
+
+        entry = max(bisect.bisect_right(self.times, samples) - 1, 0)
+        shadow = self.states[entry].copy()
+        time   = self.times[entry]
+        reader.seek(self.offsets[entry])
+        reader.restore_stream_state(self.streams[entry])
+
+        # run from the index entry up to the requested time, without playing
+        remaining = 0
+        if time < samples:
+            elapsed = _fast_forward(reader, shadow, samples - time)
+            if elapsed is not None:
+                remaining = time + elapsed - samples
+
+        current = player.ym2151_shadow or YM2151Shadow()
+        for address, data in current.diff(shadow):
+            await player.ym2151_write(address, data)
+
+        return remaining
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+import os
+import gzip
+import struct
+import asyncio
+import vgm
+from vgm_seek import VGMSeekIndex
+from ym2151 import YM2151Shadow, SIDE_EFFECT_REGISTERS
+
+
+TEST_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "test.vgz")
+
+
+class RecordingPlayer(vgm.VGMStreamPlayer):
+    """ records the YM2151 writes with their song time, and the resulting register state """
+    def __init__(self):
+        self.time   = 0
+        self.writes = []
+        self.state  = YM2151Shadow()
+
+    async def ym2151_write(self, address, data):
+        self.writes.append((self.time, address, data))
+        self.state.write(address, data)
+
+    async def wait_samples(self, samples):
+        self.time += samples
+
+
+def load(loop_at=None):
+    """ the test file, optionally patched to loop from the first command after loop_at samples """
+    with open(TEST_FILE, "rb") as f:
+        data = bytearray(gzip.decompress(f.read()))
+    if loop_at is not None:
+        reader = vgm.VGMStreamReader(bytes(data))
+        remaining = asyncio.run(VGMSeekIndex.build(reader).seek(RecordingPlayer(), loop_at))
+        loop_start = loop_at + remaining
+        struct.pack_into("<LL", data, 0x1c, reader.tell() - 0x1c, reader.total_samples - loop_start)
+    return bytes(data)
+
+
+def registers(state):
+    """ the register state, without the registers whose writes only trigger actions """
+    return [data for address, data in enumerate(state.registers) if address not in SIDE_EFFECT_REGISTERS], state.key_on
+
+
+def play(data, start, *, loops=0):
+    """ plays the song from start samples on, as vgm_play_usb.py --start does """
+    reader = vgm.VGMStreamReader(data)
+    index  = VGMSeekIndex.build(reader, interval=vgm.SAMPLE_RATE)
+    player = RecordingPlayer()
+    remaining = asyncio.run(index.seek(player, start, loop=loops != 0))
+    seek_writes = len(player.writes)
+    player.time += remaining
+    asyncio.run(reader.parse_data(player, loops=loops))
+    return player, seek_writes
+
+
+def straight(data, *, loops=0):
+    player = RecordingPlayer()
+    asyncio.run(vgm.VGMStreamReader(data).parse_data(player, loops=loops))
+    return player
+
+
+def state_at(player, samples):
+    """ register state after the writes before samples """
+    state = YM2151Shadow()
+    for time, address, data in player.writes:
+        if time >= samples:
+            break
+        state.write(address, data)
+    return state
+
+
+def test_seek_middle():
+    data = load()
+    reference = straight(data)
+    start = 1234567
+    player, seek_writes = play(data, start)
+    after = [(time + start, address, data) for time, address, data in player.writes[seek_writes:]]
+    assert after == [write for write in reference.writes if write[0] >= start]
+    assert player.time + start == reference.time
+
+
+def test_seek_past_end():
+    data = load()
+    reference = straight(data)
+    for start in [reference.time, reference.time + vgm.SAMPLE_RATE]:
+        # used to run past the end command into the GD3 tag
+        player, seek_writes = play(data, start)
+        assert player.writes[seek_writes:] == []
+        assert registers(player.state) == registers(reference.state)
+
+
+def test_seek_past_end_wraps_into_loop():
+    data = load(loop_at=1000000)
+    header = vgm.VGMStreamReader(data)
+    loop_start = header.total_samples - header.loop_samples
+    past = vgm.SAMPLE_RATE
+    wrapped, wrapped_writes = play(data, header.total_samples + past, loops=1)
+    direct, direct_writes   = play(data, loop_start + past, loops=1)
+    assert registers(wrapped.state) == registers(direct.state)
+    assert wrapped.writes[wrapped_writes:] == direct.writes[direct_writes:]
+
+
+if __name__ == "__main__":
+    for name, test in list(globals().items()):
+        if name.startswith("test_"):
+            test()
+    print("seek: all checks passed")
@@ -0,0 +1,209 @@
+import os
+import sys
+import time
+import asyncio
+import threading
+import numpy as np
+import vgm
+
+
+__all__ = ["EventRing", "RingWriter", "RealtimeSender"]
+
+
+class EventRing:
+    """ Single producer, single consumer ring of timestamped YM2151 writes.
+
+        The slots are preallocated arrays. Only the producer moves head and only
+        the consumer moves tail, each of them just reads the index of the other,
+        so the two sides never share a lock. The producer fills a slot before it
+        moves head past it, the consumer reads a slot before it moves tail past it.
+    """
+    def __init__(self, capacity=1 << 16):
+        if capacity & (capacity - 1):
+            raise ValueError(f"ring capacity {capacity} is not a power of two")
+        self.capacity = capacity
+        self.mask     = capacity - 1
+        # song position in samples, register address and data of each write
+        self.position = np.zeros(capacity, np.int64)
+        self.address  = np.zeros(capacity, np.uint8)
+        self.data     = np.zeros(capacity, np.uint8)
+        self.head     = 0
+        self.tail     = 0
+        # set by the producer after the last write, end is the song length
+        self.end      = 0
+        self.closed   = False
+
+    @property
+    def fill(self):
+        return self.head - self.tail
+
+    def push(self, position, address, data):
+        """ returns False if the ring is full """
+        head = self.head
+        if head - self.tail > self.mask:
+            return False
+        i = head & self.mask
+        self.position[i] = position
+        self.address[i]  = address
+        self.data[i]     = data
+        self.head = head + 1
+        return True
+
+    def close(self, end):
+        self.end    = end
+        self.closed = True
+
+
+class RingWriter(vgm.VGMStreamPlayer):
+    """ The producer side: a player which does not wait,
+        it only queues the writes with their song position """
+    # sleep while the ring is full
+    FULL_SLEEP = 0.002
+
+    def __init__(self, ring, sender):
+        self.ring     = ring
+        self.sender   = sender
+        self.position = 0
+        self.full_waits = 0
+
+    async def ym2151_write(self, address, data):
+        while not self.ring.push(self.position, address, data):
+            self.full_waits += 1
+            self.sender.check()
+            time.sleep(self.FULL_SLEEP)
+
+    async def wait_samples(self, samples):
+        self.position += samples
+
+    async def wait_seconds(self, duration):
+        await self.wait_samples(round(duration * vgm.SAMPLE_RATE))
+
+
+class RealtimeSender:
+    """ Plays through a USBStreamPlayer from a dedicated sender thread.
+
+        The parser runs ahead in the calling thread and fills an EventRing
+        through the RingWriter. The sender thread only sleeps until the next
+        deadline of the player's scheduler and sends, so parsing no longer
+        delays the writes. It starts once the ring holds prefill writes or the
+        song has been parsed completely. Every time it finds the ring empty
+        before the end of the song it counts an underrun.
+
+        Both threads still share the interpreter lock. To keep the parser from
+        holding it through a deadline, the switch interval is lowered during
+        playback. With priority the sender thread asks for SCHED_FIFO at that
+        priority, which usually needs CAP_SYS_NICE.
+    """
+    # poll interval of the sender while the ring is empty
+    EMPTY_SLEEP = 0.0002
+
+    def __init__(self, player, *, capacity=1 << 16, prefill=None, priority=None, switch_interval=0.0005):
+        self.player   = player
+        self.ring     = EventRing(capacity)
+        self.writer   = RingWriter(self.ring, self)
+        self.prefill  = capacity // 2 if prefill is None else prefill
+        self.priority = priority
+        self.switch_interval = switch_interval
+        self.error    = None
+        # set when playback is aborted
+        self._stop    = False
+
+        # statistics
+        self.events         = 0
+        self.underruns      = 0
+        self.underrun_time  = 0.0
+        self.fill_min       = capacity
+        self.priority_error = None
+
+        self._thread = threading.Thread(target=self._send, name="vgm-sender", daemon=True)
+
+    def check(self):
+        """ raises the error of the sender thread in the producer """
+        if self.error is not None:
+            raise self.error
+
+    def _raise_priority(self):
+        try:
+            os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(self.priority))
+        except (AttributeError, OSError) as e:
+            self.priority_error = e
+
+    def _wait_for_events(self, count):
+        """ waits until the ring holds count writes or is closed,
+            returns False if it is closed and empty """
+        ring = self.ring
+        while ring.fill < count and not ring.closed and not self._stop:
+            time.sleep(self.EMPTY_SLEEP)
+        return ring.fill > 0
+
+    def _send(self):
+        ring, player = self.ring, self.player
+        scheduler, timing = player.scheduler, player.timing
+        positions, addresses, datas, mask = ring.position, ring.address, ring.data, ring.mask
+        try:
+            if self.priority is not None:
+                self._raise_priority()
+            # filling the ring is start up latency, not an underrun
+            self._wait_for_events(self.prefill)
+            scheduler.start()
+
+            while not self._stop:
+                # closed is read before head, so no write can be missed
+                closed = ring.closed
+                tail, head = ring.tail, ring.head
+                if tail == head:
+                    if closed:
+                        scheduler.advance(ring.end - scheduler.position)
+                        player.flush()
+                        scheduler.wait()
+                        break
+                    self.underruns += 1
+                    start = time.perf_counter()
+                    self._wait_for_events(1)
+                    self.underrun_time += time.perf_counter() - start
+                    continue
+
+                self.fill_min = min(self.fill_min, head - tail)
+                for i in range(tail, head):
+                    j = i & mask
+                    position = int(positions[j])
+                    # the same merging of short waits as USBStreamPlayer.wait_samples
+                    if position > scheduler.position and scheduler.advance(position - scheduler.position):
+                        player.flush()
+                        # hand the slots read so far back to the producer before sleeping
+                        ring.tail = i
+                        scheduler.wait()
+                    if timing is not None:
+                        timing.schedule(position)
+                    player.pending += (int(addresses[j]), int(datas[j]))
+                ring.tail = head
+                self.events += head - tail
+        except Exception as e:
+            self.error = e
+            # unblock a producer waiting for space
+            ring.tail = ring.head
+
+    def run(self, play):
+        """ runs the coroutine function play with the ring writer as player,
+            while the sender thread plays the writes """
+        switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(self.switch_interval)
+        self._thread.start()
+        try:
+            asyncio.run(play(self.writer))
+        except BaseException:
+            self._stop = True
+            raise
+        finally:
+            self.ring.close(self.writer.position)
+            self._thread.join()
+            sys.setswitchinterval(switch_interval)
+        self.check()
+
+    def report(self):
+        lines = [f"sender: {self.events} writes, lowest ring fill {self.fill_min} of {self.ring.capacity}, "
+                 f"{self.underruns} underruns, {self.underrun_time * 1e3:.1f}ms spent waiting for the parser, "
+                 f"parser waited {self.writer.full_waits} times for space"]
+        if self.priority_error is not None:
+            lines.append(f"sender: could not raise the priority: {self.priority_error}")
+        return "\n".join(lines)
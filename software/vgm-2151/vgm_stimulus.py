@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+import struct
+import argparse
+import vgm
+from midi_transport import usb_midi_packets
+from vgm_play_usb import write_messages
+
+
+__all__ = ["write_stimulus"]
+
+
+# stimulus file layout, all little endian:
+#   header: magic, sample rate, total samples
+#   records: sample time, number of bytes, the USB MIDI event packets due at that time
+MAGIC  = b"VGMS"
+HEADER = struct.Struct("<4sLL")
+RECORD = struct.Struct("<LH")
+# keep a record within the 16 bit length field
+MAX_RECORD_BYTES = 0xfff0
+
+
+def write_stimulus(reader, out, *, loops=0):
+    """ converts the YM2151 writes of the reader into the USB MIDI byte stream
+        which MIDIController receives, for the verilated SynthModule bench.
+        Returns the number of records written """
+    records = 0
+    end     = 0
+    out.write(HEADER.pack(MAGIC, vgm.SAMPLE_RATE, 0))
+
+    def flush(time, writes):
+        packets = bytearray()
+        for message in write_messages(writes):
+            packets += usb_midi_packets(message)
+        chunks = range(0, len(packets), MAX_RECORD_BYTES)
+        for i in chunks:
+            chunk = packets[i:i + MAX_RECORD_BYTES]
+            out.write(RECORD.pack(time, len(chunk)))
+            out.write(chunk)
+        return len(chunks)
+
+    pending, pending_time = [], 0
+    for events in reader.iter_events(loops=loops):
+        for time, kind, a, b, c in events:
+            if kind == vgm.EVENT_YM2151:
+                if pending and time != pending_time:
+                    records += flush(pending_time, pending)
+                    pending = []
+                pending_time = time
+                pending += (a, b)
+            elif kind == vgm.EVENT_WAIT:
+                end = time + a
+    if pending:
+        records += flush(pending_time, pending)
+
+    # the song length goes into the header, so the bench knows when to stop
+    out.seek(0)
+    out.write(HEADER.pack(MAGIC, vgm.SAMPLE_RATE, end))
+    return records
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="convert a VGM file into a MIDI stream stimulus "
+                                                 "for gateware/synthmodule-bench")
+    parser.add_argument("file")
+    parser.add_argument("-o", "--output", default="stimulus.bin")
+    parser.add_argument("--loops", type=int, default=0, help="how often to repeat the looped part")
+    args = parser.parse_args()
+
+    with open(args.file, "rb") as file:
+        reader = vgm.VGMStreamReader.from_file(file)
+    with open(args.output, "wb") as out:
+        records = write_stimulus(reader, out, loops=args.loops)
+    print(f"{args.output}: {records} records, {float(reader.total_seconds):.1f}s")
@@ -0,0 +1,99 @@
+import numpy as np
+import vgm
+
+
+__all__ = ["SendTiming", "histogram_lines"]
+
+
+# upper bounds of the histogram bins, in milliseconds
+HISTOGRAM_BINS_MS = [0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50, 100]
+
+
+def histogram_lines(name, counts):
+    """ formats the counts of SendTiming.histogram(), leaving out empty bins """
+    labels = [f"<= {limit:g}ms" for limit in HISTOGRAM_BINS_MS] + [f"> {HISTOGRAM_BINS_MS[-1]:g}ms"]
+    lines  = [f"    {name}:"]
+    for label, count in zip(labels, counts):
+        if count:
+            lines.append(f"        {label:>10} {count}")
+    return lines
+
+
+class SendTiming:
+    """ Records when each register write was due and when it actually went out.
+
+        The times are kept in preallocated arrays, so recording does not
+        allocate anything per write. The scheduled time is the song position
+        of the write, the actual time is when the transport returned from
+        sending it, both in seconds from the start of playback. Writes beyond
+        the capacity are only counted.
+    """
+    def __init__(self, capacity=1 << 20):
+        self.scheduled = np.zeros(capacity)
+        self.actual    = np.zeros(capacity)
+        # number of recorded writes, and how many of them have been sent
+        self.count     = 0
+        self.sent      = 0
+        self.dropped   = 0
+
+    def schedule(self, position):
+        """ a write is due at the song position position (in samples) """
+        if self.count < len(self.scheduled):
+            self.scheduled[self.count] = position / vgm.SAMPLE_RATE
+            self.count += 1
+        else:
+            self.dropped += 1
+
+    @property
+    def pending(self):
+        return self.sent < self.count
+
+    def mark_sent(self, elapsed):
+        """ all writes scheduled so far have been sent at elapsed seconds """
+        self.actual[self.sent:self.count] = elapsed
+        self.sent = self.count
+
+    def lateness(self):
+        """ actual minus scheduled send time of every sent write, in seconds """
+        return self.actual[:self.sent] - self.scheduled[:self.sent]
+
+    def jitter(self):
+        """ change of the lateness from one write to the next, in seconds """
+        return np.abs(np.diff(self.lateness()))
+
+    def longest_stall(self):
+        """ the longest time nothing was sent while the song went on,
+            beyond the time the song itself had nothing to send """
+        if self.sent < 2:
+            return 0.0
+        gaps = np.diff(self.actual[:self.sent]) - np.diff(self.scheduled[:self.sent])
+        return max(float(gaps.max()), 0.0)
+
+    @staticmethod
+    def histogram(values):
+        """ counts of the values (in seconds) per bin of HISTOGRAM_BINS_MS, plus one for the rest """
+        edges = np.array([-np.inf] + HISTOGRAM_BINS_MS + [np.inf]) / 1e3
+        return np.histogram(values, bins=edges)[0]
+
+    def report(self):
+        lateness = self.lateness()
+        if not len(lateness):
+            return "send timing: no writes"
+        p50, p99 = np.percentile(lateness, [50, 99])
+        lines = [f"send timing: {self.sent} writes, latency p50 {p50 * 1e3:.2f}ms, p99 {p99 * 1e3:.2f}ms, "
+                 f"max {lateness.max() * 1e3:.2f}ms, longest stall {self.longest_stall() * 1e3:.2f}ms"
+                 + (f", {self.dropped} writes not recorded" if self.dropped else "")]
+        lines += histogram_lines("latency", self.histogram(lateness))
+        lines += histogram_lines("jitter",  self.histogram(self.jitter()))
+        return "\n".join(lines)
+
+    def export(self, path):
+        """ saves scheduled time, actual time and lateness of every write,
+            as .npz or else as CSV """
+        scheduled = self.scheduled[:self.sent]
+        actual    = self.actual[:self.sent]
+        if path.endswith(".npz"):
+            np.savez(path, scheduled=scheduled, actual=actual, lateness=actual - scheduled)
+        else:
+            np.savetxt(path, np.stack([scheduled, actual, actual - scheduled], axis=1),
+                       delimiter=",", header="scheduled,actual,lateness", comments="", fmt="%.9f")
@@ -0,0 +1,86 @@
+__all__ = ["YM2151Shadow", "SIDE_EFFECT_REGISTERS", "PMD_SLOT"]
+
+
+# writes to these registers trigger an action in the chip,
+# so they have to be sent even if the value does not change
+SIDE_EFFECT_REGISTERS = frozenset([
+    0x01, # test register, bit 1 resets the LFO
+    0x08, # key on/off
+    0x14, # timer load, IRQ enable and flag reset
+])
+
+# 0x19 holds the AM depth when bit 7 is 0 and the PM depth when bit 7 is 1,
+# so the PM depth is tracked in an extra slot behind the 256 registers
+PMD_SLOT = 0x100
+
+
+class YM2151Shadow:
+    """ Shadow copy of the YM2151 register file.
+
+        write() returns whether a register write changes the chip state
+        and thereby has to be sent. Registers start out as unknown,
+        so the first write to each of them always goes through.
+    """
+    def __init__(self):
+        self.registers = [None] * 257
+        # key on slot bits (C2 M2 C1 M1) per channel, as last written to 0x08
+        self.key_on    = [0] * 8
+        # per register number of dropped (hits) and sent (misses) writes
+        self.hits      = [0] * 256
+        self.misses    = [0] * 256
+
+    def reset(self):
+        """ forget the register contents, e.g. after the chip has been reset """
+        self.registers = [None] * 257
+        self.key_on    = [0] * 8
+
+    def copy(self):
+        """ snapshot of the register state, without the statistics """
+        result = YM2151Shadow()
+        result.registers = list(self.registers)
+        result.key_on    = list(self.key_on)
+        return result
+
+    def load(self, state):
+        """ takes over the register state of another shadow, e.g. one read back from the synth """
+        self.registers = list(state.registers)
+        self.key_on    = list(state.key_on)
+
+    def diff(self, target):
+        """ yields the (address, data) writes which bring a chip
+            in this state into the state of the target shadow """
+        for slot, data in enumerate(target.registers):
+            address = 0x19 if slot == PMD_SLOT else slot
+            if data is None or address in SIDE_EFFECT_REGISTERS:
+                continue
+            if self.registers[slot] != data:
+                yield address, data
+
+        # key on/off last, so the notes start with the restored settings
+        for channel, slots in enumerate(target.key_on):
+            if self.key_on[channel] != slots:
+                yield 0x08, (slots << 3) | channel
+
+    def write(self, address, data):
+        if address == 0x08:
+            self.key_on[data & 0x7] = (data >> 3) & 0xf
+
+        slot = PMD_SLOT if address == 0x19 and data & 0x80 else address
+        if self.registers[slot] == data and address not in SIDE_EFFECT_REGISTERS:
+            self.hits[address] += 1
+            return False
+
+        self.registers[slot] = data
+        self.misses[address] += 1
+        return True
+
+    def report(self, top=8):
+        hits   = sum(self.hits)
+        writes = hits + sum(self.misses)
+        rate   = hits / writes if writes else 0.0
+        lines  = [f"register shadow: dropped {hits} of {writes} writes ({rate:.1%})"]
+        busiest = sorted(range(256), key=lambda address: self.hits[address], reverse=True)[:top]
+        for address in busiest:
+            if self.hits[address]:
+                lines.append(f"    {address:02x}: dropped {self.hits[address]} sent {self.misses[address]}")
+        return "\n".join(lines)
@@ -0,0 +1,356 @@
+import math
+import numpy as np
+
+
+__all__ = ["YM2151Model", "JT51_CLOCK", "NTSC_CLOCK"]
+
+
+# SynthModule runs the JT51 from a 3.584 MHz PLL output,
+# a real YM2151 usually gets the 3.579545 MHz NTSC color clock
+JT51_CLOCK = 3_584_000
+NTSC_CLOCK = 3_579_545
+# one output sample takes 64 chip clock cycles
+CYCLES_PER_SAMPLE = 64
+
+# operator order in the register file and in the 32 entry state arrays
+M1, M2, C1, C2 = 0, 1, 2, 3
+
+# envelope generator stages
+ATTACK, DECAY1, DECAY2, RELEASE = 0, 1, 2, 3
+# attenuation in 0.09375 dB units, 64 units halve the amplitude
+MAX_ATTENUATION = 1023
+# the envelopes are advanced in steps of this many samples,
+# within a step the attenuation is interpolated linearly
+EG_STEP = 32
+# samples rendered in one go
+BLOCK_SIZE = 1024
+
+# DT1 detune by key code, in 2^-20 cycles per sample
+_DT1 = np.array([
+    [0] * 32,
+    [0, 0, 0, 0, 1, 1, 1, 1, 1, 1, 1, 1, 2, 2, 2, 2,
+     2, 3, 3, 3, 4, 4, 4, 5, 5, 6, 6, 7, 8, 8, 8, 8],
+    [1, 1, 1, 1, 2, 2, 2, 2, 2, 3, 3, 3, 4, 4, 4, 5,
+     5, 6, 6, 7, 8, 8, 9, 10, 11, 12, 13, 14, 16, 16, 16, 16],
+    [2, 2, 2, 2, 2, 3, 3, 3, 4, 4, 4, 5, 5, 6, 6, 7,
+     8, 8, 9, 10, 11, 12, 13, 14, 16, 17, 19, 20, 22, 22, 22, 22],
+], dtype=np.float64) / (1 << 20)
+# DT2 coarse detune in cents
+_DT2_CENTS = np.array([0, 600, 781, 950])
+# maximum pitch modulation by PMS in cents
+_PMS_CENTS = np.array([0, 5, 10, 20, 50, 100, 400, 700])
+
+# envelope rate -> attenuation change per sample.
+# The attenuation moves by 4 to 7 (by the two low bits of the rate) units per
+# 4 * 2048 * 3 samples at rate 0, and twice as fast for every 4 rates above
+_RATES = np.arange(64)
+_SLOPE = np.where(_RATES == 0, 0.0,
+                  np.minimum((4 + (_RATES & 3)) * 2.0 ** (_RATES >> 2) / (4 * 2048 * 3), 8 / 3))
+
+# modulation depth: a full scale operator output shifts the phase of
+# the modulated operator by 4 cycles, the feedback sum by 2 cycles at FB 7
+_MODULATION = 4.0
+
+# which operator outputs go into which operator input, by connection (CON),
+# evaluated in the order M1, C1, M2, C2
+#                 M1>C1 M1>M2 C1>M2 M1>C2 C1>C2 M2>C2    outputs M1 M2 C1 C2
+_CONNECTIONS = [
+    ((1, 0, 1, 0, 0, 1), (0, 0, 0, 1)),
+    ((0, 1, 1, 0, 0, 1), (0, 0, 0, 1)),
+    ((0, 0, 1, 1, 0, 1), (0, 0, 0, 1)),
+    ((1, 0, 0, 0, 1, 1), (0, 0, 0, 1)),
+    ((1, 0, 0, 0, 0, 1), (0, 0, 1, 1)),
+    ((1, 1, 0, 1, 0, 0), (0, 1, 1, 1)),
+    ((1, 0, 0, 0, 0, 0), (0, 1, 1, 1)),
+    ((0, 0, 0, 0, 0, 0), (1, 1, 1, 1)),
+]
+_ROUTING = np.array([routing for routing, _ in _CONNECTIONS], dtype=np.float64).T
+_OUTPUTS = np.array([outputs for _, outputs in _CONNECTIONS], dtype=np.float64).T
+
+# the LFO runs from 0.0081 Hz at LFRQ 0 to 52.9 Hz at LFRQ 255 with a 3.579545 MHz clock
+_LFO_MIN = 0.0081
+_LFO_MAX = 52.9
+# random values of the noise LFO waveform, held for 1/16 of an LFO period
+_LFO_NOISE_STEPS = 16
+
+
+class YM2151Model:
+    """ NumPy model of the YM2151 sound generation, for rendering VGM files offline.
+
+        Models the 8 channels with 4 operators each, the connections, operator 1
+        feedback, the ADSR envelopes with key scaling, detune and multiplier,
+        the LFO with AM and PM, and the noise generator on channel 8.
+        The state of all 32 operators is kept in arrays indexed like the
+        low five bits of the operator registers (operator * 8 + channel).
+        render() computes blocks of samples vectorized over channels, operators
+        and time; only operator 1 feedback has to be computed sample by sample.
+
+        This is a model for listening and regression tests, not a bit exact emulation.
+    """
+    def __init__(self, clock=JT51_CLOCK, seed=0):
+        self.clock       = clock
+        self.sample_rate = clock / CYCLES_PER_SAMPLE
+        self._rng        = np.random.default_rng(seed)
+        self._lfo_noise  = self._rng.random(4096)
+        self.reset()
+
+    def reset(self):
+        self.registers = np.zeros(256, dtype=np.int64)
+        self.pmd       = 0
+        self.amd       = 0
+        # per operator state
+        self.key_on    = np.zeros(32, dtype=bool)
+        self.phase     = np.zeros(32)
+        self.attenuation = np.full(32, float(MAX_ATTENUATION))
+        self.stage     = np.full(32, RELEASE)
+        # last two outputs of each M1, for the feedback
+        self.feedback  = np.zeros((2, 8))
+        self.lfo_phase = 0.0
+        self.noise_phase = 0.0
+        self.noise_value = 1.0
+        # samples since the last envelope step
+        self.eg_position = 0
+        self._dirty    = True
+
+    def write(self, address, data):
+        self.registers[address] = data
+        if address == 0x01:
+            if data & 0x02:
+                self.lfo_phase = 0.0
+        elif address == 0x08:
+            self._key(data)
+        elif address == 0x19:
+            if data & 0x80:
+                self.pmd = data & 0x7f
+            else:
+                self.amd = data & 0x7f
+        self._dirty = True
+
+    def _key(self, data):
+        channel = data & 0x07
+        # key on bits 3-6 are M1, C1, M2, C2
+        for bit, operator in enumerate((M1, C1, M2, C2)):
+            slot = operator * 8 + channel
+            on = bool(data & (0x08 << bit))
+            if on and not self.key_on[slot]:
+                self.stage[slot] = ATTACK
+                self.phase[slot] = 0.0
+                if operator == M1:
+                    self.feedback[:, channel] = 0.0
+            elif not on and self.key_on[slot]:
+                self.stage[slot] = RELEASE
+            self.key_on[slot] = on
+
+    def _update(self):
+        """ derives the per operator parameters from the register file """
+        regs     = self.registers
+        channels = np.arange(32) & 7
+
+        key_code = regs[0x28:0x30] & 0x7f
+        octave   = key_code >> 4
+        note     = key_code & 0x0f
+        fraction = regs[0x30:0x38] >> 2
+        # key code 0x4A is A4 = 440 Hz
+        semitones = (octave - 4) * 12 + (note - (note >> 2)) - 8 + fraction / 64
+        frequency = 440.0 * 2.0 ** (semitones / 12) * self.clock / NTSC_CLOCK
+
+        dt1 = (regs[0x40:0x60] >> 4) & 0x07
+        mul = regs[0x40:0x60] & 0x0f
+        dt2 = regs[0xC0:0xE0] >> 6
+        # rate scaling and detune use the top 5 bits of the key code
+        kcode = key_code[channels] >> 2
+
+        increment  = frequency[channels] * 2.0 ** (_DT2_CENTS[dt2] / 1200) / self.sample_rate
+        detune     = _DT1[dt1 & 3, kcode]
+        increment += np.where(dt1 & 4, -detune, detune)
+        self.increment = increment * np.where(mul == 0, 0.5, mul)
+
+        ks      = regs[0x80:0xA0] >> 6
+        scaling = kcode >> (3 - ks)
+        def rate(value):
+            return np.where(value == 0, 0, np.minimum(63, 2 * value + scaling))
+        self.rates = np.stack([
+            rate(regs[0x80:0xA0] & 0x1f),
+            rate(regs[0xA0:0xC0] & 0x1f),
+            rate(regs[0xC0:0xE0] & 0x1f),
+            # the 4 bit release rate is the top of a 5 bit rate, with the low bit set
+            rate((regs[0xE0:0x100] & 0x0f) * 2 + 1),
+        ])
+        d1l = regs[0xE0:0x100] >> 4
+        self.sustain = np.where(d1l == 15, 31 << 5, d1l << 5).astype(np.float64)
+        self.total_level = (regs[0x60:0x80] & 0x7f) * 8.0
+
+        self.ams_enable = (regs[0xA0:0xC0] & 0x80) != 0
+        self.ams = regs[0x38:0x40] & 0x03
+        self.pms = (regs[0x38:0x40] >> 4) & 0x07
+        control = regs[0x20:0x28]
+        self.connection = control & 0x07
+        self.fb_shift   = (control >> 3) & 0x07
+        self.left       = ((control >> 6) & 1).astype(np.float64)
+        self.right      = ((control >> 7) & 1).astype(np.float64)
+
+        self.noise_enable = bool(regs[0x0F] & 0x80)
+        self.noise_rate   = self.clock / (32 * (32 - (regs[0x0F] & 0x1f)))
+
+        lfrq = regs[0x18]
+        self.lfo_rate = _LFO_MIN * (_LFO_MAX / _LFO_MIN) ** (lfrq / 255) * self.clock / NTSC_CLOCK
+        self.lfo_wave = regs[0x1B] & 0x03
+        self._dirty = False
+
+    def _envelope_step(self, samples):
+        """ advances the envelopes by samples and returns the new attenuation """
+        attenuation = self.attenuation
+        stage = self.stage
+        rate  = self.rates[stage, np.arange(32)]
+        slope = _SLOPE[rate] * samples
+
+        attack = stage == ATTACK
+        # the attack curve is exponential, the other stages are linear in dB
+        new = np.where(attack, attenuation * np.exp(-slope / 16), attenuation + slope)
+        new[attack & (rate >= 62)] = 0.0
+
+        attacked = attack & (new < 1.0)
+        new[attacked] = 0.0
+        stage[attacked] = DECAY1
+
+        decayed = (stage == DECAY1) & (new >= self.sustain)
+        new[decayed] = self.sustain[decayed]
+        stage[decayed] = DECAY2
+
+        np.minimum(new, MAX_ATTENUATION, out=new)
+        self.attenuation = new
+        return new
+
+    def _envelopes(self, samples):
+        """ attenuation of every operator for every sample of the block, shape (32, samples) """
+        result = np.empty((32, samples))
+        position = 0
+        while position < samples:
+            step  = min(EG_STEP - self.eg_position, samples - position)
+            start = self.attenuation
+            end   = self._envelope_step(step)
+            weights = np.arange(1, step + 1) / step
+            result[:, position:position + step] = start[:, None] + (end - start)[:, None] * weights
+            position += step
+            self.eg_position = (self.eg_position + step) % EG_STEP
+        return result
+
+    def _lfo(self, samples):
+        """ AM (0 to 1) and PM (-1 to 1) LFO outputs for the block """
+        phase = self.lfo_phase + self.lfo_rate / self.sample_rate * np.arange(samples)
+        self.lfo_phase = (self.lfo_phase + self.lfo_rate / self.sample_rate * samples) % 1.0
+        cycle = phase % 1.0
+        if self.lfo_wave == 0:   # saw
+            am = 1.0 - cycle
+            pm = np.where(cycle < 0.5, 2 * cycle, 2 * cycle - 2)
+        elif self.lfo_wave == 1: # square
+            am = (cycle < 0.5).astype(np.float64)
+            pm = np.where(cycle < 0.5, 1.0, -1.0)
+        elif self.lfo_wave == 2: # triangle
+            am = 1.0 - np.abs(2 * cycle - 1)
+            pm = np.where(cycle < 0.25, 4 * cycle, np.where(cycle < 0.75, 2 - 4 * cycle, 4 * cycle - 4))
+        else:                    # noise
+            steps = (phase * _LFO_NOISE_STEPS).astype(np.int64) % len(self._lfo_noise)
+            am = self._lfo_noise[steps]
+            pm = 2 * am - 1
+        return am, pm
+
+    def _noise(self, samples):
+        """ noise generator output, replaces C2 of channel 8 when enabled """
+        phase = self.noise_phase + self.noise_rate / self.sample_rate * np.arange(1, samples + 1)
+        self.noise_phase = phase[-1] % 1.0
+        changes = np.floor(phase).astype(np.int64)
+        values  = np.where(self._rng.random(changes[-1] + 1) < 0.5, -1.0, 1.0)
+        values[0] = self.noise_value
+        self.noise_value = values[changes[-1]]
+        return values[changes]
+
+    def render(self, samples):
+        """ renders samples output samples, returns a (samples, 2) float array
+            of the left and right output, with full scale at +-1.0 """
+        output = np.empty((samples, 2))
+        position = 0
+        while position < samples:
+            block = min(BLOCK_SIZE, samples - position)
+            output[position:position + block] = self._render_block(block)
+            position += block
+        return output
+
+    def _render_block(self, samples):
+        if self._dirty:
+            self._update()
+
+        attenuation = self._envelopes(samples) + self.total_level[:, None]
+        am, pm = self._lfo(samples)
+        if self.amd:
+            depth = self.amd * (2 << np.maximum(self.ams - 1, 0)) * (self.ams > 0)
+            attenuation += np.where(self.ams_enable[:, None], depth[np.arange(32) & 7, None] * am, 0.0)
+        amplitude = np.where(attenuation < MAX_ATTENUATION, 2.0 ** (-attenuation / 64), 0.0)
+        active = amplitude.any(axis=1)
+
+        # phase of each operator at each sample, in cycles
+        if self.pmd and self.pms.any():
+            cents     = pm * self.pmd / 127 * _PMS_CENTS[self.pms][:, None]
+            increment = self.increment[:, None] * 2.0 ** (cents[np.arange(32) & 7] / 1200)
+            advance   = np.cumsum(increment, axis=1)
+            phase     = self.phase[:, None] + advance - increment
+            self.phase = (self.phase + advance[:, -1]) % 1.0
+        else:
+            phase      = self.phase[:, None] + self.increment[:, None] * np.arange(samples)
+            self.phase = (self.phase + self.increment * samples) % 1.0
+
+        phase  = phase.reshape(4, 8, samples)
+        amp    = amplitude.reshape(4, 8, samples)
+        routing = _ROUTING[:, self.connection][:, :, None]
+
+        m1 = self._feedback_operator(phase[M1], amp[M1])
+        c1 = self._operator(phase[C1] + _MODULATION * routing[0] * m1, amp[C1])
+        m2 = self._operator(phase[M2] + _MODULATION * (routing[1] * m1 + routing[2] * c1), amp[M2])
+        c2_mod = _MODULATION * (routing[3] * m1 + routing[4] * c1 + routing[5] * m2)
+        c2 = self._operator(phase[C2] + c2_mod, amp[C2])
+        if self.noise_enable:
+            c2[7] = self._noise(samples) * amp[C2, 7]
+
+        outputs = _OUTPUTS[:, self.connection][:, :, None]
+        channel = outputs[M1] * m1 + outputs[M2] * m2 + outputs[C1] * c1 + outputs[C2] * c2
+        # a full scale carrier is a quarter of the 16 bit output range
+        channel *= 0.25
+        left  = self.left  @ channel
+        right = self.right @ channel
+        return np.clip(np.stack([left, right], axis=1), -1.0, 1.0)
+
+    @staticmethod
+    def _operator(phase, amplitude):
+        return np.sin(2 * np.pi * phase) * amplitude
+
+    def _feedback_operator(self, phase, amplitude):
+        """ M1 of all channels. Channels with feedback need the previous two
+            outputs, so they are computed sample by sample """
+        shift   = self.fb_shift
+        looped  = (shift > 0) & amplitude.any(axis=1)
+        output  = self._operator(phase, amplitude)
+        if not looped.any():
+            self._keep_feedback(output)
+            return output
+
+        # the sum of the last two outputs shifts the phase by up to 2 cycles at FB 7.
+        # The recursion runs on Python floats, which is faster than numpy for 8 values
+        angles = (2 * np.pi * phase).tolist()
+        amps   = amplitude.tolist()
+        sin    = math.sin
+        for channel in np.flatnonzero(looped):
+            scale = 2 * math.pi * 2.0 ** (shift[channel] - 7)
+            previous, last = self.feedback[:, channel]
+            result = []
+            append = result.append
+            for angle, amp in zip(angles[channel], amps[channel]):
+                value = sin(angle + scale * (previous + last)) * amp
+                append(value)
+                previous, last = last, value
+            output[channel] = result
+        self._keep_feedback(output)
+        return output
+
+    def _keep_feedback(self, output):
+        self.feedback[0] = output[:, -2] if output.shape[1] > 1 else self.feedback[1]
+        self.feedback[1] = output[:, -1]